@@ -53,9 +53,19 @@ def test_redis_map(cluster):
             conn.get('bar')
 
 
+def test_redis_map_transaction(cluster):
+    with cluster.map(transaction=True) as conn:
+        for n in xrange(5):
+            conn.set('foo', 'bar')
+            conn.get('foo')
+            conn.set('biz', 'bar')
+            conn.get('biz')
+            conn.get('bar')
+
+
 def main(iterations=1000):
     for cluster in ('partition_cluster', 'ketama_cluster', 'roundrobin_cluster'):
-        for func in ('test_redis_normal', 'test_redis_map'):
+        for func in ('test_redis_normal', 'test_redis_map', 'test_redis_map_transaction'):
             print "Running %r on %r" % (func, cluster)
             s = time.time()
             for x in xrange(iterations):
@@ -9,11 +9,12 @@ __email__ = "creotiv@gmail.com"
 __version__ = 0.1
 __status__ = "productrion"
 
-__all__ = ['Ketama']
+__all__ = ['Ketama', 'LibmemcachedKetama']
 
 import hashlib
 import math
-from bisect import bisect
+import struct
+from bisect import bisect, bisect_left
 
 
 class Ketama(object):
@@ -23,12 +24,19 @@ class Ketama(object):
             nodes   - List of nodes(strings)
             weights - Dictionary of node wheights where keys are nodes names.
                       if not set, all nodes will be equal.
+
+            Each node is given 160 points on the circle per unit of weight,
+            independently of all other nodes, so nodes can be added and
+            removed without moving the points of any other node.
         """
-        self._hashring = dict()
-        self._sorted_keys = []
+        # (hashring, sorted keys), replaced together so that lookups never
+        # see the keys of one circle with the points of another
+        self._circle = (dict(), [])
 
         self._nodes = set(nodes or [])
-        self._weights = weights if weights else {}
+        self._weights = dict(weights or {})
+        # node: list of its points
+        self._points = dict()
 
         self._build_circle()
 
@@ -36,39 +44,60 @@ class Ketama(object):
         """
             Creates hash ring.
         """
-        total_weight = 0
+        hashring = dict()
+        self._points = dict()
         for node in self._nodes:
-            total_weight += self._weights.get(node, 1)
+            self._points[node] = self._get_points(node)
+            for key in self._points[node]:
+                hashring[key] = node
 
-        for node in self._nodes:
-            weight = self._weights.get(node, 1)
+        self._set_circle(hashring)
 
-            ks = math.floor((40 * len(self._nodes) * weight) / total_weight)
+    def _set_circle(self, hashring):
+        self._circle = (hashring, sorted(hashring))
 
-            for i in xrange(0, int(ks)):
-                b_key = self._md5_digest('%s-%s-salt' % (node, i))
+    @property
+    def _hashring(self):
+        return self._circle[0]
 
-                for l in xrange(0, 4):
-                    key = ((b_key[3 + l * 4] << 24)
-                           | (b_key[2 + l * 4] << 16)
-                           | (b_key[1 + l * 4] << 8)
-                           | b_key[l * 4])
+    @property
+    def _sorted_keys(self):
+        return self._circle[1]
 
-                    self._hashring[key] = node
-                    self._sorted_keys.append(key)
+    def _get_hash_count(self, node):
+        """
+            Return the number of digests (of four points each) for a node.
+        """
+        return int(math.floor(40 * self._weights.get(node, 1)))
 
-        self._sorted_keys.sort()
+    def _get_point_key(self, node, index):
+        return '%s-%s-salt' % (node, index)
 
-    def _get_node_pos(self, key):
+    def _get_points(self, node):
+        """
+            Return the points of a node on the circle.
         """
-            Return node position(integer) for a given key. Else return None
+        points = []
+        for i in xrange(0, self._get_hash_count(node)):
+            b_key = self._md5_digest(self._get_point_key(node, i))
+
+            for l in xrange(0, 4):
+                points.append((b_key[3 + l * 4] << 24)
+                              | (b_key[2 + l * 4] << 16)
+                              | (b_key[1 + l * 4] << 8)
+                              | b_key[l * 4])
+        return points
+
+    def _get_node_pos(self, key, nodes):
         """
-        if not self._hashring:
+            Return node position(integer) for a given key within the sorted
+            keys nodes. Else return None
+        """
+        if not nodes:
             return None
 
         key = self._gen_key(key)
 
-        nodes = self._sorted_keys
         pos = bisect(nodes, key)
 
         if pos == len(nodes):
@@ -94,37 +123,131 @@ class Ketama(object):
 
     def remove_node(self, node):
         """
-            Removes node from circle and rebuild it.
+            Removes node (and only its points) from circle. Its weight is
+            kept, should it be added again.
         """
-        try:
-            self._nodes.remove(node)
-            del self._weights[node]
-        except (KeyError, ValueError):
-            pass
-        self._hashring = dict()
-        self._sorted_keys = []
-
-        self._build_circle()
-
-    def add_node(self, node, weight=1):
+        self._nodes.discard(node)
+        points = self._points.pop(node, None)
+        if not points:
+            return
+
+        # the circle is replaced rather than changed in place, so that
+        # lookups in progress are not affected
+        hashring = dict(self._hashring)
+        for key in points:
+            if hashring.get(key) == node:
+                del hashring[key]
+        self._set_circle(hashring)
+
+    def add_node(self, node, weight=None):
         """
-            Adds node to circle and rebuild it.
+            Adds node (and only its points) to circle. Unless set, its
+            weight is that it was last added with (or 1).
         """
+        if node in self._nodes:
+            self.remove_node(node)
         self._nodes.add(node)
-        self._weights[node] = weight
-        self._hashring = dict()
-        self._sorted_keys = []
+        if weight is not None:
+            self._weights[node] = weight
+        self._points[node] = self._get_points(node)
 
-        self._build_circle()
+        hashring = dict(self._hashring)
+        for key in self._points[node]:
+            hashring[key] = node
+        self._set_circle(hashring)
 
     def get_node(self, key):
         """
             Return node for a given key. Else return None.
         """
-        pos = self._get_node_pos(key)
+        hashring, sorted_keys = self._circle
+        pos = self._get_node_pos(key, sorted_keys)
         if pos is None:
             return None
-        return self._hashring[self._sorted_keys[pos]]
+        return hashring[sorted_keys[pos]]
+
+    def get_nodes(self, key, count):
+        """
+            Return up to count distinct nodes for a given key, walking the
+            circle from its position. The first node is always the node
+            returned by get_node.
+        """
+        hashring, sorted_keys = self._circle
+        pos = self._get_node_pos(key, sorted_keys)
+        if pos is None:
+            return []
+
+        nodes = []
+        num_keys = len(sorted_keys)
+        for i in xrange(num_keys):
+            node = hashring[sorted_keys[(pos + i) % num_keys]]
+            if node not in nodes:
+                nodes.append(node)
+                if len(nodes) == count:
+                    break
+        return nodes
+
+
+def _float32(value):
+    """
+        Rounds value to single precision, as libmemcached computes in floats.
+    """
+    return struct.unpack('f', struct.pack('f', value))[0]
+
+
+class LibmemcachedKetama(Ketama):
+    """
+        Hash ring placing keys exactly as libmemcached (and so pylibmc) does
+        with weighted ketama (the ``ketama_weighted`` behaviour).
+
+        Nodes are named ``host:port``. Each is given 160 points per server
+        (scaled by its share of the total weight), hashed from
+        ``host:port-i`` (or ``host-i`` on the default port), with four points
+        sliced from every MD5 digest.
+
+        As the number of points of every node depends on all other nodes,
+        the circle is rebuilt whenever a node is added or removed.
+    """
+    default_port = 11211
+    points_per_server = 160
+
+    def _build_circle(self):
+        self._total_weight = sum(self._weights.get(node, 1) for node in self._nodes)
+        super(LibmemcachedKetama, self)._build_circle()
+
+    def _get_hash_count(self, node):
+        pct = _float32(_float32(self._weights.get(node, 1)) / _float32(self._total_weight))
+        ks = _float32(_float32(pct * self.points_per_server) / 4)
+        return int(math.floor(_float32(_float32(ks * len(self._nodes)) + 0.0000000001)))
+
+    def _get_point_key(self, node, index):
+        host, sep, port = node.rpartition(':')
+        if not sep or int(port) == self.default_port:
+            return '%s-%d' % (host or node, index)
+        return '%s:%d-%d' % (host, int(port), index)
+
+    def _get_node_pos(self, key, nodes):
+        """
+            Return position of the first point at or after the key.
+        """
+        if not nodes:
+            return None
+
+        pos = bisect_left(nodes, self._gen_key(key))
+
+        if pos == len(nodes):
+            return 0
+        return pos
+
+    def remove_node(self, node):
+        self._nodes.discard(node)
+        self._build_circle()
+
+    def add_node(self, node, weight=None):
+        self._nodes.add(node)
+        if weight is not None:
+            self._weights[node] = weight
+        self._build_circle()
 
 
 if __name__ == '__main__':
@@ -17,10 +17,8 @@ Disqus generic connections wrappers.
 
 __all__ = ('create_cluster', 'connections', 'Cluster')
 
-import copy
-
 from nydus import conf
-from nydus.db.base import LazyConnectionHandler
+from nydus.db.base import LazyConnectionHandler, copy_settings
 from nydus.db.routers.base import BaseRouter
 from nydus.utils import import_string, apply_defaults
 
@@ -46,8 +44,9 @@ def create_cluster(settings):
     >>>     }
     >>> })
     """
-    # Pull in our client
-    settings = copy.deepcopy(settings)
+    # Pull in our client (a codec or hot key sampler may be an instance, which
+    # is shared rather than copied)
+    settings = copy_settings(settings)
     backend = settings.pop('engine', settings.pop('backend', None))
     if isinstance(backend, basestring):
         Conn = import_string(backend)
@@ -74,11 +73,21 @@ def create_cluster(settings):
     else:
         Router = router
 
+    warmup = settings.pop('warmup', None)
+
     # Build the connection cluster
-    return Cluster(
+    cluster = Cluster(
         router=Router,
         backend=Conn,
         **settings
     )
 
+    # Optionally connect to every host right away
+    if warmup:
+        if warmup is True:
+            warmup = {}
+        cluster.warmup(**warmup)
+
+    return cluster
+
 connections = LazyConnectionHandler(lambda: conf.CONNECTIONS)
@@ -8,7 +8,10 @@ nydus.db.backends.base
 
 __all__ = ('BaseConnection',)
 
+import os
+
 from nydus.db.base import BaseCluster
+from nydus.db.commands import CommandTable
 
 
 class BasePipeline(object):
@@ -46,9 +49,19 @@ class BaseConnection(object):
 
     retryable_exceptions = ()
     supports_pipelines = False
+    # Options accepted by ``get_pipeline``, any others given to ``map()`` are
+    # ignored
+    supported_pipeline_options = frozenset()
+    # Describes the commands of the backend (see ``nydus.db.commands``)
+    commands = CommandTable()
+    # Share of keys routed to this host, relative to other hosts (set with
+    # the ``weight`` option of a host)
+    weight = 1
 
     def __init__(self, num, **options):
         self._connection = None
+        # process the connection belongs to
+        self._pid = os.getpid()
         self.num = num
 
     def __getattr__(self, name):
@@ -60,18 +73,40 @@ class BaseConnection(object):
 
     @property
     def connection(self):
+        if self._connection is not None and self._pid != os.getpid():
+            # the connection was inherited from the process we were forked
+            # from, which still uses it
+            self.reset()
         if self._connection is None:
             self._connection = self.connect()
+            self._pid = os.getpid()
         return self._connection
 
     def close(self):
         """
         Close the connection if it is open.
         """
-        if self._connection:
+        # an inherited connection is left open for the parent process
+        if self._connection and self._pid == os.getpid():
             self.disconnect()
         self._connection = None
 
+    def warmup(self, ping=False):
+        """
+        Opens the connection ahead of the first command.
+
+        Backends whose clients connect lazily open a socket here, and with
+        ``ping`` make a round trip to the server.
+        """
+        self.connection
+
+    def reset(self):
+        """
+        Forgets the connection without closing it, so that a forked process
+        opens its own rather than sharing the sockets of its parent.
+        """
+        self._connection = None
+
     def connect(self):
         """
         Connect.
@@ -86,9 +121,54 @@ class BaseConnection(object):
         """
         raise NotImplementedError
 
-    def get_pipeline(self):
+    def to_buffers(self, value):
+        """
+        Wraps any strings within ``value`` (the result of a raw command) in
+        ``memoryview`` objects, which share the memory of the reply.
+        """
+        if isinstance(value, str):
+            return memoryview(value)
+        elif isinstance(value, dict):
+            return dict((k, self.to_buffers(v)) for k, v in value.iteritems())
+        elif isinstance(value, tuple):
+            return tuple(self.to_buffers(v) for v in value)
+        elif isinstance(value, list):
+            return [self.to_buffers(v) for v in value]
+        return value
+
+    def from_buffers(self, value):
+        """
+        Converts any buffer objects within ``value`` (the arguments of a raw
+        command) into values the client is able to send.
+        """
+        if isinstance(value, (memoryview, buffer, bytearray)):
+            return self.from_buffer(value)
+        elif isinstance(value, dict):
+            return dict((k, self.from_buffers(v)) for k, v in value.iteritems())
+        elif isinstance(value, tuple):
+            return tuple(self.from_buffers(v) for v in value)
+        elif isinstance(value, list):
+            return [self.from_buffers(v) for v in value]
+        return value
+
+    def from_buffer(self, value):
+        """
+        Converts a single buffer object into a value the client is able to
+        send.
+
+        Clients generally only accept strings, so by default the buffer is
+        copied (once) here.
+        """
+        if isinstance(value, memoryview):
+            return value.tobytes()
+        return str(value)
+
+    def get_pipeline(self, *args, **kwargs):
         """
         Return a new pipeline instance (bound to this connection).
+
+        Keyword arguments are backend specific pipeline options, such as
+        ``transaction`` for Redis.
         """
         raise NotImplementedError
 
@@ -8,18 +8,61 @@ nydus.db.backends.memcache
 
 from __future__ import absolute_import
 
+import math
 import pylibmc
 
+from contextlib import contextmanager
+from fractions import Fraction, gcd
 from itertools import izip
 from nydus.db.backends import BaseConnection, BasePipeline
+from nydus.db.base import BaseCluster, iter_hosts
+from nydus.db.commands import Command, CommandTable, KEY_LIST, KEY_MAPPING
 from nydus.db.promise import EventualCommand
-from nydus.utils import peek
+from nydus.db.routers import BaseRouter
+from nydus.utils import apply_defaults, peek
+
+
+MEMCACHE_COMMANDS = CommandTable([
+    Command('get', read=True),
+    Command('get_multi', keys=KEY_LIST, read=True, merge='dict'),
+    Command('set_multi', keys=KEY_MAPPING, merge='concat'),
+    Command('add_multi', keys=KEY_MAPPING, merge='concat'),
+    Command('delete_multi', keys=KEY_LIST, merge='all'),
+    # decr stops at zero, so only increments can be merged
+    Command('incr', counter='incr', amount='delta'),
+    Command('set', replaces=True),
+    Command('delete', replaces=(True, False)),
+])
+
+
+def get_weight(server):
+    weight = server.get('weight', 1)
+    try:
+        weight = float(weight)
+    except (TypeError, ValueError):
+        weight = None
+    if weight is None or not weight > 0 or math.isinf(weight):
+        raise ValueError('Invalid weight for %s: %r' % (server.get('host', 'localhost'), server.get('weight')))
+    return weight
+
+
+def scale_weights(weights):
+    """
+    Scales ``weights`` up by the same factor until they are all whole numbers,
+    as libmemcached only takes whole weights. Keys are placed by the share of
+    each weight in the total, which is left unchanged.
+    """
+    fractions = [Fraction(repr(weight)) for weight in weights]
+    scale = reduce(lambda a, b: a * b // gcd(a, b), (f.denominator for f in fractions), 1)
+    return [int(f * scale) for f in fractions]
 
 
 class Memcache(BaseConnection):
 
     retryable_exceptions = frozenset([pylibmc.Error])
     supports_pipelines = True
+    supported_pipeline_options = frozenset(['noreply'])
+    commands = MEMCACHE_COMMANDS
 
     def __init__(self, num, host='localhost', port=11211, binary=True,
             behaviors=None, **options):
@@ -41,14 +84,126 @@ class Memcache(BaseConnection):
     def disconnect(self):
         self.connection.disconnect_all()
 
-    def get_pipeline(self, *args, **kwargs):
-        return MemcachePipeline(self)
+    def warmup(self, ping=False):
+        # the client only connects once a command is sent
+        self.connection.get_stats()
+
+    @contextmanager
+    def noreply(self):
+        """
+        Writes made within the block do not wait for a reply from the server.
+
+        They are sent over the same client (and sockets) as every other
+        command, so are always ordered with any reads which follow them. The
+        behaviour is set on that client until the block exits, so the
+        connection must not be used by anything else (such as another
+        thread) meanwhile. Blocks may be nested.
+        """
+        client = self.connection
+        previous = bool(client.get_behaviors().get('_noreply'))
+        client.set_behaviors({'_noreply': True})
+        try:
+            yield client
+        finally:
+            client.set_behaviors({'_noreply': previous})
+
+    def get_pipeline(self, noreply=False):
+        return MemcachePipeline(self, noreply=noreply)
+
+    @classmethod
+    def get_cluster(cls):
+        return MemcacheCluster
+
+
+class MemcacheServers(Memcache):
+    """
+    A single connection to several Memcache servers, across which
+    libmemcached distributes keys itself (using weighted ketama unless other
+    ``behaviors`` are given).
+
+    Each of ``servers`` is a dictionary with a ``host``, ``port`` and
+    ``weight`` (any positive number).
+    """
+    default_behaviors = {'ketama_weighted': True}
+
+    def __init__(self, num, servers=(), binary=True, behaviors=None, **options):
+        self.servers = [dict(server) for server in servers]
+        for server in self.servers:
+            server['weight'] = get_weight(server)
+        super(MemcacheServers, self).__init__(num, binary=binary, behaviors=dict(
+            self.default_behaviors, **(behaviors or {})))
+
+    @property
+    def identifier(self):
+        return "memcache://%s/" % ','.join(
+            '%s:%s' % (server.get('host', 'localhost'), server.get('port', 11211))
+            for server in self.servers)
+
+    def connect(self):
+        weights = scale_weights([server['weight'] for server in self.servers])
+        servers = ['%s:%s:%d' % (server.get('host', 'localhost'), server.get('port', 11211), weight)
+                   for server, weight in izip(self.servers, weights)]
+        return pylibmc.Client(servers, binary=self.binary, behaviors=self.behaviors)
+
+
+class MemcacheCluster(BaseCluster):
+    """
+    A cluster of Memcache servers.
+
+    With ``native`` enabled, the servers are not routed to by nydus, but are
+    all handed to a single pylibmc client (see ``MemcacheServers``). Commands
+    spanning many servers, such as ``get_multi``, are then a single call which
+    talks to every server at once, rather than being split up and executed
+    within a pool of threads.
+
+    Keys are placed as ``ConsistentHashingRouter`` places them with the
+    ``libmemcached_compat`` option, so either can be used against the same
+    servers. Native clusters ignore the ``router`` and cannot add or remove
+    hosts at runtime.
+    """
+    def __init__(self, hosts, backend, native=False, defaults=None, **kwargs):
+        self.native = native
+        if native:
+            defaults = dict(defaults or {})
+            servers = [apply_defaults(dict(settings), defaults)
+                       for num, settings in sorted(iter_hosts(hosts))]
+            hosts = {0: dict(defaults, servers=servers)}
+            backend = MemcacheServers
+            defaults = None
+            kwargs['router'] = BaseRouter
+        super(MemcacheCluster, self).__init__(hosts=hosts, backend=backend, defaults=defaults, **kwargs)
+
+    def add_host(self, num, settings):
+        if self.native:
+            raise ValueError('Hosts cannot be added to a native cluster')
+        return super(MemcacheCluster, self).add_host(num, settings)
+
+    def remove_host(self, num):
+        if self.native:
+            raise ValueError('Hosts cannot be removed from a native cluster')
+        return super(MemcacheCluster, self).remove_host(num)
 
 
 class MemcachePipeline(BasePipeline):
+    """
+    With ``noreply``, sets and deletes (including those grouped into
+    ``set_multi`` and ``delete_multi``) are sent without waiting for the
+    server to reply, which the binary protocol does with its quiet commands.
+    Their results are ``None``. A failure to send them is still raised when
+    the pipeline is executed, but errors reported by the server are not.
+    """
+    noreply_commands = frozenset(['set', 'set_multi', 'delete', 'delete_multi'])
+
+    def __init__(self, connection, noreply=False):
+        self.noreply = noreply
+        super(MemcachePipeline, self).__init__(connection)
+
     def execute(self):
         grouped = regroup_commands(self.pending)
-        results = resolve_grouped_commands(grouped, self.connection)
+        if self.noreply:
+            results = resolve_grouped_commands(grouped, self.connection, self.noreply_commands)
+        else:
+            results = resolve_grouped_commands(grouped, self.connection)
         return results
 
 
@@ -182,10 +337,17 @@ def regroup_commands(commands):
     return grouped
 
 
-def resolve_grouped_commands(grouped, connection):
+def resolve_grouped_commands(grouped, connection, noreply_commands=()):
     results = {}
 
     for master_command, grouped_commands in grouped:
+        if master_command.get_name() in noreply_commands:
+            with connection.noreply() as client:
+                master_command.resolve(client)
+            for command in grouped_commands:
+                results[command] = None
+            continue
+
         result = master_command.resolve(connection)
 
         # this command was not grouped
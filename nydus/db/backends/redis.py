@@ -8,47 +8,499 @@ nydus.db.backends.redis
 
 from __future__ import absolute_import
 
+import hashlib
+import os
+import random
+import threading
+import time
+
 from itertools import izip
 from redis import Redis as RedisClient, StrictRedis
 from redis import ConnectionError, InvalidResponse
+from redis.exceptions import NoScriptError
 
 from nydus.db.backends import BaseConnection, BasePipeline
+from nydus.db.base import BaseCluster
+from nydus.db.commands import Command, CommandTable, KEYS, KEY_LIST, KEY_MAPPING, SCRIPT
+from nydus.db.promise import EventualCommand
+from nydus.utils import iter_parallel
+
+
+# Commands which do not take a single key as their first argument, which only
+# read data, or which add to or replace a key. Signatures are those of
+# ``StrictRedis``.
+REDIS_COMMANDS = CommandTable([Command(name, read=True) for name in (
+    'bitcount', 'dump', 'get', 'getbit', 'getrange', 'hexists', 'hget',
+    'hgetall', 'hkeys', 'hlen', 'hmget', 'hscan', 'hvals', 'lindex', 'llen',
+    'lrange', 'pttl', 'scard', 'sismember', 'smembers', 'srandmember', 'sscan',
+    'strlen', 'ttl', 'type', 'zcard', 'zcount', 'zlexcount', 'zrange',
+    'zrangebylex', 'zrangebyscore', 'zrank', 'zrevrange', 'zrevrangebyscore',
+    'zrevrank', 'zscan', 'zscore',
+)] + [Command(name, keys=None, read=True) for name in (
+    'dbsize', 'keys', 'randomkey', 'scan',
+)] + [Command(name, keys=None) for name in (
+    'bgrewriteaof', 'bgsave', 'config_get', 'config_set', 'flushall', 'flushdb',
+    'info', 'lastsave', 'ping', 'save', 'script_exists', 'script_flush',
+    'script_kill', 'script_load', 'time',
+)] + [
+    Command('mget', keys=KEY_LIST, read=True, merge='list'),
+    Command('delete', keys=KEYS, merge='sum', replaces=(1, 0)),
+    # several keys need a client which accepts them (redis-py 3.0 or later),
+    # and return how many exist
+    Command('exists', keys=KEYS, read=True, merge='sum'),
+    Command('mset', keys=KEY_MAPPING, merge='all'),
+    # msetnx is atomic, so all of its keys must live on the same node
+    Command('msetnx', keys=KEY_MAPPING),
+    Command('sdiff', keys=KEY_LIST, read=True),
+    Command('sinter', keys=KEY_LIST, read=True),
+    Command('sunion', keys=KEY_LIST, read=True),
+    Command('pfcount', keys=KEYS, read=True),
+    Command('blpop', keys=KEY_LIST),
+    Command('brpop', keys=KEY_LIST),
+    Command('watch', keys=KEYS),
+    Command('eval', keys=SCRIPT),
+    Command('evalsha', keys=SCRIPT),
+    Command('incr', counter='incrby'),
+    Command('incrby', counter='incrby'),
+    Command('decr', counter='incrby', sign=-1),
+    Command('set', replaces=True, unless={'nx': 4, 'xx': 5}),
+    Command('setex', replaces=True),
+])
 
 
 class RedisPipeline(BasePipeline):
-    def __init__(self, connection):
+    """
+    Pipelines are not wrapped in MULTI/EXEC unless ``transaction`` is set, as
+    that blocks every other client of the server while the batch runs.
+    """
+    def __init__(self, connection, transaction=False):
         self.pending = []
         self.connection = connection
-        self.pipe = connection.pipeline()
+        self.transaction = transaction
+        self.pipe = connection.pipeline(transaction=transaction)
 
     def add(self, command):
         name, args, kwargs = command.get_command()
-        self.pending.append(command)
-        # ensure the command is executed in the pipeline
+        # ensure the command is executed in the pipeline (an unknown command
+        # will raise before anything is queued up)
         getattr(self.pipe, name)(*args, **kwargs)
+        self.pending.append(command)
 
     def execute(self):
-        return dict(izip(self.pending, self.pipe.execute()))
+        return dict(izip(self.pending, self.execute_ordered()))
+
+    def execute_ordered(self, raise_on_error=True):
+        """
+        Executes the pipeline and returns a list of results in the order
+        commands were added.
+
+        Registered scripts are loaded before the pipeline is sent, and any
+        ``EVALSHA`` which still fails with ``NOSCRIPT`` (e.g. because the
+        server was restarted) is retried once its script has been reloaded.
+        """
+        for script in self.get_scripts():
+            self.connection.load_script(script)
+
+        results = self.pipe.execute(raise_on_error=False)
+
+        retry = [i for i, result in enumerate(results)
+                 if isinstance(result, NoScriptError) and self.get_script(self.pending[i])]
+        if retry:
+            self.connection.reset_scripts()
+            for script in self.get_scripts():
+                self.connection.load_script(script)
+
+            pipe = self.connection.pipeline(transaction=self.transaction)
+            for i in retry:
+                name, args, kwargs = self.pending[i].get_command()
+                getattr(pipe, name)(*args, **kwargs)
+            for i, result in izip(retry, pipe.execute(raise_on_error=False)):
+                results[i] = result
+
+        if raise_on_error:
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        return results
+
+    def get_script(self, command):
+        if command.get_name() != 'evalsha':
+            return None
+        return self.connection.scripts.get(command.get_args()[0])
+
+    def get_scripts(self):
+        scripts = (self.get_script(command) for command in self.pending)
+        return set(script for script in scripts if script is not None)
+
+
+class AutoPipelineBatch(object):
+    """
+    A set of commands which will be sent to a single node within one
+    ``RedisPipeline``.
+    """
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.results = None
+        self.full = threading.Event()
+        self.done = threading.Event()
+
+    def __len__(self):
+        return len(self.pipeline.pending)
+
+    def add(self, command):
+        """
+        Queues ``command`` and returns its position within the batch.
+        """
+        self.pipeline.add(command)
+        return len(self.pipeline.pending) - 1
+
+    def flush(self):
+        try:
+            # each caller receives its own result (or error), so a single
+            # failing command must not fail the rest of the batch
+            self.results = self.pipeline.execute_ordered(raise_on_error=False)
+        except Exception as e:
+            self.results = [e] * len(self)
+        finally:
+            self.done.set()
+
+    def get_result(self, index):
+        self.done.wait()
+        return self.results[index]
+
+
+class AutoPipeline(object):
+    """
+    Collects commands issued against a single connection -- usually from many
+    threads at once -- and sends them together within a single pipeline.
+
+    The first command to arrive in an empty batch elects its caller as the
+    one which flushes the batch. It waits up to ``window`` seconds (or until
+    ``max_commands`` have been queued), and then for any previous flush on
+    this node to finish, before executing the pipeline. Commands continue to
+    join the batch until it is actually sent, so a ``window`` of ``0`` still
+    batches everything issued while the node is busy.
+    """
+    def __init__(self, connection, window=0, max_commands=100):
+        self.connection = connection
+        self.window = window
+        self.max_commands = max_commands
+        self._batch = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def execute(self, name, args, kwargs):
+        command = EventualCommand(name, args, kwargs)
+
+        with self._lock:
+            batch = self._batch
+            is_leader = batch is None
+            if is_leader:
+                batch = AutoPipelineBatch(self.connection.get_pipeline())
+
+            index = batch.add(command)
+
+            if is_leader:
+                self._batch = batch
+            if len(batch) >= self.max_commands:
+                # close the batch so any new commands start the next one
+                self._batch = None
+                batch.full.set()
+
+        if is_leader:
+            if self.window:
+                batch.full.wait(self.window)
+            with self._flush_lock:
+                with self._lock:
+                    if self._batch is batch:
+                        self._batch = None
+                batch.flush()
+
+        result = batch.get_result(index)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+class RedisScript(object):
+    """
+    A Lua script registered with a ``RedisCluster``.
+
+    Scripts are loaded once per node and executed with ``EVALSHA``, which
+    transparently reloads the script if the node responds with ``NOSCRIPT``.
+    """
+    def __init__(self, cluster, name, lua):
+        self.cluster = cluster
+        self.name = name
+        self.lua = lua
+        self.sha = hashlib.sha1(lua).hexdigest()
+
+    def __call__(self, keys=(), args=(), client=None):
+        """
+        Runs the script on the node which owns ``keys[0]``.
+
+        To run the script within ``map()``, pass the mapped connection as
+        ``client``.
+        """
+        keys = list(keys)
+        if client is None:
+            client = self.cluster
+        return client.evalsha(self.sha, len(keys), *(keys + list(args)))
+
+
+class RedisCluster(BaseCluster):
+    """
+    A cluster of Redis connections.
+
+    With ``auto_pipeline`` enabled, commands issued outside of ``map()`` are
+    transparently batched per node (see ``AutoPipeline``), so that many
+    concurrent callers share round trips to the same server.
+    """
+    # Commands which either block the connection, do not return a plain
+    # value, or cannot be queued within a pipeline, along with methods of the
+    # client which are not commands at all.
+    unpipelined_commands = frozenset([
+        'blpop', 'brpop', 'brpoplpush', 'lock', 'monitor', 'pipeline',
+        'pubsub', 'scan_iter', 'hscan_iter', 'sscan_iter', 'zscan_iter',
+        'transaction', 'watch', 'unwatch', 'multi', 'register_script',
+        'execute_command', 'parse_response', 'set_response_callback',
+    ])
+
+    def __init__(self, auto_pipeline=False, auto_pipeline_window=0,
+                 auto_pipeline_size=100, **kwargs):
+        super(RedisCluster, self).__init__(**kwargs)
+        self.scripts = {}
+        self.auto_pipeline = auto_pipeline
+        self.auto_pipeline_window = auto_pipeline_window
+        self.auto_pipeline_size = auto_pipeline_size
+        self.reset_auto_pipelines()
+
+    def reset_auto_pipelines(self):
+        self._auto_pipelines = dict(
+            (num, AutoPipeline(conn, self.auto_pipeline_window, self.auto_pipeline_size))
+            for num, conn in self.hosts.iteritems()
+        )
+        # batches (and their locks) are never shared with a forked process
+        self._auto_pipelines_pid = os.getpid()
+
+    def postfork(self):
+        super(RedisCluster, self).postfork()
+        self.reset_auto_pipelines()
+
+    def add_host(self, num, settings):
+        conn = super(RedisCluster, self).add_host(num, settings)
+        for script in self.scripts.itervalues():
+            conn.scripts[script.sha] = script
+
+        auto_pipelines = dict(self._auto_pipelines)
+        auto_pipelines[num] = AutoPipeline(conn, self.auto_pipeline_window, self.auto_pipeline_size)
+        self._auto_pipelines = auto_pipelines
+        return conn
+
+    def remove_host(self, num):
+        auto_pipelines = dict(self._auto_pipelines)
+        auto_pipelines.pop(num, None)
+        self._auto_pipelines = auto_pipelines
+        return super(RedisCluster, self).remove_host(num)
+
+    def register_script(self, name, lua):
+        """
+        Registers a Lua script with every node in the cluster, and returns a
+        ``RedisScript`` which runs it on the node owning its first key.
+
+        >>> incr_max = redis.register_script('incr_max', INCR_MAX_LUA)
+        >>> incr_max(keys=['counter'], args=[100])
+        >>> with redis.map() as conn:
+        >>>     incr_max(keys=['counter'], args=[100], client=conn)
+        """
+        script = RedisScript(self, name, lua)
+        self.scripts[name] = script
+        for conn in self.hosts.itervalues():
+            conn.scripts[script.sha] = script
+        return script
+
+    def scan_iter(self, match=None, count=None):
+        """
+        Iterates over the keys of every node in the cluster.
+
+        SCAN cursors are driven on all nodes in parallel, and keys are yielded
+        as each node's batch arrives. Only a single batch per node is held in
+        memory at any time.
+
+        >>> for key in redis.scan_iter(match='session:*', count=1000):
+        >>>     print key
+        """
+        nodes = [self._scan_node(conn, match, count) for conn in self.hosts.itervalues()]
+        for keys in iter_parallel(nodes):
+            for key in keys:
+                yield key
+
+    def _scan_node(self, conn, match, count):
+        cursor = 0
+        while True:
+            cursor, keys = conn.scan(cursor, match=match, count=count)
+            if keys:
+                yield keys
+            if not int(cursor):
+                break
+
+    def _get_scan_conn(self, attr, key):
+        # the key may route to several nodes (every node with BaseRouter, or
+        # each replica of a hot key), any of which holds all of it
+        return self[self.router.get_dbs(attr=attr, args=(key,), kwargs={})[0]]
+
+    def hscan_iter(self, key, match=None, count=None):
+        """
+        Iterates over the ``(field, value)`` pairs of the hash at ``key``.
+        """
+        return self._get_scan_conn('hscan', key).hscan_iter(key, match=match, count=count)
+
+    def sscan_iter(self, key, match=None, count=None):
+        """
+        Iterates over the members of the set at ``key``.
+        """
+        return self._get_scan_conn('sscan', key).sscan_iter(key, match=match, count=count)
+
+    def zscan_iter(self, key, match=None, count=None, score_cast_func=float):
+        """
+        Iterates over the ``(member, score)`` pairs of the sorted set at ``key``.
+        """
+        conn = self._get_scan_conn('zscan', key)
+        return conn.zscan_iter(key, match=match, count=count, score_cast_func=score_cast_func)
+
+    def get_command(self, conn, path):
+        if not self.auto_pipeline or '.' in path or path in self.unpipelined_commands:
+            return super(RedisCluster, self).get_command(conn, path)
+
+        # reads served by replicas are not pipelined on the primary
+        if conn.replicas and path in conn.replica_commands:
+            return super(RedisCluster, self).get_command(conn, path)
+
+        if self._auto_pipelines_pid != os.getpid():
+            self.reset_auto_pipelines()
+        auto_pipeline = self._auto_pipelines.get(conn.num)
+        if auto_pipeline is None:
+            # the host is being added to (or was removed from) the cluster
+            return super(RedisCluster, self).get_command(conn, path)
+
+        def execute(*args, **kwargs):
+            return auto_pipeline.execute(path, args, kwargs)
+        return execute
 
 
 class Redis(BaseConnection):
+    """
+    A connection to a Redis server, optionally backed by replicas.
+
+    Each entry of ``replicas`` is a dictionary of connection options (which
+    default to those of the primary) and an optional ``weight``. Read only
+    commands (see ``replica_commands``) are sent to a replica chosen at
+    random by weight for every call, falling back to the primary if the replica fails.
+    Replicas which fail are skipped for ``replica_retry_timeout`` seconds.
+
+    With ``max_replica_lag`` set, replicas which have not heard from their
+    primary for more than ``max_replica_lag`` seconds (or have lost their
+    link to it) are skipped, which is checked at most every
+    ``replica_check_interval`` seconds.
+
+    Pipelines are always executed on the primary.
+    """
     # Exceptions that can be retried by this backend
     retryable_exceptions = frozenset([ConnectionError, InvalidResponse])
     supports_pipelines = True
+    supported_pipeline_options = frozenset(['transaction'])
+
+    commands = REDIS_COMMANDS
+
+    # Commands which may be served by a replica (cursors of the SCAN family
+    # are only valid on the server which returned them, so always use the
+    # primary)
+    replica_commands = REDIS_COMMANDS.get_read_commands() - frozenset(['scan', 'hscan', 'sscan', 'zscan'])
+
+    replicas = ()
 
     def __init__(self, num, host='localhost', port=6379, db=0, timeout=None,
                  password=None, unix_socket_path=None, identifier=None,
-                 strict=True):
+                 strict=True, replicas=None, max_replica_lag=None,
+                 replica_check_interval=1, replica_retry_timeout=30):
         self.host = host
         self.port = port
         self.db = db
         self.unix_socket_path = unix_socket_path
         self.timeout = timeout
         self.strict = strict
+        self.scripts = {}
+        self.__loaded_scripts = set()
         self.__identifier = identifier
         self.__password = password
+        self.max_replica_lag = max_replica_lag
+        self.replica_check_interval = replica_check_interval
+        self.replica_retry_timeout = replica_retry_timeout
+        if replicas:
+            self.replicas = [
+                RedisReplica(num, **dict({
+                    'port': port,
+                    'db': db,
+                    'timeout': timeout,
+                    'password': password,
+                    'strict': strict,
+                }, **replica))
+                for replica in replicas
+            ]
         super(Redis, self).__init__(num)
 
+    def __getattr__(self, name):
+        if self.replicas and name in self.replica_commands:
+            return self.__get_replica_command(name)
+        return super(Redis, self).__getattr__(name)
+
+    def __get_replica_command(self, name):
+        def execute(*args, **kwargs):
+            replica = self.get_replica()
+            if replica is not None:
+                try:
+                    return getattr(replica.connection, name)(*args, **kwargs)
+                except tuple(self.retryable_exceptions):
+                    self.mark_replica_down(replica)
+            return getattr(self.connection, name)(*args, **kwargs)
+        return execute
+
+    def get_replica(self):
+        """
+        Returns a replica, chosen at random by weight, which is able to serve
+        reads, or ``None`` if there is none.
+        """
+        now = time.time()
+        available = []
+        for replica in self.replicas:
+            if replica.down_until > now:
+                continue
+
+            if self.max_replica_lag is not None and now - replica.checked_at >= self.replica_check_interval:
+                replica.checked_at = now
+                try:
+                    lag = replica.get_lag()
+                except tuple(self.retryable_exceptions):
+                    self.mark_replica_down(replica)
+                    continue
+                replica.lagging = lag is None or lag > self.max_replica_lag
+
+            if not replica.lagging:
+                available.append(replica)
+
+        if not available:
+            return None
+
+        point = random.uniform(0, sum(r.weight for r in available))
+        for replica in available:
+            point -= replica.weight
+            if point <= 0:
+                break
+        return replica
+
+    def mark_replica_down(self, replica):
+        replica.down_until = time.time() + self.replica_retry_timeout
+
     @property
     def identifier(self):
         if self.__identifier is not None:
@@ -69,6 +521,89 @@ class Redis(BaseConnection):
 
     def disconnect(self):
         self.connection.disconnect()
+        for replica in self.replicas:
+            replica.close()
+
+    def warmup(self, ping=False):
+        client = self.connection
+        if ping:
+            client.ping()
+        else:
+            # clients only connect once a command is sent, so open a socket
+            # within the pool ourselves
+            pool = client.connection_pool
+            conn = pool.get_connection('PING')
+            try:
+                conn.connect()
+            finally:
+                pool.release(conn)
+        for replica in self.replicas:
+            replica.warmup(ping=ping)
+
+    def close(self):
+        super(Redis, self).close()
+        for replica in self.replicas:
+            replica.close()
+
+    def reset(self):
+        super(Redis, self).reset()
+        for replica in self.replicas:
+            replica.reset()
+
+    def load_script(self, script):
+        """
+        Loads ``script`` onto the server, unless it has already been loaded.
+        """
+        if script.sha not in self.__loaded_scripts:
+            self.connection.script_load(script.lua)
+            self.__loaded_scripts.add(script.sha)
+
+    def reset_scripts(self):
+        """
+        Forgets which scripts have been loaded, e.g. after a ``NOSCRIPT``.
+        """
+        self.__loaded_scripts.clear()
+
+    def evalsha(self, sha, numkeys, *keys_and_args):
+        script = self.scripts.get(sha)
+        if script is None:
+            return self.connection.evalsha(sha, numkeys, *keys_and_args)
+
+        self.load_script(script)
+        try:
+            return self.connection.evalsha(sha, numkeys, *keys_and_args)
+        except NoScriptError:
+            self.reset_scripts()
+            self.load_script(script)
+            return self.connection.evalsha(sha, numkeys, *keys_and_args)
 
     def get_pipeline(self, *args, **kwargs):
-        return RedisPipeline(self)
+        return RedisPipeline(self, *args, **kwargs)
+
+    @classmethod
+    def get_cluster(cls):
+        return RedisCluster
+
+
+class RedisReplica(Redis):
+    """
+    A replica of a ``Redis`` connection.
+    """
+    def __init__(self, num, weight=1, **options):
+        self.weight = weight
+        # time until which the replica is considered down
+        self.down_until = 0
+        # time the replica's lag was last checked
+        self.checked_at = 0
+        self.lagging = False
+        super(RedisReplica, self).__init__(num, **options)
+
+    def get_lag(self):
+        """
+        Returns the number of seconds since the replica last heard from its
+        primary, or ``None`` if it is not connected to its primary.
+        """
+        info = self.connection.info('replication')
+        if info.get('master_link_status') != 'up':
+            return None
+        return info.get('master_last_io_seconds_ago', 0)
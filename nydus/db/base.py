@@ -9,9 +9,49 @@ nydus.db.base
 __all__ = ('LazyConnectionHandler', 'BaseCluster')
 
 import collections
-from nydus.db.map import DistributedContextManager
+import copy
+import threading
+import time
+from Queue import Queue, Empty
+from nydus.db.codecs import create_codec
+from nydus.db.commands import CommandTable
+from nydus.db.exceptions import WarmupError
+from nydus.db.map import DistributedContextManager, imap
 from nydus.db.routers import BaseRouter, routing_params
-from nydus.utils import apply_defaults
+from nydus.db.routers.hotkeys import create_sampler
+from nydus.utils import ThreadPool, apply_defaults
+
+
+# settings which may be instances (such as a ``Codec``), and are shared with
+# the cluster rather than copied
+SHARED_SETTINGS = ('codec', 'hot_keys')
+
+
+def copy_settings(settings):
+    """
+    Returns a deep copy of cluster ``settings``, leaving any shared settings
+    (see ``SHARED_SETTINGS``) as they are.
+    """
+    settings = dict(settings)
+    shared = dict((name, settings.pop(name)) for name in SHARED_SETTINGS if name in settings)
+    settings = copy.deepcopy(settings)
+    settings.update(shared)
+    return settings
+
+
+def same_settings(settings, other):
+    """
+    Returns whether two sets of cluster settings are the same. Shared settings
+    are compared by identity unless they are plain values (such as ``'json'``).
+    """
+    settings, other = dict(settings), dict(other)
+    for name in SHARED_SETTINGS:
+        value, other_value = settings.pop(name, None), other.pop(name, None)
+        if value is other_value:
+            continue
+        if not isinstance(value, (basestring, int, long, float)) or value != other_value:
+            return False
+    return settings == other
 
 
 def iter_hosts(hosts):
@@ -27,7 +67,13 @@ def create_connection(Connection, num, host_settings, defaults):
     # of connection (some connections share options and simply just need to
     # pass a single host, or a list of hosts)
     if isinstance(host_settings, collections.Mapping):
-        return Connection(num, **apply_defaults(host_settings, defaults or {}))
+        host_settings = apply_defaults(dict(host_settings), defaults or {})
+        # the weight of a host is used by routers, not by its connection
+        weight = host_settings.pop('weight', None)
+        conn = Connection(num, **host_settings)
+        if weight is not None:
+            conn.weight = weight
+        return conn
     elif isinstance(host_settings, collections.Iterable):
         return Connection(num, *host_settings, **defaults or {})
     return Connection(num, host_settings, **defaults or {})
@@ -40,13 +86,22 @@ class BaseCluster(object):
     class MaxRetriesExceededError(Exception):
         pass
 
-    def __init__(self, hosts, backend, router=BaseRouter, max_connection_retries=20, defaults=None):
+    def __init__(self, hosts, backend, router=BaseRouter, max_connection_retries=20, defaults=None,
+                 codec=None, hot_keys=None, router_options=None):
         self.hosts = dict(
             (conn_number, create_connection(backend, conn_number, host_settings, defaults))
             for conn_number, host_settings
             in iter_hosts(hosts)
         )
+        self.backend = backend
+        self.defaults = defaults
         self.max_connection_retries = max_connection_retries
+        self.commands = getattr(backend, 'commands', None)
+        if not isinstance(self.commands, CommandTable):
+            self.commands = CommandTable()
+        self.codec = create_codec(codec)
+        self.hot_keys = create_sampler(hot_keys)
+        self.router_options = router_options or {}
         self.install_router(router)
 
     def __len__(self):
@@ -62,29 +117,70 @@ class BaseCluster(object):
         for name in self.hosts.iterkeys():
             yield name
 
+    @property
+    def raw(self):
+        """
+        Executes commands without the codec, accepting buffer objects (such as
+        ``memoryview``) as values and returning values as ``memoryview``
+        objects over the replies, so large values are never copied.
+
+        >>> view = redis.raw.get('foo')
+        >>> redis.raw.set('bar', view[16:])
+        """
+        return RawCallProxy(self)
+
+    def add_host(self, num, settings):
+        """
+        Adds a host to the cluster as ``num``, with the same backend and
+        defaults as every other host, and returns its connection.
+
+        The router only moves the keys which now belong to the new host (for
+        routers which support that, such as ``ConsistentHashingRouter``).
+        """
+        if num in self.hosts:
+            raise ValueError('Host %r already exists' % (num,))
+        conn = create_connection(self.backend, num, settings, self.defaults)
+        # the mapping is replaced rather than changed, so that requests in
+        # progress keep the hosts they started with
+        hosts = dict(self.hosts)
+        hosts[num] = conn
+        self.hosts = hosts
+        self.router.add_host(num, conn)
+        return conn
+
+    def remove_host(self, num):
+        """
+        Removes the host ``num`` from the cluster, and returns its connection.
+
+        The connection is left open for requests already using it; close it
+        once they have finished.
+        """
+        hosts = dict(self.hosts)
+        conn = hosts.pop(num)
+        self.hosts = hosts
+        self.router.remove_host(num, conn)
+        return conn
+
     def install_router(self, router):
-        self.router = router(self)
+        self.router = router(self, **self.router_options)
+        self.router.sampler = self.hot_keys
+
+    def execute(self, path, args, kwargs, raw=False):
+        if self.codec is not None and not raw:
+            args, kwargs = self.codec.encode_command(path, args, kwargs)
+
+        # commands taking keys which live on several databases (such as
+        # mget) are split up, executed in parallel, and merged
+        if '.' not in path:
+            parts = self.router.split_command(path, args, kwargs)
+            if parts is not None:
+                return self.__execute_split(path, args, kwargs, parts, raw)
 
-    def execute(self, path, args, kwargs):
         connections = self.__connections_for(path, args=args, kwargs=kwargs)
 
         results = []
         for conn in connections:
-            for retry in xrange(self.max_connection_retries):
-                func = conn
-                for piece in path.split('.'):
-                    func = getattr(func, piece)
-                try:
-                    results.append(func(*args, **kwargs))
-                except tuple(conn.retryable_exceptions), e:
-                    if not self.router.retryable:
-                        raise e
-                    elif retry == self.max_connection_retries - 1:
-                        raise self.MaxRetriesExceededError(e)
-                    else:
-                        conn = self.__connections_for(path, retry_for=conn.num, args=args, kwargs=kwargs)[0]
-                else:
-                    break
+            results.append(self.__execute_on(conn, path, args, kwargs, raw))
 
         # If we only had one db to query, we simply return that res
         if len(results) == 1:
@@ -92,11 +188,133 @@ class BaseCluster(object):
         else:
             return results
 
+    def __execute_on(self, conn, path, args, kwargs, raw=False):
+        for retry in xrange(self.max_connection_retries):
+            func = self.get_command(conn, path)
+            try:
+                if raw:
+                    result = conn.to_buffers(func(*conn.from_buffers(args),
+                                                  **conn.from_buffers(kwargs)))
+                else:
+                    result = func(*args, **kwargs)
+                if self.codec is not None and not raw:
+                    result = self.codec.decode_result(path, result)
+                return result
+            except tuple(conn.retryable_exceptions), e:
+                if not self.router.retryable:
+                    raise e
+                elif retry == self.max_connection_retries - 1:
+                    raise self.MaxRetriesExceededError(e)
+                else:
+                    conn = self.__connections_for(path, retry_for=conn.num, args=args, kwargs=kwargs)[0]
+
+    def __execute_split(self, path, args, kwargs, parts, raw=False):
+        pool = ThreadPool(min(len(parts), 16))
+        for index, (db_num, part_args, part_kwargs, keys) in enumerate(parts):
+            pool.add(index, self.__execute_on, (self[db_num], path, part_args, part_kwargs, raw))
+        results = pool.join()
+
+        merge_parts = []
+        for index, (db_num, part_args, part_kwargs, keys) in enumerate(parts):
+            result = results[index][0]
+            if isinstance(result, Exception):
+                raise result
+            merge_parts.append((keys, result))
+
+        command = self.commands[path]
+        return command.merge(command.get_keys(args, kwargs), merge_parts)
+
+    def get_command(self, conn, path):
+        """
+        Returns the callable which executes ``path`` (e.g. ``incr`` or
+        ``foo.bar``) against ``conn``.
+        """
+        func = conn
+        for piece in path.split('.'):
+            func = getattr(func, piece)
+        return func
+
     def disconnect(self):
         """Disconnects all connections in cluster"""
         for connection in self.hosts.itervalues():
             connection.disconnect()
 
+    def warmup(self, parallel=True, timeout=None, ping=False):
+        """
+        Opens the connection of every host ahead of the first command, and
+        returns the number of seconds each took, by host number.
+
+        Hosts are connected to concurrently unless ``parallel`` is ``False``.
+        With ``ping``, a round trip is made to every host as well.
+
+        Raises ``WarmupError`` as soon as any host fails, or once ``timeout``
+        seconds have passed without every host being connected.
+        """
+        def connect(conn):
+            start = time.time()
+            conn.warmup(ping=ping)
+            return time.time() - start
+
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        results = {}
+        if not parallel:
+            for num, conn in self.hosts.iteritems():
+                try:
+                    results[num] = connect(conn)
+                except Exception as e:
+                    raise WarmupError(num, e)
+                if timeout is not None and time.time() > deadline:
+                    raise WarmupError(num, 'timed out after %ss' % (timeout,))
+            return results
+
+        queue = Queue()
+
+        def run(num, conn):
+            try:
+                queue.put((num, True, connect(conn)))
+            except Exception as e:
+                queue.put((num, False, e))
+
+        for num, conn in self.hosts.iteritems():
+            thread = threading.Thread(target=run, args=(num, conn))
+            thread.daemon = True
+            thread.start()
+
+        while len(results) < len(self.hosts):
+            remaining = None
+            if timeout is not None:
+                remaining = max(deadline - time.time(), 0)
+            try:
+                num, success, value = queue.get(timeout=remaining)
+            except Empty:
+                pending = sorted(set(self.hosts) - set(results))
+                raise WarmupError(pending[0], 'timed out after %ss' % (timeout,))
+            if not success:
+                raise WarmupError(num, value)
+            results[num] = value
+        return results
+
+    def prefork(self):
+        """
+        Closes any open connections, so that processes forked from this one
+        do not inherit them.
+        """
+        for connection in self.hosts.itervalues():
+            connection.close()
+
+    def postfork(self):
+        """
+        Forgets (without closing) any connections inherited by a forked
+        process, which will open its own when they are next used.
+
+        Connections also reset themselves when first used after a fork; this
+        resets any other state of the cluster as well.
+        """
+        for connection in self.hosts.itervalues():
+            connection.reset()
+
     def get_conn(self, *args, **kwargs):
         """
         Returns a connection object from the router given ``args``.
@@ -115,6 +333,17 @@ class BaseCluster(object):
     def map(self, workers=None, **kwargs):
         return DistributedContextManager(self, workers, **kwargs)
 
+    def imap(self, commands, chunk_size=1000, workers=None, **kwargs):
+        """
+        Executes an iterable of ``(name, args[, kwargs])`` commands in
+        pipelined chunks, and returns a generator of their results.
+
+        >>> keys = ('foo:%d' % n for n in xrange(500000))
+        >>> for value in redis.imap(('get', (k,)) for k in keys):
+        >>>     print value
+        """
+        return imap(self, commands, chunk_size, workers, **kwargs)
+
     @routing_params
     def __connections_for(self, attr, args, kwargs, **fkwargs):
         return [self[n] for n in self.router.get_dbs(attr=attr, args=args, kwargs=kwargs, **fkwargs)]
@@ -124,42 +353,119 @@ class CallProxy(object):
     """
     Handles routing function calls to the proper connection.
     """
-    def __init__(self, cluster, path):
+    def __init__(self, cluster, path, raw=False):
         self.__cluster = cluster
         self.__path = path
+        self.__raw = raw
 
     def __call__(self, *args, **kwargs):
-        return self.__cluster.execute(self.__path, args, kwargs)
+        return self.__cluster.execute(self.__path, args, kwargs, raw=self.__raw)
+
+    def __getattr__(self, name):
+        return CallProxy(self.__cluster, self.__path + '.' + name, self.__raw)
+
+
+class RawCallProxy(object):
+    """
+    Handles routing function calls to the proper connection, exchanging values
+    as buffers.
+    """
+    def __init__(self, cluster):
+        self.__cluster = cluster
 
     def __getattr__(self, name):
-        return CallProxy(self.__cluster, self.__path + '.' + name)
+        return CallProxy(self.__cluster, name, raw=True)
 
 
 class LazyConnectionHandler(dict):
     """
     Maps clusters of connections within a dictionary.
+
+    Clusters are built from ``conf_callback()`` the first time any of them is
+    accessed, and are then kept until ``reload`` is called.
     """
     def __init__(self, conf_callback):
         self.conf_callback = conf_callback
         self.conf_settings = {}
         self.__is_ready = False
+        self.__lock = threading.Lock()
 
     def __getitem__(self, key):
-        if not self.is_ready():
-            self.reload()
+        if not self.__is_ready:
+            with self.__lock:
+                # another thread may have built the clusters while we waited
+                if not self.__is_ready:
+                    self._reload()
         return super(LazyConnectionHandler, self).__getitem__(key)
 
     def is_ready(self):
         return self.__is_ready
 
     def reload(self):
+        """
+        Applies the current result of ``conf_callback()``.
+
+        Only clusters whose settings have changed (or which are new) are
+        rebuilt; every other cluster, and its open connections, is kept.
+        Clusters which were replaced or removed are disconnected.
+
+        Returns the list of aliases which were rebuilt or removed.
+        """
+        with self.__lock:
+            return self._reload()
+
+    def _reload(self):
         from nydus.db import create_cluster
 
-        for conn_alias, conn_settings in self.conf_callback().iteritems():
-            self[conn_alias] = create_cluster(conn_settings)
-        self._is_ready = True
+        conf = dict(self.conf_callback())
+        changed = []
+        stale = []
+
+        for conn_alias in self.keys():
+            if conn_alias not in conf:
+                stale.append(self.pop(conn_alias))
+                del self.conf_settings[conn_alias]
+                changed.append(conn_alias)
+
+        for conn_alias, conn_settings in conf.iteritems():
+            if conn_alias in self and same_settings(self.conf_settings[conn_alias], conn_settings):
+                continue
+            cluster = create_cluster(conn_settings)
+            if conn_alias in self:
+                stale.append(dict.__getitem__(self, conn_alias))
+            self[conn_alias] = cluster
+            self.conf_settings[conn_alias] = copy_settings(conn_settings)
+            changed.append(conn_alias)
+
+        self.__is_ready = True
+
+        for cluster in stale:
+            cluster.disconnect()
+
+        return changed
 
     def disconnect(self):
         """Disconnects all connections in cluster"""
         for connection in self.itervalues():
             connection.disconnect()
+
+    def prefork(self):
+        """
+        Closes the connections of every cluster before forking worker
+        processes (e.g. in the master of a pre-forking server).
+        """
+        for cluster in self.itervalues():
+            cluster.prefork()
+
+    def postfork(self, warmup=False):
+        """
+        Resets every cluster within a newly forked worker process, leaving the
+        sockets of the parent untouched. With ``warmup``, the connections of
+        the worker are opened right away (see ``BaseCluster.warmup``).
+        """
+        # the lock may have been held by a thread which does not exist here
+        self.__lock = threading.Lock()
+        for cluster in self.itervalues():
+            cluster.postfork()
+            if warmup:
+                cluster.warmup()
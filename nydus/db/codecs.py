@@ -0,0 +1,324 @@
+"""
+nydus.db.codecs
+~~~~~~~~~~~~~~~
+
+Transparent serialization and compression of values.
+
+>>> redis = create_cluster({
+>>>     'backend': 'nydus.db.backends.redis.Redis',
+>>>     'codec': {
+>>>         'serializer': 'json',
+>>>         'compressor': 'zlib',
+>>>         'compress_threshold': 1024,
+>>>     },
+>>>     'hosts': {
+>>>         0: {'db': 0},
+>>>     },
+>>> })
+>>> redis.set('foo', {'bar': 1})
+>>> redis.get('foo')
+{u'bar': 1}
+
+:copyright: (c) 2011-2012 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+__all__ = ('Codec', 'PickleSerializer', 'JSONSerializer', 'MsgpackSerializer',
+           'ZlibCompressor', 'LZ4Compressor', 'create_codec')
+
+import cPickle as pickle
+import json
+import threading
+import zlib
+
+from nydus.utils import import_string
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.block as lz4
+except ImportError:
+    try:
+        import lz4
+    except ImportError:
+        lz4 = None
+
+
+class PickleSerializer(object):
+    def dumps(self, value):
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class JSONSerializer(object):
+    def dumps(self, value):
+        return json.dumps(value, separators=(',', ':'))
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class MsgpackSerializer(object):
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError('msgpack is required to use MsgpackSerializer')
+
+    def dumps(self, value):
+        return msgpack.packb(value)
+
+    def loads(self, data):
+        return msgpack.unpackb(data)
+
+
+class ZlibCompressor(object):
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class LZ4Compressor(object):
+    def __init__(self):
+        if lz4 is None:
+            raise ImportError('lz4 is required to use LZ4Compressor')
+
+    def compress(self, data):
+        return lz4.compress(data)
+
+    def decompress(self, data):
+        return lz4.decompress(data)
+
+
+SERIALIZERS = {
+    'pickle': PickleSerializer,
+    'json': JSONSerializer,
+    'msgpack': MsgpackSerializer,
+}
+
+COMPRESSORS = {
+    'zlib': ZlibCompressor,
+    'lz4': LZ4Compressor,
+}
+
+
+class Codec(object):
+    """
+    Serializes values on their way to a cluster, compressing them when they
+    are larger than ``compress_threshold`` bytes, and reverses the process on
+    the way back.
+
+    Encoded values start with a single flag byte. Integers (so the server is
+    still able to increment them) and strings are stored as they are, unless
+    a string could be mistaken for an encoded value. Values which can't be
+    decoded (such as counters maintained by the server, or values written by
+    other clients) are passed through untouched.
+    """
+    # Flag bytes prefixed to encoded values
+    SERIALIZED = '\x00'
+    COMPRESSED = '\x01'
+
+    # command name: position of the value argument
+    value_arguments = {
+        'add': 1,
+        'getset': 1,
+        'psetex': 2,
+        'replace': 1,
+        'set': 1,
+        'setex': 2,
+        'setnx': 1,
+    }
+
+    # commands taking a mapping of keys to values as their first argument
+    mapping_arguments = frozenset(['mset', 'msetnx', 'set_multi', 'add_multi'])
+
+    # command name: shape of the result ('value', 'list' or 'mapping')
+    value_results = {
+        'get': 'value',
+        'getset': 'value',
+        'mget': 'list',
+        'get_multi': 'mapping',
+    }
+
+    def __init__(self, serializer=None, compressor=None, compress_threshold=1024):
+        self.serializer = serializer or PickleSerializer()
+        self.compressor = compressor
+        self.compress_threshold = compress_threshold
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self._stats = {
+            'encoded': 0,
+            'compressed': 0,
+            'decoded': 0,
+            'bytes_serialized': 0,
+            'bytes_stored': 0,
+        }
+
+    def get_stats(self):
+        """
+        Returns counters for the values encoded and decoded so far, including
+        the number of bytes saved by compression.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats['bytes_saved'] = stats['bytes_serialized'] - stats['bytes_stored']
+        return stats
+    stats = property(get_stats)
+
+    def is_raw(self, value):
+        """
+        Returns whether ``value`` is stored as it is, rather than encoded.
+        """
+        if isinstance(value, (int, long)):
+            return not isinstance(value, bool)
+        return isinstance(value, str) and value[:1] not in (self.SERIALIZED, self.COMPRESSED)
+
+    def encode(self, value):
+        return self.encode_many([value])[0]
+
+    def decode(self, data):
+        return self.decode_many([data])[0]
+
+    def encode_many(self, values):
+        results = []
+        encoded = serialized = stored = compressed = 0
+        for value in values:
+            if self.is_raw(value):
+                results.append(value)
+                continue
+
+            data = self.serializer.dumps(value)
+            serialized += len(data)
+            if self.compressor is not None and len(data) > self.compress_threshold:
+                data = self.COMPRESSED + self.compressor.compress(data)
+                compressed += 1
+            else:
+                data = self.SERIALIZED + data
+            stored += len(data) - 1
+            encoded += 1
+            results.append(data)
+
+        with self._lock:
+            self._stats['encoded'] += encoded
+            self._stats['compressed'] += compressed
+            self._stats['bytes_serialized'] += serialized
+            self._stats['bytes_stored'] += stored
+        return results
+
+    def decode_many(self, values):
+        results = []
+        decoded = 0
+        for data in values:
+            if not isinstance(data, basestring) or not data:
+                results.append(data)
+                continue
+
+            flag = data[0]
+            try:
+                if flag == self.SERIALIZED:
+                    value = self.serializer.loads(data[1:])
+                elif flag == self.COMPRESSED and self.compressor is not None:
+                    value = self.serializer.loads(self.compressor.decompress(data[1:]))
+                else:
+                    results.append(data)
+                    continue
+            except Exception:
+                # not a value we encoded, but one which happens to start with
+                # a flag byte
+                results.append(data)
+                continue
+            results.append(value)
+            decoded += 1
+
+        with self._lock:
+            self._stats['decoded'] += decoded
+        return results
+
+    def encode_command(self, name, args, kwargs):
+        """
+        Returns ``(args, kwargs)`` with any values encoded.
+        """
+        if name in self.mapping_arguments and args:
+            mapping = args[0]
+            keys = list(mapping)
+            args = (dict(zip(keys, self.encode_many(mapping[k] for k in keys))),) + tuple(args[1:])
+        elif name in self.value_arguments:
+            pos = self.value_arguments[name]
+            if len(args) > pos:
+                args = tuple(args[:pos]) + (self.encode(args[pos]),) + tuple(args[pos + 1:])
+            elif 'value' in kwargs:
+                kwargs = dict(kwargs, value=self.encode(kwargs['value']))
+        return args, kwargs
+
+    def decode_result(self, name, result):
+        """
+        Returns ``result`` with any values decoded.
+        """
+        shape = self.value_results.get(name)
+        if shape == 'value':
+            return self.decode(result)
+        elif shape == 'list' and isinstance(result, (list, tuple)):
+            return self.decode_many(result)
+        elif shape == 'mapping' and isinstance(result, dict):
+            keys = list(result)
+            return dict(zip(keys, self.decode_many(result[k] for k in keys)))
+        return result
+
+    def decode_results(self, commands):
+        """
+        Decodes the resolved values of an iterable of ``(name, result)``
+        pairs in a single pass, returning the decoded results in order.
+        """
+        commands = list(commands)
+        # values from every single value command are decoded together
+        single = [i for i, (name, _) in enumerate(commands) if self.value_results.get(name) == 'value']
+        decoded = dict(zip(single, self.decode_many(commands[i][1] for i in single)))
+
+        results = []
+        for i, (name, result) in enumerate(commands):
+            if i in decoded:
+                results.append(decoded[i])
+            else:
+                results.append(self.decode_result(name, result))
+        return results
+
+
+def _get_component(value, registry, options=None):
+    if value is None:
+        return None
+    if isinstance(value, basestring):
+        value = registry[value] if value in registry else import_string(value)
+    if isinstance(value, type):
+        value = value(**(options or {}))
+    return value
+
+
+def create_codec(settings):
+    """
+    Creates a ``Codec`` from the ``codec`` setting of a cluster.
+
+    ``settings`` is either a ``Codec`` instance, or a dictionary with the keys
+    ``serializer`` (``pickle``, ``json``, ``msgpack`` or a path to a class),
+    ``compressor`` (``zlib``, ``lz4`` or a path to a class),
+    ``compressor_options`` and ``compress_threshold``.
+    """
+    if settings is None or isinstance(settings, Codec):
+        return settings
+
+    settings = dict(settings)
+    return Codec(
+        serializer=_get_component(settings.pop('serializer', 'pickle'), SERIALIZERS),
+        compressor=_get_component(settings.pop('compressor', None), COMPRESSORS,
+                                  settings.pop('compressor_options', None)),
+        **settings
+    )
@@ -0,0 +1,234 @@
+"""
+nydus.db.commands
+~~~~~~~~~~~~~~~~~
+
+Describes the commands of a backend: where their keys are, whether they only
+read data, and how commands taking several keys are split across nodes.
+
+:copyright: (c) 2011-2012 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+__all__ = ('Command', 'CommandTable', 'KEY', 'KEYS', 'KEY_LIST', 'KEY_MAPPING', 'SCRIPT')
+
+from itertools import chain, izip
+
+# A single key, e.g. ``get(key)``
+KEY = 'key'
+# Every argument is a key, e.g. ``delete(*keys)``
+KEYS = 'keys'
+# A list of keys, optionally followed by more keys, e.g. ``mget(keys, *args)``
+KEY_LIST = 'list'
+# A mapping of keys to values, e.g. ``mset(mapping)``
+KEY_MAPPING = 'mapping'
+# A script followed by the number of keys and the keys, e.g.
+# ``evalsha(sha, numkeys, *keys_and_args)``
+SCRIPT = 'script'
+
+
+def merge_list(keys, parts):
+    values = {}
+    for part_keys, result in parts:
+        for key, value in izip(part_keys, result):
+            values.setdefault(key, value)
+    return [values.get(key) for key in keys]
+
+
+def merge_dict(keys, parts):
+    values = {}
+    for part_keys, result in parts:
+        values.update(result)
+    return values
+
+
+def merge_sum(keys, parts):
+    # parts only holding copies of replicated keys come last, and are skipped
+    total = 0
+    seen = set()
+    for part_keys, result in parts:
+        if not part_keys or not seen.issuperset(part_keys):
+            total += result
+        seen.update(part_keys)
+    return total
+
+
+MERGES = {
+    # a list of values, ordered as the keys were given
+    'list': merge_list,
+    # a mapping of keys to values
+    'dict': merge_dict,
+    # a total, such as the number of keys deleted
+    'sum': merge_sum,
+    # a flag, which is only true if it was on every node
+    'all': lambda keys, parts: all(result for part_keys, result in parts),
+    # a list, such as keys which could not be stored
+    'concat': lambda keys, parts: list(chain(*(result for part_keys, result in parts))),
+}
+
+
+class Command(object):
+    """
+    Describes a single command.
+
+    :param name: Name of the command.
+    :param keys: How keys are passed to the command (``KEY``, ``KEYS``,
+                 ``KEY_LIST``, ``KEY_MAPPING``, ``SCRIPT``), or ``None`` if
+                 the command does not take any keys.
+    :param position: Position of the (first) key within the arguments.
+    :param read: Whether the command only reads data.
+    :param merge: For commands taking several keys which may be split across
+                  nodes, how the results of each node are merged (``list``,
+                  ``dict``, ``sum``, ``all``, ``concat``, or a callable taking
+                  the keys and a list of ``(keys, result)`` pairs). Commands
+                  without ``merge`` are never split, and are routed on their
+                  first key.
+    :param counter: For commands adding an amount to the counter at their
+                    key, the name of the command which adds any amount, and
+                    which several calls on the same key may be merged into.
+    :param sign: ``-1`` for counter commands which subtract their amount.
+    :param amount: Name of the keyword argument for the amount of a counter
+                   command, which otherwise follows the key and defaults to 1.
+    :param replaces: For commands replacing whatever is stored at a single
+                     key (such as ``set`` or ``delete``), their result. Either
+                     a value, or a pair of the results when the key existed
+                     and when it did not.
+    :param unless: Arguments which make a replacing command conditional (such
+                   as ``nx``), mapped to their position.
+    """
+    def __init__(self, name, keys=KEY, position=0, read=False, merge=None,
+                 counter=None, sign=1, amount='amount', replaces=None, unless=None):
+        self.name = name
+        self.keys = keys
+        self.position = position
+        self.read = read
+        self.merge = MERGES.get(merge, merge)
+        self.counter = counter
+        self.sign = sign
+        self.amount = amount
+        self.replaces = replaces
+        self.unless = unless or {}
+
+    def __repr__(self):
+        return '<Command: %s>' % (self.name,)
+
+    @property
+    def splittable(self):
+        return self.merge is not None and self.keys in (KEYS, KEY_LIST, KEY_MAPPING)
+
+    def get_keys(self, args, kwargs):
+        """
+        Returns the list of keys the command was called with.
+        """
+        if 'key' in kwargs:
+            return [kwargs['key']]
+
+        pos = self.position
+        if self.keys is None or len(args) <= pos:
+            return []
+
+        if self.keys == KEY:
+            return [args[pos]]
+        elif self.keys == KEYS:
+            return list(args[pos:])
+        elif self.keys == KEY_LIST:
+            if isinstance(args[pos], basestring):
+                return list(args[pos:])
+            return list(args[pos]) + list(args[pos + 1:])
+        elif self.keys == KEY_MAPPING:
+            if isinstance(args[pos], dict):
+                return list(args[pos])
+            return []
+        elif self.keys == SCRIPT:
+            return list(args[pos + 2:pos + 2 + int(args[pos + 1])])
+        raise ValueError('Unknown key type: %r' % (self.keys,))
+
+    def get_key(self, args, kwargs):
+        """
+        Returns the first key the command was called with, or ``None``.
+        """
+        keys = self.get_keys(args, kwargs)
+        if keys:
+            return keys[0]
+        return None
+
+    def get_fallback_key(self, args, kwargs):
+        """
+        Returns what a command which takes keys, but was called without any
+        (such as a script run with no keys), is routed on, so that it runs on
+        a single node: its first argument if that is a string, or ``None``.
+        """
+        if self.keys is None or len(args) <= self.position:
+            return None
+        if isinstance(args[self.position], basestring):
+            return args[self.position]
+        return None
+
+    def get_amount(self, args, kwargs):
+        """
+        Returns the amount a counter command adds to its key, or ``None`` if
+        it was not called with only a key and an integer amount.
+        """
+        if self.counter is None:
+            return None
+
+        pos = self.position
+        if len(args) == pos + 1 and not kwargs:
+            amount = 1
+        elif len(args) == pos + 2 and not kwargs:
+            amount = args[pos + 1]
+        elif len(args) == pos + 1 and kwargs.keys() == [self.amount]:
+            amount = kwargs[self.amount]
+        else:
+            return None
+
+        if not isinstance(amount, (int, long)) or isinstance(amount, bool):
+            return None
+        return self.sign * amount
+
+    def get_replaced_key(self, args, kwargs):
+        """
+        Returns the key a replacing command was called with, or ``None`` if it
+        does not unconditionally replace a single key.
+        """
+        if self.replaces is None:
+            return None
+
+        for name, pos in self.unless.iteritems():
+            if kwargs.get(name) or (len(args) > pos and args[pos]):
+                return None
+
+        keys = self.get_keys(args, kwargs)
+        if len(keys) != 1:
+            return None
+        return keys[0]
+
+    def split(self, args, kwargs, keys):
+        """
+        Returns the arguments to call the command with for only ``keys``.
+        """
+        pos = self.position
+        if self.keys == KEYS:
+            return tuple(args[:pos]) + tuple(keys), kwargs
+        elif self.keys == KEY_LIST:
+            return tuple(args[:pos]) + (list(keys),), kwargs
+        elif self.keys == KEY_MAPPING:
+            mapping = args[pos]
+            return tuple(args[:pos]) + (dict((k, mapping[k]) for k in keys),) + tuple(args[pos + 1:]), kwargs
+        raise ValueError('Command cannot be split: %r' % (self.name,))
+
+
+class CommandTable(dict):
+    """
+    Maps command names to their ``Command``.
+
+    Commands which are not described take a single key as their first
+    argument, and are assumed to write data.
+    """
+    def __init__(self, commands=()):
+        super(CommandTable, self).__init__((c.name, c) for c in commands)
+
+    def __missing__(self, name):
+        return Command(name)
+
+    def get_read_commands(self):
+        return frozenset(name for name, command in self.iteritems() if command.read)
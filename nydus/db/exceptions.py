@@ -16,3 +16,13 @@ class CommandError(Exception):
 
     def __str__(self):
         return '%d command(s) failed: %r' % (len(self.errors), self.errors)
+
+
+class WarmupError(Exception):
+    def __init__(self, num, error):
+        self.num = num
+        self.error = error
+        super(WarmupError, self).__init__(num, error)
+
+    def __str__(self):
+        return 'Unable to connect to host %r: %s' % (self.num, self.error)
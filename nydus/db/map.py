@@ -6,14 +6,23 @@ nydus.db.map
 :license: Apache License 2.0, see LICENSE for more details.
 """
 
-from collections import defaultdict
-from nydus.utils import ThreadPool
+import threading
+
+from collections import OrderedDict, defaultdict
+from itertools import chain, islice, izip
+from nydus.utils import ThreadPool, chunks
 from nydus.db.exceptions import CommandError
-from nydus.db.promise import EventualCommand, change_resolution
+from nydus.db.promise import EventualCommand, change_resolution, get_resolution
 
 
 class BaseDistributedConnection(object):
-    def __init__(self, cluster, workers=None, fail_silently=False):
+    """
+    With ``coalesce_writes`` set, writes (such as ``set``) which are replaced
+    by a later write to the same key are not sent (see
+    ``_drop_replaced_writes``).
+    """
+    def __init__(self, cluster, workers=None, fail_silently=False, chunk_size=None,
+                 coalesce_writes=False):
         self._commands = []
         self._complete = False
         self._errors = []
@@ -21,22 +30,46 @@ class BaseDistributedConnection(object):
         self._cluster = cluster
         self._fail_silently = fail_silently
         self._workers = min(workers or len(cluster), 16)
+        self._chunk_size = chunk_size
+        self._coalesce_writes = coalesce_writes
+        # (command, result) for each write which was not sent
+        self._replaced = []
 
     def __getattr__(self, attr):
+        # the previous command has been called by now, so this is our chance
+        # to send a full chunk before queueing up another one
+        if self._chunk_size and len(self._commands) >= self._chunk_size:
+            self.flush()
+
         command = EventualCommand(attr)
         self._commands.append(command)
         return command
 
-    def _build_pending_commands(self):
-        pending_commands = defaultdict(list)
+    def _route_commands(self, split_commands):
+        """
+        Yields a ``(db_num, command)`` pair for every database each called
+        command needs to run on.
 
-        # build up a list of pending commands and their routing information
+        Commands taking keys which live on several databases (such as
+        ``mget``) are split into a command per database, which are recorded in
+        ``split_commands`` as ``(command, [(keys, sub_command), ...])``.
+        """
         for command in self._commands:
             if not command.was_called():
                 continue
 
             if self._cluster.router:
                 name, args, kwargs = command.get_command()
+                parts = self._cluster.router.split_command(name, args, kwargs)
+                if parts is not None:
+                    sub_commands = []
+                    for db_num, sub_args, sub_kwargs, keys in parts:
+                        sub_command = EventualCommand(name, sub_args, sub_kwargs)
+                        sub_commands.append((keys, sub_command))
+                        yield db_num, sub_command
+                    split_commands.append((command, sub_commands))
+                    continue
+
                 db_nums = self._cluster.router.get_dbs(
                     cluster=self._cluster,
                     attr=name,
@@ -47,27 +80,146 @@ class BaseDistributedConnection(object):
                 db_nums = self._cluster.keys()
 
             for db_num in db_nums:
-                # add to pending commands
-                pending_commands[db_num].append(command)
+                yield db_num, command
+
+    def _build_pending_commands(self, routed_commands):
+        pending_commands = defaultdict(list)
+
+        # build up a list of pending commands for each database
+        for db_num, command in routed_commands:
+            pending_commands[db_num].append(command)
+
+        if self._coalesce_writes:
+            for db_num, commands in pending_commands.iteritems():
+                pending_commands[db_num] = self._drop_replaced_writes(commands)
 
         return pending_commands
 
+    def _drop_replaced_writes(self, commands):
+        """
+        Returns the commands for a single database without the writes whose
+        key is replaced by a later ``set`` (or similar), with no other command
+        in between. A write followed by a ``delete`` is always sent, as the
+        result of the ``delete`` depends on it.
+
+        Writes which are dropped are recorded with the result they would have
+        had. For a ``delete`` that depends on whether the key existed, so it is
+        only dropped when an earlier write in the batch determines that.
+        """
+        table = self._cluster.commands
+        kept = list(commands)
+        # key: (index of the last write to it, its spec, whether the key existed before it)
+        last = {}
+        # key: whether the key exists after the last write to it
+        exists = {}
+
+        for i, command in enumerate(commands):
+            name, args, kwargs = command.get_command()
+            spec = table[name]
+            key = spec.get_replaced_key(args, kwargs)
+            try:
+                previous = last.pop(key, None)
+            except TypeError:
+                # unhashable keys can't be tracked
+                key = None
+            if key is None:
+                # any other command may read or change what was written so far
+                last.clear()
+                exists.clear()
+                continue
+
+            # writes whose result depends on the key are deletes
+            is_delete = isinstance(spec.replaces, tuple)
+
+            if previous is not None and not is_delete:
+                index, previous_spec, existed = previous
+                result = previous_spec.replaces
+                if isinstance(result, tuple):
+                    result = None if existed is None else result[0 if existed else 1]
+                if result is not None:
+                    kept[index] = None
+                    self._replaced.append((commands[index], result))
+
+            last[key] = (i, spec, exists.get(key))
+            exists[key] = not is_delete
+
+        return [command for command in kept if command is not None]
+
     def get_pool(self, commands):
         return ThreadPool(min(self._workers, len(commands)))
 
+    def flush(self):
+        """
+        Resolves all commands issued so far and releases them, so that the
+        memory held by a chunked ``map()`` stays bounded by ``chunk_size``.
+
+        Errors are collected and raised once the block is resolved.
+        """
+        self._resolve_commands()
+        self._commands = []
+
     def resolve(self):
-        pending_commands = self._build_pending_commands()
+        self._resolve_commands()
+        self._resolved = True
 
-        num_commands = sum(len(v) for v in pending_commands.itervalues())
-        # Don't bother with the pooling if we only need to do one operation on a single machine
-        if num_commands == 1:
-            db_num, (command,) = pending_commands.items()[0]
-            self._commands = [command.resolve(self._cluster[db_num])]
+        if not self._fail_silently and self._errors:
+            raise CommandError(self._errors)
 
-        elif num_commands > 1:
-            results = self.execute(self._cluster, pending_commands)
+    def _resolve_commands(self):
+        codec = self._cluster.codec
+        if codec is None:
+            return self._execute_commands()
+
+        # values are encoded, and later decoded, in a single pass over the
+        # batch (names are captured first, as resolved commands proxy to
+        # their values)
+        commands = [c for c in self._commands if c.was_called()]
+        names = []
+        for command in commands:
+            name, args, kwargs = command.get_command()
+            args, kwargs = codec.encode_command(name, args, kwargs)
+            command.set_args(args)
+            command.set_kwargs(kwargs)
+            names.append(name)
+
+        self._execute_commands()
+
+        results = codec.decode_results(izip(names, (get_resolution(c) for c in commands)))
+        for command, result in izip(commands, results):
+            change_resolution(command, result)
+
+    def _execute_commands(self):
+        split_commands = []
+        routed_commands = self._route_commands(split_commands)
+        # routing is lazy, so only look far enough ahead to know whether
+        # there is more than a single operation
+        first_commands = list(islice(routed_commands, 2))
+
+        # Don't bother with the pooling if we only need to do one operation on a single machine
+        if len(first_commands) == 1:
+            db_num, command = first_commands[0]
+            try:
+                command.resolve(self._cluster[db_num])
+            except Exception as e:
+                # errors are collected as they are from the pool
+                self._errors.append((command.get_name(), e))
+                change_resolution(command, e)
+            self._commands = [command]
+
+        elif first_commands:
+            self._replaced = []
+            results = self.execute(self._cluster, chain(first_commands, routed_commands))
+            for command, result in self._replaced:
+                results.setdefault(command, []).append(result)
+
+            split = set(id(command) for command, sub_commands in split_commands)
+            for command, sub_commands in split_commands:
+                change_resolution(command, self._merge_results(command, sub_commands, results))
 
             for command in self._commands:
+                if id(command) in split:
+                    continue
+
                 result = results.get(command)
 
                 if result:
@@ -81,15 +233,26 @@ class BaseDistributedConnection(object):
 
                 change_resolution(command, result)
 
-        self._resolved = True
+    def _merge_results(self, command, sub_commands, results):
+        name, args, kwargs = command.get_command()
+        parts = []
+        for keys, sub_command in sub_commands:
+            result = results.get(sub_command)[0]
+            if isinstance(result, Exception):
+                self._errors.append((name, result))
+                return result
+            parts.append((keys, result))
 
-        if not self._fail_silently and self._errors:
-            raise CommandError(self._errors)
+        spec = self._cluster.commands[name]
+        return spec.merge(spec.get_keys(args, kwargs), parts)
 
     def execute(self, cluster, commands):
         """
         Execute the given commands on the cluster.
 
+        ``commands`` is an iterable of ``(db_num, command)`` pairs, which is
+        routed lazily as it is consumed.
+
         The result should be a dictionary mapping the original command to the
         result value.
         """
@@ -98,6 +261,9 @@ class BaseDistributedConnection(object):
     def get_results(self):
         """
         Returns a list of results (once commands have been resolved).
+
+        When running with a ``chunk_size`` only the commands issued since the
+        last chunk was sent are retained.
         """
         assert self._resolved, 'you must execute the commands before fetching results'
 
@@ -118,6 +284,8 @@ class DistributedConnection(BaseDistributedConnection):
     it needs to run on.
     """
     def execute(self, cluster, commands):
+        commands = self._build_pending_commands(commands)
+
         # Create the threadpool and pipe jobs into it
         pool = self.get_pool(commands)
 
@@ -131,48 +299,187 @@ class DistributedConnection(BaseDistributedConnection):
         return dict(pool.join())
 
 
+class CounterPipeline(object):
+    """
+    Wraps the pipeline of a node, merging counter commands (such as ``incr``)
+    on the same key into a single command which adds their total amount.
+
+    Counter commands only change their own key, so they are held back until
+    any other command is added, and are then queued ahead of it. Each of the
+    merged commands still resolves to the value of its key once it would have
+    run, which is the final value less the amounts of the commands after it.
+    """
+    def __init__(self, pipe, commands):
+        self.pipe = pipe
+        self.commands = commands
+        self.pending = []
+        # key: (counter command, [(command, amount), ...])
+        self._counters = OrderedDict()
+        # merged command: [(command, amount), ...]
+        self._merged = {}
+
+    def add(self, command):
+        self.pending.append(command)
+
+        name, args, kwargs = command.get_command()
+        spec = self.commands[name]
+        amount = spec.get_amount(args, kwargs)
+        if amount is not None:
+            key = spec.get_key(args, kwargs)
+            try:
+                counter, counted = self._counters.setdefault(key, (spec.counter, []))
+            except TypeError:
+                # unhashable keys can't be merged
+                counter = None
+            if counter == spec.counter:
+                counted.append((command, amount))
+                return
+
+        self.flush()
+        self.pipe.add(command)
+
+    def flush(self):
+        """
+        Queues the counter commands held back so far.
+        """
+        for key, (counter, counted) in self._counters.iteritems():
+            if len(counted) == 1:
+                self.pipe.add(counted[0][0])
+                continue
+
+            command = EventualCommand(counter, (key, sum(amount for c, amount in counted)))
+            self.pipe.add(command)
+            self._merged[command] = counted
+        self._counters.clear()
+
+    def execute(self):
+        self.flush()
+        results = self.pipe.execute()
+
+        for command, counted in self._merged.iteritems():
+            result = results.pop(command)
+            if not isinstance(result, (int, long)):
+                for c, amount in counted:
+                    results[c] = result
+                continue
+
+            # the amounts added after each command
+            remaining = sum(amount for c, amount in counted)
+            for c, amount in counted:
+                remaining -= amount
+                results[c] = result - remaining
+        return results
+
+
 class PipelinedDistributedConnection(BaseDistributedConnection):
     """
     Runs all commands using pipelines, which will execute a single pipe.execute() call
     within a thread pool.
-    """
-    def execute(self, cluster, commands):
-        # db_num: pipeline object
-        pipes = {}
 
-        # Create the threadpool and pipe jobs into it
-        pool = self.get_pool(commands)
+    Workers are started before routing begins. Each node's pipeline is sent as
+    soon as it holds ``pipeline_size`` commands, while the remaining commands
+    are still being routed, and whatever is left is sent once routing
+    completes. Pipelines for the same node are always executed in order.
 
-        # execute our pending commands either in the pool, or using a pipeline
-        for db_num, command_list in commands.iteritems():
-            pipes[db_num] = cluster[db_num].get_pipeline()
-            for command in command_list:
-                # add to pipeline
-                pipes[db_num].add(command.clone())
+    Pipelines are not transactional unless ``transaction`` is set, in which
+    case each pipeline sent is atomic on its node. With ``atomic`` set, all of
+    a node's commands are sent within a single transaction.
 
-        # We need to finalize our commands with a single execute in pipelines
-        for db_num, pipe in pipes.iteritems():
-            pool.add(db_num, pipe.execute, (), {})
+    With ``noreply`` set, backends which support it (such as Memcache) send
+    writes without waiting for their replies. Options a backend does not
+    support (see ``supported_pipeline_options``) are ignored.
 
-        # Consolidate commands with their appropriate results
-        db_result_map = pool.join()
+    Counter commands on the same key are merged into a single command (see
+    ``CounterPipeline``) unless ``coalesce_counters`` is disabled.
+    """
+    def __init__(self, cluster, workers=None, pipeline_size=1000, transaction=False,
+                 atomic=False, noreply=False, coalesce_counters=True, **kwargs):
+        self._coalesce_counters = coalesce_counters
+        self._pipeline_options = {}
+        if transaction or atomic:
+            self._pipeline_options['transaction'] = True
+        if noreply:
+            self._pipeline_options['noreply'] = True
+        if atomic:
+            pipeline_size = None
+        self._pipeline_size = pipeline_size
+        super(PipelinedDistributedConnection, self).__init__(cluster, workers, **kwargs)
+
+    def _execute_pipeline(self, pipe, previous, done):
+        try:
+            if previous is not None:
+                previous.wait()
+            try:
+                return pipe.pending, pipe.execute()
+            # if pipe.execute (within nydus) fails, this will be an exception object
+            except Exception as e:
+                return pipe.pending, e
+        finally:
+            done.set()
 
-        # Results get grouped by their command signature, so we have to separate the logic
+    def execute(self, cluster, commands):
+        # db_num: pipeline object currently being built
+        pipes = {}
+        # db_num: event which is set once the last pipeline sent to that node has executed
+        sent = {}
+        # command added to a pipeline: the command it was cloned from
+        originals = {}
+
+        if self._coalesce_writes:
+            # a write can only be dropped once the writes after it are known,
+            # so every command is routed before any pipeline is sent
+            pending_commands = self._build_pending_commands(commands)
+            commands = ((db_num, command) for db_num, command_list in pending_commands.iteritems()
+                        for command in command_list)
+
+        # Create the threadpool and start it, so that pipelines begin executing as they are sent
+        pool = self.get_pool(cluster)
+        pool.start()
+
+        def send(db_num):
+            done = threading.Event()
+            pool.add(db_num, self._execute_pipeline, (pipes.pop(db_num), sent.get(db_num), done))
+            sent[db_num] = done
+
+        try:
+            for db_num, command in commands:
+                pipe = pipes.get(db_num)
+                if pipe is None:
+                    connection = cluster[db_num]
+                    options = dict((k, v) for k, v in self._pipeline_options.iteritems()
+                                   if k in connection.supported_pipeline_options)
+                    pipe = connection.get_pipeline(**options)
+                    if self._coalesce_counters:
+                        pipe = CounterPipeline(pipe, cluster.commands)
+                    pipes[db_num] = pipe
+                # add to pipeline (cloned, as a command can only resolve once)
+                clone = command.clone()
+                originals[clone] = command
+                pipe.add(clone)
+
+                if self._pipeline_size and len(pipe.pending) >= self._pipeline_size:
+                    send(db_num)
+
+            # We need to finalize the remaining commands with a single execute per pipeline
+            for db_num in pipes.keys():
+                send(db_num)
+        finally:
+            # Consolidate commands with their appropriate results (the workers
+            # only exit once joined, so this must happen even if routing fails)
+            db_result_map = pool.join()
+
+        # A command routed to several databases has a result from each
         results = defaultdict(list)
 
         for db_num, db_results in db_result_map.iteritems():
-            # Pipelines always execute on a single database
-            assert len(db_results) == 1
-            db_results = db_results[0]
+            for pending, pipe_results in db_results:
+                if isinstance(pipe_results, Exception):
+                    for command in pending:
+                        results[originals[command]].append(pipe_results)
+                    continue
 
-            # if pipe.execute (within nydus) fails, this will be an exception object
-            if isinstance(db_results, Exception):
-                for command in commands[db_num]:
-                    results[command].append(db_results)
-                continue
-
-            for command, result in db_results.iteritems():
-                results[command].append(result)
+                for command, result in pipe_results.iteritems():
+                    results[originals[command]].append(result)
 
         return results
 
@@ -194,3 +501,23 @@ class DistributedContextManager(object):
 
     def can_pipeline(self, cluster):
         return all(cluster[n].supports_pipelines for n in cluster)
+
+
+def imap(cluster, commands, chunk_size=1000, workers=None, **kwargs):
+    """
+    Executes ``commands`` on ``cluster`` in chunks of at most ``chunk_size``
+    commands, yielding each result in order as its chunk completes.
+
+    Each command is a tuple of ``(name, args)`` or ``(name, args, kwargs)``.
+    Only a single chunk is ever held in memory, so ``commands`` may be a
+    generator of any length.
+    """
+    for chunk in chunks(commands, chunk_size):
+        with DistributedContextManager(cluster, workers, **kwargs) as conn:
+            results = []
+            for command in chunk:
+                name, args = command[:2]
+                results.append(getattr(conn, name)(*args, **(command[2] if len(command) > 2 else {})))
+
+        for result in results:
+            yield get_resolution(result)
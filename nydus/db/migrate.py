@@ -0,0 +1,534 @@
+"""
+nydus.db.migrate
+~~~~~~~~~~~~~~~~
+
+Moves keys between two layouts of a cluster, such as when hosts are added
+to a ``PartitionRouter`` cluster.
+
+>>> migration = Migration(old_settings, new_settings, batch_size=1000, workers=8)
+>>> stats = migration.run()
+>>> print stats['copied'], stats['keys_per_second']
+
+While keys are being moved, reads can be served from the new layout with a
+fallback to the old one:
+
+>>> redis = DualReadCluster(migration.target, migration.source)
+>>> redis.get('foo')
+
+Or, before switching over, writes can be mirrored to the new layout:
+
+>>> redis = ShadowCluster(old_cluster, new_cluster, read_sample_rate=0.01)
+>>> redis.set('foo', 'bar')
+
+:copyright: (c) 2011-2012 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+__all__ = ('Migration', 'DualReadCluster', 'ShadowCluster')
+
+import logging
+import random
+import threading
+import time
+
+from collections import defaultdict
+from itertools import izip
+from Queue import Queue, Empty, Full
+
+from nydus.db import create_cluster
+from nydus.db.base import BaseCluster, CallProxy, RawCallProxy
+from nydus.db.commands import KEY_LIST
+from nydus.db.promise import get_resolution, is_resolved
+from nydus.utils import ThreadPool, iter_parallel
+
+
+def get_cluster(cluster):
+    if isinstance(cluster, (BaseCluster, ClusterWrapper)):
+        return cluster
+    return create_cluster(cluster)
+
+
+class Migration(object):
+    """
+    Copies every key of ``source`` to the node(s) it belongs to in ``target``.
+
+    Keys are read from each source node with ``SCAN`` in batches of
+    ``batch_size``, dumped with a pipeline of ``DUMP`` and ``PTTL``, and
+    written with a pipeline of ``RESTORE`` to each target node. Batches are
+    copied by a pool of ``workers`` threads. Keys which stay on the same
+    server are skipped.
+
+    ``source`` and ``target`` may either be clusters or cluster settings.
+    Other backends can be supported by overriding ``scan_node``,
+    ``dump_keys`` and ``restore_keys``.
+    """
+    logger = logging.getLogger('nydus.db.migrate')
+
+    def __init__(self, source, target, batch_size=1000, workers=4, match=None):
+        self.source = get_cluster(source)
+        self.target = get_cluster(target)
+        self.batch_size = batch_size
+        self.workers = workers
+        self.match = match
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self._stats = {
+            # keys read from the source
+            'scanned': 0,
+            # keys written to the target
+            'copied': 0,
+            # keys which did not need to move
+            'skipped': 0,
+            # keys which disappeared before they were copied
+            'missing': 0,
+            # keys which could not be copied
+            'errors': 0,
+            # bytes of dumped values written to the target
+            'bytes': 0,
+        }
+        self._started_at = None
+        self._finished_at = None
+
+    def get_stats(self):
+        """
+        Returns counters for the keys migrated so far, including the number
+        of keys scanned per second.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        if self._started_at is None:
+            elapsed = 0
+        else:
+            elapsed = (self._finished_at or time.time()) - self._started_at
+        stats['elapsed'] = elapsed
+        stats['keys_per_second'] = stats['scanned'] / elapsed if elapsed else 0
+        return stats
+    stats = property(get_stats)
+
+    def run(self, progress=None):
+        """
+        Migrates all keys, and returns the final stats.
+
+        ``progress`` is called with the current stats after each batch.
+        """
+        self._started_at = time.time()
+        self._finished_at = None
+
+        # bounds the number of batches waiting to be copied
+        pending = threading.Semaphore(self.workers * 2)
+        pool = ThreadPool(self.workers)
+        pool.start()
+
+        def copy(conn, keys):
+            try:
+                self.copy_keys(conn, keys)
+            finally:
+                pending.release()
+            if progress is not None:
+                progress(self.get_stats())
+
+        nodes = [self.iter_node(conn) for conn in self.source.hosts.itervalues()]
+        try:
+            for conn, keys in iter_parallel(nodes):
+                pending.acquire()
+                pool.add(conn.num, copy, (conn, keys))
+        finally:
+            results = pool.join()
+            self._finished_at = time.time()
+
+        for errors in results.itervalues():
+            for error in errors:
+                if isinstance(error, Exception):
+                    raise error
+
+        stats = self.get_stats()
+        self.logger.info('Migrated %(copied)d of %(scanned)d keys (%(skipped)d skipped, %(missing)d missing, '
+                         '%(errors)d errors) in %(elapsed).1fs', stats)
+        return stats
+
+    def iter_node(self, conn):
+        for keys in self.scan_node(conn):
+            yield conn, keys
+
+    def copy_keys(self, conn, keys):
+        """
+        Copies ``keys`` from the source connection ``conn`` to the target.
+        """
+        counts = defaultdict(int)
+        counts['scanned'] = len(keys)
+
+        restores = defaultdict(list)
+        for key, ttl, data in self.dump_keys(conn, keys):
+            if data is None:
+                counts['missing'] += 1
+                continue
+
+            db_nums = [n for n in self.target.router.get_dbs(attr='restore', args=(key, ttl, data))
+                       if self.target[n].identifier != conn.identifier]
+            if not db_nums:
+                counts['skipped'] += 1
+                continue
+
+            for db_num in db_nums:
+                restores[db_num].append((key, ttl, data))
+
+        for db_num, items in restores.iteritems():
+            for (key, ttl, data), result in izip(items, self.restore_keys(self.target[db_num], items)):
+                if isinstance(result, Exception):
+                    self.logger.warning('Unable to copy %r to %r: %s', key, self.target[db_num].identifier, result)
+                    counts['errors'] += 1
+                else:
+                    counts['copied'] += 1
+                    counts['bytes'] += len(data)
+
+        with self._lock:
+            for name, count in counts.iteritems():
+                self._stats[name] += count
+
+    def scan_node(self, conn):
+        """
+        Yields batches of keys from the source connection ``conn``.
+        """
+        cursor = 0
+        while True:
+            cursor, keys = conn.scan(cursor, match=self.match, count=self.batch_size)
+            if keys:
+                yield keys
+            if not int(cursor):
+                break
+
+    def dump_keys(self, conn, keys):
+        """
+        Returns a list of ``(key, ttl, data)`` for each of ``keys``, where
+        ``ttl`` is in milliseconds (``0`` if the key does not expire) and
+        ``data`` is ``None`` if the key does not exist.
+        """
+        pipe = conn.pipeline(transaction=False)
+        for key in keys:
+            pipe.dump(key)
+            pipe.pttl(key)
+        results = pipe.execute()
+
+        dumped = []
+        for key, data, ttl in izip(keys, results[::2], results[1::2]):
+            if ttl == -2:
+                data = None
+            dumped.append((key, max(ttl, 0), data))
+        return dumped
+
+    def restore_keys(self, conn, items):
+        """
+        Writes each ``(key, ttl, data)`` of ``items`` to the target connection
+        ``conn``, returning a result (or exception) for each.
+        """
+        pipe = conn.pipeline(transaction=False)
+        for key, ttl, data in items:
+            pipe.restore(key, ttl, data, replace=True)
+        return pipe.execute(raise_on_error=False)
+
+
+class ClusterWrapper(object):
+    """
+    Proxies commands to ``execute``, and everything else (such as ``hosts``,
+    ``router`` or ``get_conn``) to ``cluster``, which may itself be wrapped.
+    """
+    def __init__(self, cluster):
+        self.cluster = get_cluster(cluster)
+
+    def __len__(self):
+        return len(self.cluster)
+
+    def __getitem__(self, name):
+        return self.cluster[name]
+
+    def __iter__(self):
+        return iter(self.cluster)
+
+    def __getattr__(self, name):
+        try:
+            return self._get_cluster_attribute(name)
+        except AttributeError:
+            return CallProxy(self, name)
+
+    def _get_cluster_attribute(self, name):
+        # attributes of the cluster are looked up without falling back to its
+        # own __getattr__, which would turn anything into a command
+        try:
+            return object.__getattribute__(self.cluster, name)
+        except AttributeError:
+            if isinstance(self.cluster, ClusterWrapper):
+                return self.cluster._get_cluster_attribute(name)
+            raise
+
+    @property
+    def raw(self):
+        return RawCallProxy(self)
+
+    def execute(self, path, args, kwargs, raw=False):
+        return self.cluster.execute(path, args, kwargs, raw)
+
+    def map(self, *args, **kwargs):
+        return self.cluster.map(*args, **kwargs)
+
+    def disconnect(self):
+        self.cluster.disconnect()
+
+
+class DualReadCluster(ClusterWrapper):
+    """
+    Executes commands on ``cluster``, and read commands which come back as
+    ``None`` on ``previous`` as well, so that a new layout can take over from an old
+    one without starting out cold.
+
+    Multi-key reads (such as ``mget``, or ``get_multi`` which returns a
+    mapping) only fetch the missing keys from ``previous``. Writes only go to ``cluster``, except ``fallthrough_writes``
+    (deletes by default), which are applied to both so that deleted keys are
+    not read back from ``previous``.
+
+    ``map()`` is executed on ``cluster`` alone.
+    """
+    fallthrough_writes = frozenset(['delete'])
+
+    def __init__(self, cluster, previous):
+        super(DualReadCluster, self).__init__(cluster)
+        self.previous = get_cluster(previous)
+
+    def execute(self, path, args, kwargs, raw=False):
+        result = self.cluster.execute(path, args, kwargs, raw)
+
+        command = self.cluster.commands[path]
+        if path in self.fallthrough_writes:
+            self.previous.execute(path, args, kwargs, raw)
+        elif not command.read:
+            pass
+        elif command.keys == KEY_LIST and isinstance(result, list):
+            keys = command.get_keys(args, kwargs)
+            missing = [i for i, value in enumerate(result) if value is None]
+            if missing:
+                missing_args, missing_kwargs = command.split(args, kwargs, [keys[i] for i in missing])
+                values = self.previous.execute(path, missing_args, missing_kwargs, raw)
+                for i, value in izip(missing, values):
+                    result[i] = value
+        elif command.keys == KEY_LIST and isinstance(result, dict):
+            # such as get_multi, which leaves out the keys it did not find
+            missing = [key for key in command.get_keys(args, kwargs) if key not in result]
+            if missing:
+                missing_args, missing_kwargs = command.split(args, kwargs, missing)
+                result.update(self.previous.execute(path, missing_args, missing_kwargs, raw))
+        elif result is None:
+            result = self.previous.execute(path, args, kwargs, raw)
+        return result
+
+    def disconnect(self):
+        self.cluster.disconnect()
+        self.previous.disconnect()
+
+
+class ShadowCluster(ClusterWrapper):
+    """
+    Executes commands on ``cluster``, and mirrors writes (and a sample of
+    ``read_sample_rate`` reads) to ``shadow`` in the background, so that a
+    new cluster can be warmed up, or a new router tried out, under real load.
+
+    Mirrored commands are queued (up to ``queue_size``) and executed by
+    ``workers`` threads, so the latency of ``cluster`` is unaffected. When the
+    queue is full, ``drop_policy`` decides what happens:
+
+    - ``newest``: the new command is dropped.
+    - ``oldest``: the oldest queued command is dropped to make room.
+    - ``block``: the caller waits for room.
+
+    The results of sampled reads are compared with those of ``cluster``, and
+    ``on_mismatch`` (if given) is called with the command and both results.
+    Commands from a single worker are mirrored in order; with several workers
+    writes to the same key may be reordered.
+
+    Writes made within ``map()`` which succeed are mirrored once it has been
+    executed, but its reads are never sampled. ``imap()`` is executed on ``cluster`` alone.
+    """
+    logger = logging.getLogger('nydus.db.migrate')
+
+    drop_policies = ('newest', 'oldest', 'block')
+
+    def __init__(self, cluster, shadow, read_sample_rate=0, queue_size=10000, drop_policy='newest',
+                 workers=1, on_mismatch=None):
+        assert drop_policy in self.drop_policies, 'drop_policy must be one of %r' % (self.drop_policies,)
+
+        super(ShadowCluster, self).__init__(cluster)
+        self.shadow = get_cluster(shadow)
+        self.read_sample_rate = read_sample_rate
+        self.drop_policy = drop_policy
+        self.on_mismatch = on_mismatch
+        self._queue = Queue(queue_size)
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+        self._workers = []
+        for n in xrange(workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {
+                # commands queued for the shadow cluster
+                'queued': 0,
+                # commands executed on the shadow cluster
+                'executed': 0,
+                # commands dropped as the queue was full
+                'dropped': 0,
+                # commands which failed on the shadow cluster
+                'errors': 0,
+                # sampled reads which returned a different result
+                'mismatches': 0,
+                # seconds between queueing and executing the last command
+                'lag': 0,
+                'max_lag': 0,
+            }
+
+    def get_stats(self):
+        """
+        Returns counters for the mirrored commands, along with how far behind
+        the shadow cluster is.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats['pending'] = self._queue.qsize()
+        return stats
+    stats = property(get_stats)
+
+    def execute(self, path, args, kwargs, raw=False):
+        result = self.cluster.execute(path, args, kwargs, raw)
+
+        if not self.cluster.commands[path].read:
+            self._put((path, args, kwargs, raw, time.time(), False, None))
+        elif self.read_sample_rate and random.random() < self.read_sample_rate:
+            self._put((path, args, kwargs, raw, time.time(), True, result))
+        return result
+
+    def map(self, *args, **kwargs):
+        return ShadowedMap(self, self.cluster.map(*args, **kwargs))
+
+    def _put(self, item):
+        if self.drop_policy == 'block':
+            self._queue.put(item)
+        else:
+            while True:
+                try:
+                    self._queue.put_nowait(item)
+                except Full:
+                    if self.drop_policy == 'newest':
+                        self._dropped()
+                        return
+                    try:
+                        self._queue.get_nowait()
+                    except Empty:
+                        pass
+                    else:
+                        self._queue.task_done()
+                        self._dropped()
+                    continue
+                break
+
+        with self._lock:
+            self._stats['queued'] += 1
+
+    def _dropped(self):
+        with self._lock:
+            self._stats['dropped'] += 1
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    break
+                self._execute(*item)
+            finally:
+                self._queue.task_done()
+
+    def _execute(self, path, args, kwargs, raw, queued_at, compare, expected):
+        lag = time.time() - queued_at
+        try:
+            result = self.shadow.execute(path, args, kwargs, raw)
+        except Exception as e:
+            self.logger.debug('Shadowed %s failed: %s', path, e)
+            error = True
+        else:
+            error = False
+            if compare and result != expected:
+                with self._lock:
+                    self._stats['mismatches'] += 1
+                if self.on_mismatch is not None:
+                    self.on_mismatch(path, args, kwargs, expected, result)
+
+        with self._lock:
+            self._stats['executed'] += 1
+            self._stats['errors'] += int(error)
+            self._stats['lag'] = lag
+            self._stats['max_lag'] = max(lag, self._stats['max_lag'])
+
+    def join(self):
+        """
+        Waits for every queued command to be mirrored.
+        """
+        self._queue.join()
+
+    def close(self):
+        """
+        Mirrors every queued command, and stops the workers.
+        """
+        for worker in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def disconnect(self):
+        self.close()
+        self.cluster.disconnect()
+        self.shadow.disconnect()
+
+
+class ShadowedMap(object):
+    """
+    Wraps a ``map()`` of the primary cluster, recording the writes called on
+    it so that those which succeed are mirrored once they have been executed,
+    even if others failed.
+    """
+    def __init__(self, cluster, context):
+        self.cluster = cluster
+        self.context = context
+        self.connection = None
+        self.writes = []
+
+    def __enter__(self):
+        self.connection = self.context.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            self.context.__exit__(exc_type, exc_value, tb)
+        finally:
+            for path, args, kwargs, command in self.writes:
+                if is_resolved(command) and not isinstance(get_resolution(command), Exception):
+                    self.cluster._put((path, args, kwargs, False, time.time(), False, None))
+
+    def __getattr__(self, name):
+        # methods of the connection (such as ``get_results``) are not commands
+        if hasattr(type(self.connection), name):
+            return getattr(self.connection, name)
+
+        command = getattr(self.connection, name)
+        if self.cluster.commands[name].read:
+            return command
+
+        def call(*args, **kwargs):
+            result = command(*args, **kwargs)
+            self.writes.append((name, args, kwargs, result))
+            return result
+        return call
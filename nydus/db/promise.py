@@ -35,6 +35,20 @@ def change_resolution(command, value):
     command._EventualCommand__resolved = True
 
 
+def get_resolution(command):
+    """
+    Public API to fetch the value an EventualCommand was resolved to.
+    """
+    return command._EventualCommand__wrapped
+
+
+def is_resolved(command):
+    """
+    Public API to check whether an EventualCommand has been resolved.
+    """
+    return command._EventualCommand__resolved
+
+
 class EventualCommand(object):
     # introspection support:
     __members__ = property(lambda self: self.__dir__())
@@ -46,18 +60,17 @@ class EventualCommand(object):
         self.__resolved = False
         self.__args = args or []
         self.__kwargs = kwargs or {}
-        self.__ident = ':'.join(map(lambda x: str(hash(str(x))), [self.__attr, self.__args, self.__kwargs]))
 
     def __call__(self, *args, **kwargs):
         self.__called = True
         self.__args = args
         self.__kwargs = kwargs
-        self.__ident = ':'.join(map(lambda x: str(hash(str(x))), [self.__attr, self.__args, self.__kwargs]))
         return self
 
     def __hash__(self):
-        # We return our ident
-        return hash(self.__ident)
+        # commands are told apart by identity, as identical calls (such as a
+        # counter incremented several times) each have their own result
+        return id(self)
 
     def __repr__(self):
         if self.__resolved:
@@ -39,6 +39,9 @@ class BaseRouter(object):
     """
     retryable = False
 
+    # Optional ``HotKeySampler`` which records the key of every routed call
+    sampler = None
+
     class UnableToSetupRouter(Exception):
         pass
 
@@ -78,7 +81,14 @@ class BaseRouter(object):
             self._handle_exception(e)
             db_nums = []
 
-        return self._post_routing(attr=attr, db_nums=db_nums, args=args, kwargs=kwargs, **fkwargs)
+        db_nums = self._post_routing(attr=attr, db_nums=db_nums, args=args, kwargs=kwargs, **fkwargs)
+
+        if self.sampler is not None and db_nums:
+            key = self.get_routing_key(attr, args, kwargs)
+            if key is not None:
+                self.sampler.record(key, db_nums)
+
+        return db_nums
 
     # Backwards compatibilty
     get_db = get_dbs
@@ -121,6 +131,71 @@ class BaseRouter(object):
         """
         return db_nums
 
+    def add_host(self, db_num, host):
+        """
+        Called once ``host`` has been added to the cluster as ``db_num``.
+        """
+        pass
+
+    def remove_host(self, db_num, host):
+        """
+        Called once ``host`` (``db_num``) has been removed from the cluster.
+        """
+        pass
+
+    def get_command_spec(self, attr):
+        """
+        Returns the ``Command`` describing ``attr`` for the cluster's backend.
+        """
+        return self.cluster.commands[attr]
+
+    def split_command(self, attr, args, kwargs):
+        """
+        Splits a command taking several keys (such as ``mget``) by the
+        databases its keys route to.
+
+        Returns a list of ``(db_num, args, kwargs, keys)`` for each database,
+        or ``None`` if the command cannot be split or only routes to a single
+        database.
+        """
+        command = self.get_command_spec(attr)
+        if not command.splittable or self.get_routing_key(attr, args, kwargs) is None:
+            return None
+
+        # the copies of replicated keys are sent apart from (and after) the
+        # keys each database holds first, so that merged results (such as the
+        # number of keys deleted) count every key once
+        keys_by_part = {}
+        own_parts, copy_parts = [], []
+        seen = set()
+        for key in command.get_keys(args, kwargs):
+            for index, db_num in enumerate(self.get_dbs(attr=attr, args=(), kwargs={'key': key})):
+                if (db_num, key) in seen:
+                    continue
+                seen.add((db_num, key))
+                part = (db_num, index > 0)
+                if part not in keys_by_part:
+                    keys_by_part[part] = []
+                    (copy_parts if index else own_parts).append(part)
+                keys_by_part[part].append(key)
+
+        parts = own_parts + copy_parts
+        if len(parts) < 2:
+            return None
+
+        results = []
+        for part in parts:
+            keys = keys_by_part[part]
+            results.append((part[0],) + command.split(args, kwargs, keys) + (keys,))
+        return results
+
+    def get_routing_key(self, attr, args, kwargs):
+        """
+        Returns the key the given call is routed on, or ``None`` if it is not
+        routed on a key.
+        """
+        return None
+
     def _handle_exception(self, e):
         """
         Handle/transform exceptions and return it
@@ -199,6 +274,15 @@ class RoundRobinRouter(BaseRouter):
         db_num = self.ensure_db_num(db_num)
         self._down_connections.pop(db_num, None)
 
+    def add_host(self, db_num, host):
+        if self._ready:
+            self._hosts_cycler = cycle(self.cluster.hosts.keys())
+
+    def remove_host(self, db_num, host):
+        self._down_connections.pop(db_num, None)
+        if self._ready:
+            self._hosts_cycler = cycle(self.cluster.hosts.keys())
+
     @routing_params
     def _setup_router(self, args, kwargs, **fkwargs):
         self._hosts_cycler = cycle(self.cluster.hosts.keys())
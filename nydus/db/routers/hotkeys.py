@@ -0,0 +1,177 @@
+"""
+nydus.db.routers.hotkeys
+~~~~~~~~~~~~~~~~~~~~~~~~
+
+Sampling of the most frequently routed keys.
+
+>>> redis = create_cluster({
+>>>     'backend': 'nydus.db.backends.redis.Redis',
+>>>     'router': 'nydus.db.routers.keyvalue.ConsistentHashingRouter',
+>>>     'hot_keys': {
+>>>         'window': 60,
+>>>         'sample_rate': 0.1,
+>>>     },
+>>>     'hosts': {
+>>>         0: {'db': 0},
+>>>     },
+>>> })
+>>> redis.hot_keys.get_hot_keys(limit=3)
+[('foo', 0, 5210), ('bar', 0, 380), ('baz', 0, 120)]
+
+:copyright: (c) 2011-2012 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+__all__ = ('HotKeySampler', 'create_sampler')
+
+import logging
+import random
+import threading
+import time
+
+
+class HotKeySampler(object):
+    """
+    Tracks the most frequently routed keys, and the database they were routed
+    to, within windows of ``window`` seconds.
+
+    Keys are counted using the space-saving algorithm, which keeps at most
+    ``capacity`` keys and never underestimates the count of a key it keeps.
+    Keys are also grouped by their count, so that the least frequent key is
+    found (and replaced) in constant time. Only ``sample_rate`` of all calls
+    are counted, and counts are scaled back up when reported. Counting takes
+    a lock, so by default only one in a hundred calls is sampled.
+
+    With ``log_threshold`` set, a key is logged as soon as its count within
+    the current window reaches it. When a window ends its hot keys are kept
+    (see ``get_last_hot_keys``) and, if ``log_limit`` is set, the hottest of
+    them are logged.
+    """
+    logger = logging.getLogger('nydus.db.routers.hotkeys')
+
+    def __init__(self, capacity=100, window=60, sample_rate=0.01, log_limit=10,
+                 log_threshold=None):
+        self.capacity = capacity
+        self.window = window
+        self.sample_rate = sample_rate
+        self.log_limit = log_limit
+        self.log_threshold = log_threshold
+        self._lock = threading.Lock()
+        self._reset(time.time())
+        self._last = []
+
+    def _reset(self, now):
+        # key: [count, db_num]
+        self._counts = {}
+        # count: set of keys with that count
+        self._buckets = {}
+        self._min_count = 0
+        # keys logged for reaching log_threshold within this window
+        self._logged = set()
+        self.window_start = now
+
+    def record(self, key, db_nums):
+        """
+        Records a single call for ``key``, which was routed to ``db_nums``.
+        """
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+
+        db_num = db_nums[0] if len(db_nums) == 1 else tuple(db_nums)
+        now = time.time()
+
+        with self._lock:
+            if now - self.window_start >= self.window:
+                self._rotate(now)
+
+            try:
+                entry = self._counts.get(key)
+            except TypeError:
+                # unhashable keys can't be tracked
+                return
+
+            if entry is not None:
+                count = entry[0]
+                self._remove_from_bucket(key, count)
+            elif len(self._counts) < self.capacity:
+                count = 0
+                self._min_count = 1
+            else:
+                # replace a least frequent key, which the new key inherits
+                # the count of
+                count = self._min_count
+                min_key = next(iter(self._buckets[count]))
+                self._remove_from_bucket(min_key, count)
+                del self._counts[min_key]
+
+            count += 1
+            self._counts[key] = [count, db_num]
+            self._buckets.setdefault(count, set()).add(key)
+
+            hot = (self.log_threshold and key not in self._logged and
+                   count / self.sample_rate >= self.log_threshold)
+            if hot:
+                self._logged.add(key)
+
+        if hot:
+            self.logger.info('Hot key %r (db %s): %d calls within %ds', key, db_num,
+                             int(count / self.sample_rate), now - self.window_start)
+
+    def _remove_from_bucket(self, key, count):
+        bucket = self._buckets[count]
+        bucket.discard(key)
+        if not bucket:
+            del self._buckets[count]
+            if count == self._min_count:
+                # the key is moved on to the next count, or replaced by a key
+                # which inherits it
+                self._min_count = count + 1
+
+    def _rotate(self, now):
+        self._last = self._get_hot_keys(self._counts)
+        self._reset(now)
+
+        if self.log_limit and self._last:
+            self.logger.info('Hot keys over the last %ds: %s', self.window, ', '.join(
+                '%r (db %s): %d' % hot_key for hot_key in self._last[:self.log_limit]))
+
+    def _get_hot_keys(self, counts, limit=None):
+        hot_keys = sorted(((k, db_num, int(count / self.sample_rate))
+                          for k, (count, db_num) in counts.iteritems()),
+                          key=lambda x: x[2], reverse=True)
+        return hot_keys[:limit]
+
+    def get_hot_keys(self, limit=None):
+        """
+        Returns a list of ``(key, db_num, count)`` tuples for the hottest keys
+        in the current window, ordered by count.
+        """
+        with self._lock:
+            return self._get_hot_keys(self._counts, limit)
+
+    def get_last_hot_keys(self, limit=None):
+        """
+        Returns a list of ``(key, db_num, count)`` tuples for the hottest keys
+        in the last complete window, ordered by count.
+        """
+        with self._lock:
+            return self._last[:limit]
+
+    def reset(self):
+        with self._lock:
+            self._reset(time.time())
+            self._last = []
+
+
+def create_sampler(settings):
+    """
+    Creates a ``HotKeySampler`` from the ``hot_keys`` setting of a cluster,
+    which is either ``True``, a dictionary of options, or a sampler instance.
+    """
+    if not settings:
+        return None
+    elif settings is True:
+        return HotKeySampler()
+    elif isinstance(settings, HotKeySampler):
+        return settings
+    return HotKeySampler(**settings)
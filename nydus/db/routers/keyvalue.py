@@ -6,9 +6,11 @@ nydus.db.routers.keyvalue
 :license: Apache License 2.0, see LICENSE for more details.
 """
 
+import random
+
 from binascii import crc32
 
-from nydus.contrib.ketama import Ketama
+from nydus.contrib.ketama import Ketama, LibmemcachedKetama
 from nydus.db.routers import BaseRouter, RoundRobinRouter, routing_params
 
 __all__ = ('ConsistentHashingRouter', 'PartitionRouter')
@@ -29,30 +31,125 @@ class ConsistentHashingRouter(RoundRobinRouter):
 
     If a key is not provided, then all hosts are returned.
 
-    The first argument is assumed to be the ``key`` for routing. Keyword arguments
-    are not supported.
+    The ``key`` for routing is found through the backend's command table (see
+    ``nydus.db.commands``), and is the first argument for commands it does not
+    describe. Keyword arguments are not supported.
+
+    Each host receives a share of keys in proportion to its ``weight`` option
+    (1 by default, which places 160 points on the ring), e.g. 1 for a 16GB
+    host and 4 for a 64GB host.
+
+    Individual keys may be replicated across several nodes (see
+    ``replicate_key``), in which case writes go to each of the nodes following
+    the key on the ring, and reads of the key alone go to one of them at
+    random. Placement of all other keys is unaffected.
+
+    With the ``libmemcached_compat`` option, keys are placed exactly as
+    libmemcached (e.g. pylibmc with the ``ketama_weighted`` behaviour) places
+    them across the same ``host:port`` servers (see ``LibmemcachedKetama``),
+    so a fleet can be shared with other clients.
     """
 
+    # Default number of nodes a replicated key is stored on
+    replicas = 3
+
     def __init__(self, *args, **kwargs):
         self._db_num_id_map = {}
+        self.libmemcached_compat = kwargs.pop('libmemcached_compat', False)
+        # key: number of nodes
+        self._replicated_keys = {}
+        self._hot_replicated_keys = []
+        for key, replicas in (kwargs.pop('replicated_keys', None) or {}).iteritems():
+            self.replicate_key(key, replicas)
         super(ConsistentHashingRouter, self).__init__(*args, **kwargs)
 
+    def replicate_key(self, key, replicas=None):
+        """
+        Replicates ``key`` across ``replicas`` nodes.
+
+        Replicas are only populated by subsequent writes, so this is best
+        suited to keys which are rewritten regularly (such as cached values).
+        """
+        self._replicated_keys[key] = replicas or self.replicas
+
+    def unreplicate_key(self, key):
+        self._replicated_keys.pop(key, None)
+
+    def get_replicated_keys(self):
+        """
+        Returns a dictionary mapping replicated keys to their number of nodes.
+        """
+        return dict(self._replicated_keys)
+
+    def replicate_hot_keys(self, limit=10, replicas=None, min_count=0):
+        """
+        Replicates the ``limit`` hottest keys of the last complete window seen
+        by the router's hot key sampler, replacing any keys previously
+        replicated this way.
+        """
+        assert self.sampler is not None, 'hot key sampling must be enabled to replicate hot keys'
+
+        for key in self._hot_replicated_keys:
+            self.unreplicate_key(key)
+
+        self._hot_replicated_keys = []
+        for key, db_num, count in self.sampler.get_last_hot_keys(limit):
+            if count >= min_count and key not in self._replicated_keys:
+                self.replicate_key(key, replicas)
+                self._hot_replicated_keys.append(key)
+        return self._hot_replicated_keys
+
     def mark_connection_down(self, db_num):
         db_num = self.ensure_db_num(db_num)
+        if db_num not in self._db_num_id_map:
+            # the host has been removed from the cluster
+            return
         self._hash.remove_node(self._db_num_id_map[db_num])
 
         super(ConsistentHashingRouter, self).mark_connection_down(db_num)
 
     def mark_connection_up(self, db_num):
         db_num = self.ensure_db_num(db_num)
-        self._hash.add_node(self._db_num_id_map[db_num])
+        if db_num in self._db_num_id_map:
+            self._hash.add_node(self._db_num_id_map[db_num], self.cluster.hosts[db_num].weight)
 
         super(ConsistentHashingRouter, self).mark_connection_up(db_num)
 
+    def add_host(self, db_num, host):
+        """
+        Adds the points of ``host`` to the ring, leaving every other node's
+        points (and the keys routed to them) in place.
+        """
+        if self._ready:
+            self._db_num_id_map[db_num] = self.get_node_name(host)
+            self._hash.add_node(self._db_num_id_map[db_num], host.weight)
+
+        super(ConsistentHashingRouter, self).add_host(db_num, host)
+
+    def remove_host(self, db_num, host):
+        if self._ready and db_num in self._db_num_id_map:
+            self._hash.remove_node(self._db_num_id_map.pop(db_num))
+
+        super(ConsistentHashingRouter, self).remove_host(db_num, host)
+
+    def get_node_name(self, host):
+        """
+        Returns the name of ``host`` on the ring.
+        """
+        if self.libmemcached_compat:
+            return '%s:%s' % (host.host, host.port)
+        return host.identifier
+
     @routing_params
     def _setup_router(self, args, kwargs, **fkwargs):
-        self._db_num_id_map = dict([(db_num, host.identifier) for db_num, host in self.cluster.hosts.iteritems()])
-        self._hash = Ketama(self._db_num_id_map.values())
+        self._db_num_id_map = dict([(db_num, self.get_node_name(host))
+                                    for db_num, host in self.cluster.hosts.iteritems()])
+        weights = dict((self._db_num_id_map[db_num], host.weight)
+                       for db_num, host in self.cluster.hosts.iteritems())
+        if self.libmemcached_compat:
+            self._hash = LibmemcachedKetama(self._db_num_id_map.values(), weights=weights)
+        else:
+            self._hash = Ketama(self._db_num_id_map.values(), weights=weights)
 
         return True
 
@@ -62,29 +159,62 @@ class ConsistentHashingRouter(RoundRobinRouter):
 
         return super(ConsistentHashingRouter, self)._pre_routing(*args, **kwargs)
 
+    def get_routing_key(self, attr, args, kwargs):
+        return self.get_command_spec(attr).get_key(args, kwargs)
+
     @routing_params
     def _route(self, attr, args, kwargs, **fkwargs):
         """
-        The first argument is assumed to be the ``key`` for routing.
+        Routes on the first key of the command, or to all hosts if it does not
+        take any keys.
         """
-
-        key = get_key(args, kwargs)
-
-        found = self._hash.get_node(key)
+        command = self.get_command_spec(attr)
+        keys = command.get_keys(args, kwargs)
+        if keys:
+            key = keys[0]
+        else:
+            key = command.get_fallback_key(args, kwargs)
+            if key is None:
+                return self.cluster.hosts.keys()
+
+        replicas = None
+        if self._replicated_keys:
+            try:
+                replicas = self._replicated_keys.get(key)
+            except TypeError:
+                pass
+
+        if replicas:
+            found = self._hash.get_nodes(key, replicas)
+            # reads of other keys may not be replicated, so they are only
+            # served by the key's own node
+            if found and command.read:
+                found = [random.choice(found)] if len(keys) == 1 else found[:1]
+        else:
+            found = self._hash.get_node(key)
+            found = [found] if found else []
 
         if not found and len(self._down_connections) > 0:
             raise self.HostListExhausted()
 
-        return [i for i, h in self.cluster.hosts.iteritems()
-                if h.identifier == found]
+        return [i for i, node in self._db_num_id_map.iteritems()
+                if node in found]
 
 
 class PartitionRouter(BaseRouter):
+    def get_routing_key(self, attr, args, kwargs):
+        return self.get_command_spec(attr).get_key(args, kwargs)
+
     @routing_params
     def _route(self, attr, args, kwargs, **fkwargs):
         """
-        The first argument is assumed to be the ``key`` for routing.
+        Routes on the first key of the command, or to all hosts if it does not
+        take any keys.
         """
-        key = get_key(args, kwargs)
+        key = self.get_routing_key(attr, args, kwargs)
+        if key is None:
+            key = self.get_command_spec(attr).get_fallback_key(args, kwargs)
+        if key is None:
+            return self.cluster.hosts.keys()
 
         return [crc32(str(key)) % len(self.cluster)]
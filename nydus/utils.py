@@ -1,6 +1,7 @@
 from collections import defaultdict
-from Queue import Queue, Empty
-from threading import Thread
+from itertools import islice
+from Queue import Queue, Empty, Full
+from threading import Event, Thread
 
 
 # import_string comes form Werkzeug
@@ -46,6 +47,75 @@ def peek(value):
     yield prev, None
 
 
+def chunks(iterable, size):
+    """
+    Yields lists of at most ``size`` items from ``iterable``.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def iter_parallel(iterables, buffer_size=None):
+    """
+    Consumes each of ``iterables`` within its own thread, and yields their
+    items (in no particular order) as they become available.
+
+    At most ``buffer_size`` items (by default, one per iterable) are buffered
+    at any time, so producers never run far ahead of the consumer. Any
+    exception raised by an iterable is re-raised to the consumer.
+    """
+    iterables = list(iterables)
+    queue = Queue(buffer_size or len(iterables) or 1)
+    stopped = Event()
+
+    def put(message):
+        while not stopped.is_set():
+            try:
+                queue.put(message, timeout=0.1)
+            except Full:
+                continue
+            return True
+        return False
+
+    def produce(iterable):
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+        except Exception as e:
+            put((False, e))
+        else:
+            put((False, None))
+
+    for iterable in iterables:
+        thread = Thread(target=produce, args=(iterable,))
+        thread.daemon = True
+        thread.start()
+
+    remaining = len(iterables)
+    try:
+        while remaining:
+            is_item, value = queue.get()
+            if is_item:
+                yield value
+            elif value is not None:
+                raise value
+            else:
+                remaining -= 1
+    finally:
+        # unblock any producers if we stopped consuming early
+        stopped.set()
+        while True:
+            try:
+                queue.get_nowait()
+            except Empty:
+                break
+
+
 class Worker(Thread):
     def __init__(self, queue):
         Thread.__init__(self)
@@ -54,11 +124,13 @@ class Worker(Thread):
 
     def run(self):
         while True:
-            try:
-                ident, func, args, kwargs = self.queue.get_nowait()
-            except Empty:
+            task = self.queue.get()
+            # a task of None tells the worker there is no more work coming
+            if task is None:
+                self.queue.task_done()
                 break
 
+            ident, func, args, kwargs = task
             try:
                 result = func(*args, **kwargs)
                 self.results[ident].append(result)
@@ -75,9 +147,21 @@ class ThreadPool(object):
         self.queue = Queue()
         self.workers = []
         self.tasks = []
+        self.started = False
         for worker in xrange(workers):
             self.workers.append(Worker(self.queue))
 
+    def start(self):
+        """
+        Starts the workers, so that tasks are executed as soon as they are
+        added rather than once ``join`` is called.
+        """
+        if self.started:
+            return
+        self.started = True
+        for worker in self.workers:
+            worker.start()
+
     def add(self, ident, func, args=None, kwargs=None):
         if args is None:
             args = ()
@@ -89,7 +173,8 @@ class ThreadPool(object):
 
     def join(self):
         for worker in self.workers:
-            worker.start()
+            self.queue.put_nowait(None)
+        self.start()
 
         results = defaultdict(list)
         for worker in self.workers:
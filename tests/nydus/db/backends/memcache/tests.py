@@ -2,8 +2,8 @@ from __future__ import absolute_import
 
 from nydus.db import create_cluster
 from nydus.db.base import BaseCluster
-from nydus.db.backends.memcache import Memcache, regroup_commands, grouped_args_for_command, \
-  can_group_commands
+from nydus.db.backends.memcache import Memcache, MemcacheCluster, MemcacheServers, regroup_commands, \
+  grouped_args_for_command, can_group_commands
 from nydus.db.promise import EventualCommand
 from nydus.testutils import BaseTest, fixture
 
@@ -255,3 +255,120 @@ class MemcacheTest(BaseTest):
         self.assertEquals(len(results), 6, results)
         self.assertEquals(results[0:3], [None, None, None])
         self.assertEquals(results[3:6], [1, 2, 3])
+
+    @mock.patch('pylibmc.Client')
+    def test_pipeline_noreply(self, Client):
+        client = Client.return_value
+        client.get_multi.return_value = {'c': 3}
+        client.get_behaviors.return_value = {'_noreply': 0}
+        cluster = create_cluster({
+            'engine': 'nydus.db.backends.memcache.Memcache',
+            'hosts': {
+                0: {'binary': True},
+            }
+        })
+
+        with cluster.map(noreply=True) as conn:
+            conn.set('a', 1)
+            conn.set('b', 2)
+            conn.get('c')
+            conn.get('d')
+            conn.delete('a')
+
+        # quiet writes share the client of the reads, which keeps them in order
+        self.assertEquals(client.mock_calls, [
+            mock.call.get_behaviors(),
+            mock.call.set_behaviors({'_noreply': True}),
+            mock.call.set_multi({'a': 1, 'b': 2}),
+            mock.call.set_behaviors({'_noreply': False}),
+            mock.call.get_multi(['c', 'd']),
+            mock.call.get_behaviors(),
+            mock.call.set_behaviors({'_noreply': True}),
+            mock.call.delete('a'),
+            mock.call.set_behaviors({'_noreply': False}),
+        ])
+        self.assertFalse(client.clone.called)
+        self.assertEquals(conn.get_results(), [None, None, 3, None, None])
+
+    @mock.patch('pylibmc.Client')
+    def test_noreply_restores_behaviors(self, Client):
+        Client.return_value.get_behaviors.return_value = {'_noreply': 0}
+        memcache = Memcache(num=0)
+        with self.assertRaises(ValueError):
+            with memcache.noreply() as client:
+                raise ValueError
+        self.assertTrue(client is Client.return_value)
+        client.set_behaviors.assert_called_with({'_noreply': False})
+
+    @mock.patch('pylibmc.Client')
+    def test_noreply_restores_previous_behavior_when_nested(self, Client):
+        behaviors = {'_noreply': 0}
+        client = Client.return_value
+        client.get_behaviors.side_effect = lambda: dict(behaviors)
+        client.set_behaviors.side_effect = behaviors.update
+        memcache = Memcache(num=0)
+        with memcache.noreply():
+            with memcache.noreply():
+                pass
+            self.assertEquals(behaviors, {'_noreply': True})
+        self.assertEquals(behaviors, {'_noreply': False})
+
+
+class MemcacheClusterTest(BaseTest):
+    def get_cluster(self, **settings):
+        return create_cluster(dict({
+            'backend': 'nydus.db.backends.memcache.Memcache',
+            'router': 'nydus.db.routers.keyvalue.ConsistentHashingRouter',
+            'hosts': {
+                0: {'host': '10.0.1.1'},
+                1: {'host': '10.0.1.2', 'port': 11212, 'weight': 2},
+            },
+        }, **settings))
+
+    def test_routes_to_each_host_by_default(self):
+        cluster = self.get_cluster()
+        self.assertTrue(isinstance(cluster, MemcacheCluster))
+        self.assertEquals(len(cluster), 2)
+        self.assertEquals(cluster[1].weight, 2)
+
+    @mock.patch('pylibmc.Client')
+    def test_native_uses_a_single_client(self, Client):
+        cluster = self.get_cluster(native=True, defaults={'binary': False})
+        self.assertEquals(len(cluster), 1)
+        self.assertTrue(isinstance(cluster[0], MemcacheServers))
+
+        result = cluster.get_multi(['a', 'b', 'c', 'd'])
+        self.assertEquals(result, Client.return_value.get_multi.return_value)
+        Client.return_value.get_multi.assert_called_once_with(['a', 'b', 'c', 'd'])
+        Client.assert_called_once_with(['10.0.1.1:11211:1', '10.0.1.2:11212:2'], binary=False,
+                                       behaviors={'ketama_weighted': True})
+
+    @mock.patch('pylibmc.Client')
+    def test_native_pipeline(self, Client):
+        cluster = self.get_cluster(native=True)
+        with cluster.map() as conn:
+            conn.get('a')
+            conn.get('b')
+            conn.get('c')
+        Client.return_value.get_multi.assert_called_once_with(['a', 'b', 'c'])
+
+    def test_native_hosts_are_fixed(self):
+        cluster = self.get_cluster(native=True)
+        self.assertRaises(ValueError, cluster.add_host, 2, {'host': '10.0.1.3'})
+        self.assertRaises(ValueError, cluster.remove_host, 0)
+
+    @mock.patch('pylibmc.Client')
+    def test_native_scales_fractional_weights(self, Client):
+        cluster = self.get_cluster(native=True, hosts={
+            0: {'host': '10.0.1.1', 'weight': 1.5},
+            1: {'host': '10.0.1.2', 'weight': 0.25},
+        })
+        cluster.get('a')
+        Client.assert_called_once_with(['10.0.1.1:11211:6', '10.0.1.2:11211:1'], binary=True,
+                                       behaviors={'ketama_weighted': True})
+
+    def test_native_rejects_invalid_weights(self):
+        for weight in (0, -1, 'heavy', None, float('inf')):
+            self.assertRaises(ValueError, self.get_cluster, native=True, hosts={
+                0: {'host': '10.0.1.1', 'weight': weight},
+            })
@@ -2,11 +2,14 @@ from __future__ import absolute_import
 
 from nydus.db import create_cluster
 from nydus.db.base import BaseCluster
-from nydus.db.backends.redis import Redis
+from nydus.db.backends.redis import AutoPipeline, Redis, RedisCluster
 from nydus.db.promise import EventualCommand
 from nydus.testutils import BaseTest, fixture
+import hashlib
 import mock
 import redis as redis_
+import threading
+import time
 
 
 class RedisPipelineTest(BaseTest):
@@ -95,14 +98,14 @@ class RedisTest(BaseTest):
         self.assertFalse(RedisClient().set.called)
 
         self.assertEquals(RedisClient().pipeline.call_count, 2)
-        RedisClient().pipeline.assert_called_with()
+        RedisClient().pipeline.assert_called_with(transaction=False)
 
         self.assertEquals(RedisClient().pipeline().set.call_count, 2)
         RedisClient().pipeline().set.assert_any_call('a', 0)
         RedisClient().pipeline().set.assert_any_call('d', 1)
 
         self.assertEquals(RedisClient().pipeline().execute.call_count, 2)
-        RedisClient().pipeline().execute.assert_called_with()
+        RedisClient().pipeline().execute.assert_called_with(raise_on_error=False)
 
     @mock.patch('nydus.db.backends.redis.StrictRedis')
     def test_map_only_runs_on_required_nodes(self, RedisClient):
@@ -122,14 +125,14 @@ class RedisTest(BaseTest):
         self.assertFalse(RedisClient().set.called)
 
         self.assertEquals(RedisClient().pipeline.call_count, 1)
-        RedisClient().pipeline.assert_called_with()
+        RedisClient().pipeline.assert_called_with(transaction=False)
 
         self.assertEquals(RedisClient().pipeline().set.call_count, 2)
         RedisClient().pipeline().set.assert_any_call('a', 0)
         RedisClient().pipeline().set.assert_any_call('b', 1)
 
         self.assertEquals(RedisClient().pipeline().execute.call_count, 1)
-        RedisClient().pipeline().execute.assert_called_with()
+        RedisClient().pipeline().execute.assert_called_with(raise_on_error=False)
 
     def test_normal_exceptions_dont_break_the_cluster(self):
         redis = create_cluster({
@@ -166,3 +169,390 @@ class RedisTest(BaseTest):
         for idx in cluster_config['hosts'].keys():
             self.assertEquals(redis.hosts[idx].identifier,
                               cluster_config['hosts'][idx]['identifier'])
+
+
+class FakePipeline(object):
+    """
+    Records commands and answers each with its name and arguments.
+    """
+    def __init__(self):
+        self.queued = []
+        self.executions = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.queued.append((name,) + args)
+        return queue
+
+    def execute(self, **kwargs):
+        self.executions.append(kwargs)
+        results, self.queued = self.queued, []
+        return [ValueError(r) if r[0] == 'fail' else r for r in results]
+
+
+class AutoPipelineTest(BaseTest):
+    def setUp(self):
+        self.pipes = []
+        patcher = mock.patch('nydus.db.backends.redis.StrictRedis')
+        self.RedisClient = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.RedisClient.return_value.pipeline.side_effect = self.create_pipeline
+
+    def create_pipeline(self, *args, **kwargs):
+        pipe = FakePipeline()
+        self.pipes.append(pipe)
+        return pipe
+
+    def get_cluster(self, **kwargs):
+        settings = {
+            'backend': 'nydus.db.backends.redis.Redis',
+            'router': 'nydus.db.routers.keyvalue.PartitionRouter',
+            'hosts': {
+                0: {'db': 0},
+            },
+            'auto_pipeline': True,
+        }
+        settings.update(kwargs)
+        return create_cluster(settings)
+
+    def test_uses_redis_cluster(self):
+        self.assertTrue(isinstance(self.get_cluster(), RedisCluster))
+
+    def test_single_command_goes_through_pipeline(self):
+        cluster = self.get_cluster()
+        self.assertEquals(cluster.get('a'), ('get', 'a'))
+        self.assertFalse(self.RedisClient.return_value.get.called)
+        self.assertEquals(len(self.pipes), 1)
+        self.assertEquals(self.pipes[0].executions, [{'raise_on_error': False}])
+
+    def test_disabled_by_default(self):
+        cluster = self.get_cluster(auto_pipeline=False)
+        cluster.get('a')
+        self.RedisClient.return_value.get.assert_called_once_with('a')
+        self.assertEquals(self.pipes, [])
+
+    def test_unpipelined_commands_are_called_directly(self):
+        cluster = self.get_cluster()
+        cluster.blpop('a')
+        self.RedisClient.return_value.blpop.assert_called_once_with('a')
+        self.assertEquals(self.pipes, [])
+
+    def test_client_helpers_are_called_directly(self):
+        cluster = self.get_cluster()
+        client = self.RedisClient.return_value
+        for name in ('register_script', 'lock', 'pubsub', 'transaction'):
+            self.assertEquals(cluster.execute(name, ('a',), {}), getattr(client, name).return_value)
+            getattr(client, name).assert_called_once_with('a')
+        self.assertEquals(self.pipes, [])
+
+    def test_concurrent_commands_share_a_pipeline(self):
+        cluster = self.get_cluster(auto_pipeline_window=5, auto_pipeline_size=3)
+        results = {}
+
+        def run(key):
+            results[key] = cluster.get(key)
+
+        threads = [threading.Thread(target=run, args=(k,)) for k in ('a', 'b', 'c')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(results, {
+            'a': ('get', 'a'),
+            'b': ('get', 'b'),
+            'c': ('get', 'c'),
+        })
+        self.assertEquals(len(self.pipes), 1)
+        self.assertEquals(len(self.pipes[0].executions), 1)
+
+    def test_auto_pipelines_reset_after_fork(self):
+        cluster = self.get_cluster()
+        pipelines = cluster._auto_pipelines
+        cluster.get('a')
+        self.assertTrue(cluster._auto_pipelines is pipelines)
+
+        with mock.patch('nydus.db.backends.redis.os.getpid', return_value=-1):
+            self.assertEquals(cluster.get('a'), ('get', 'a'))
+        self.assertFalse(cluster._auto_pipelines is pipelines)
+
+    def test_errors_only_affect_their_caller(self):
+        pipeline = AutoPipeline(Redis(num=0), max_commands=2, window=5)
+        results = {}
+
+        def run(name):
+            try:
+                results[name] = pipeline.execute(name, ('a',), {})
+            except ValueError as e:
+                results[name] = e
+
+        threads = [threading.Thread(target=run, args=(n,)) for n in ('get', 'fail')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(results['get'], ('get', 'a'))
+        self.assertTrue(isinstance(results['fail'], ValueError))
+
+
+class MapTransactionTest(BaseTest):
+    @fixture
+    def cluster(self):
+        return create_cluster({
+            'backend': 'nydus.db.backends.redis.Redis',
+            'router': 'nydus.db.routers.keyvalue.PartitionRouter',
+            'hosts': {
+                0: {'db': 0},
+            },
+        })
+
+    @mock.patch('nydus.db.backends.redis.StrictRedis')
+    def test_map_is_not_transactional_by_default(self, RedisClient):
+        with self.cluster.map() as conn:
+            conn.set('a', 0)
+            conn.set('b', 1)
+
+        RedisClient().pipeline.assert_called_once_with(transaction=False)
+
+    @mock.patch('nydus.db.backends.redis.StrictRedis')
+    def test_map_with_transaction(self, RedisClient):
+        with self.cluster.map(transaction=True) as conn:
+            conn.set('a', 0)
+            conn.set('b', 1)
+
+        RedisClient().pipeline.assert_called_once_with(transaction=True)
+
+    @mock.patch('nydus.db.backends.redis.StrictRedis')
+    def test_map_ignores_noreply(self, RedisClient):
+        with self.cluster.map(noreply=True) as conn:
+            conn.set('a', 0)
+            conn.set('b', 1)
+
+        RedisClient().pipeline.assert_called_once_with(transaction=False)
+
+
+class RedisScriptTest(BaseTest):
+    lua = "return redis.call('incrby', KEYS[1], ARGV[1])"
+
+    def setUp(self):
+        patcher = mock.patch('nydus.db.backends.redis.StrictRedis')
+        self.RedisClient = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = self.RedisClient.return_value
+
+        self.cluster = create_cluster({
+            'backend': 'nydus.db.backends.redis.Redis',
+            'router': 'nydus.db.routers.keyvalue.PartitionRouter',
+            'hosts': {
+                0: {'db': 0},
+                1: {'db': 1},
+            },
+        })
+        self.script = self.cluster.register_script('incrby', self.lua)
+
+    def test_registers_script(self):
+        self.assertEquals(self.cluster.scripts, {'incrby': self.script})
+        self.assertEquals(self.script.sha, hashlib.sha1(self.lua).hexdigest())
+
+    def test_loads_script_once_per_node(self):
+        self.script(keys=['a'], args=[1])
+        self.script(keys=['a'], args=[2])
+
+        self.client.script_load.assert_called_once_with(self.lua)
+        self.client.evalsha.assert_called_with(self.script.sha, 1, 'a', 2)
+
+    def test_routes_on_first_key(self):
+        with mock.patch.object(self.cluster.router, '_route', return_value=[1]) as _route:
+            self.script(keys=['a', 'b'], args=[1])
+
+        _route.assert_called_once_with(attr='evalsha', args=(self.script.sha, 2, 'a', 'b', 1), kwargs={})
+
+    def test_reloads_script_on_noscript(self):
+        self.client.evalsha.side_effect = [redis_.exceptions.NoScriptError(), 5]
+
+        self.assertEquals(self.script(keys=['a'], args=[1]), 5)
+        self.assertEquals(self.client.script_load.call_count, 2)
+
+    def test_runs_within_map(self):
+        pipe = self.client.pipeline.return_value
+        pipe.execute.side_effect = [[redis_.exceptions.NoScriptError(), 2], [5]]
+
+        with self.cluster.map() as conn:
+            first = self.script(keys=['a'], args=[1], client=conn)
+            second = self.script(keys=['a'], args=[2], client=conn)
+
+        self.assertEquals(first, 5)
+        self.assertEquals(second, 2)
+        pipe.evalsha.assert_any_call(self.script.sha, 1, 'a', 1)
+        pipe.evalsha.assert_any_call(self.script.sha, 1, 'a', 2)
+        self.assertEquals(self.client.script_load.call_count, 2)
+
+    def test_added_hosts_receive_scripts(self):
+        conn = self.cluster.add_host(2, {'db': 2})
+        self.assertEquals(conn.scripts, {self.script.sha: self.script})
+        self.assertEquals(conn.db, 2)
+
+
+class ScanTest(BaseTest):
+    def setUp(self):
+        self.clients = {}
+        patcher = mock.patch('nydus.db.backends.redis.StrictRedis')
+        RedisClient = patcher.start()
+        self.addCleanup(patcher.stop)
+        RedisClient.side_effect = lambda **kwargs: self.clients.setdefault(kwargs['db'], mock.Mock())
+
+        self.cluster = create_cluster({
+            'backend': 'nydus.db.backends.redis.Redis',
+            'router': 'nydus.db.routers.keyvalue.PartitionRouter',
+            'hosts': {
+                0: {'db': 0},
+                1: {'db': 1},
+            },
+        })
+        for num in self.cluster:
+            self.cluster[num].connection
+
+    def test_scan_iter_walks_every_node(self):
+        self.clients[0].scan.side_effect = [(5, ['a', 'b']), (0, ['c'])]
+        self.clients[1].scan.side_effect = [(0, ['d'])]
+
+        keys = self.cluster.scan_iter(match='*', count=10)
+        self.assertEquals(sorted(keys), ['a', 'b', 'c', 'd'])
+
+        self.clients[0].scan.assert_any_call(0, match='*', count=10)
+        self.clients[0].scan.assert_any_call(5, match='*', count=10)
+        self.clients[1].scan.assert_called_once_with(0, match='*', count=10)
+
+    def test_scan_iter_propagates_errors(self):
+        self.clients[0].scan.side_effect = redis_.ConnectionError()
+        self.clients[1].scan.return_value = (0, [])
+
+        with self.assertRaises(redis_.ConnectionError):
+            list(self.cluster.scan_iter())
+
+    def test_hscan_iter_uses_node_owning_key(self):
+        with mock.patch.object(self.cluster.router, '_route', return_value=[1]):
+            result = self.cluster.hscan_iter('foo', match='a*')
+
+        self.clients[1].hscan_iter.assert_called_once_with('foo', match='a*', count=None)
+        self.assertEquals(result, self.clients[1].hscan_iter.return_value)
+
+    def test_scan_iters_use_a_single_node_with_base_router(self):
+        cluster = create_cluster({
+            'backend': 'nydus.db.backends.redis.Redis',
+            'hosts': {
+                0: {'db': 0},
+                1: {'db': 1},
+            },
+        })
+        for name in ('hscan_iter', 'sscan_iter', 'zscan_iter'):
+            result = getattr(cluster, name)('foo')
+            self.assertEquals(result, getattr(self.clients[0], name).return_value)
+            self.assertFalse(getattr(self.clients[1], name).called)
+
+
+class ReplicaTest(BaseTest):
+    def setUp(self):
+        self.clients = {}
+        patcher = mock.patch('nydus.db.backends.redis.StrictRedis')
+        RedisClient = patcher.start()
+        self.addCleanup(patcher.stop)
+        RedisClient.side_effect = lambda **kwargs: self.clients.setdefault(kwargs['host'], mock.Mock())
+
+        self.cluster = create_cluster({
+            'backend': 'nydus.db.backends.redis.Redis',
+            'hosts': {
+                0: {
+                    'host': 'primary',
+                    'db': 3,
+                    'replicas': [
+                        {'host': 'replica1', 'weight': 2},
+                        {'host': 'replica2'},
+                    ],
+                },
+            },
+        })
+        self.conn = self.cluster[0]
+
+    def test_replicas_inherit_options(self):
+        replica = self.conn.replicas[0]
+        self.assertEquals(replica.host, 'replica1')
+        self.assertEquals(replica.db, 3)
+        self.assertEquals(replica.weight, 2)
+
+    def test_reads_go_to_replicas(self):
+        with mock.patch('random.uniform', return_value=1):
+            self.cluster.get('foo')
+        self.clients['replica1'].get.assert_called_once_with('foo')
+        self.assertFalse('primary' in self.clients)
+
+    def test_scans_stay_on_the_primary(self):
+        self.clients['primary'] = mock.Mock()
+        self.clients['primary'].scan.side_effect = [(5, ['foo']), (0, ['bar'])]
+        with mock.patch('random.uniform', return_value=1):
+            self.assertEquals(list(self.cluster.scan_iter()), ['foo', 'bar'])
+            self.conn.hscan('foo', 0)
+        self.assertEquals(self.clients['primary'].scan.call_count, 2)
+        self.clients['primary'].hscan.assert_called_once_with('foo', 0)
+        self.assertFalse('replica1' in self.clients)
+
+    def test_replicas_are_chosen_by_weight(self):
+        with mock.patch('random.uniform', return_value=2.5):
+            self.assertEquals(self.conn.get_replica().host, 'replica2')
+        with mock.patch('random.uniform', return_value=2):
+            self.assertEquals(self.conn.get_replica().host, 'replica1')
+
+    def test_postfork_resets_replicas(self):
+        with mock.patch('random.uniform', return_value=1):
+            self.cluster.get('foo')
+        self.cluster.postfork()
+        self.assertEquals(self.conn.replicas[0]._connection, None)
+        self.assertFalse(self.clients['replica1'].connection_pool.disconnect.called)
+
+    def test_warmup_opens_replica_sockets(self):
+        self.cluster.warmup()
+        for host in ('primary', 'replica1', 'replica2'):
+            pool = self.clients[host].connection_pool
+            pool.get_connection.return_value.connect.assert_called_once_with()
+            pool.release.assert_called_once_with(pool.get_connection.return_value)
+
+    def test_warmup_ping(self):
+        self.cluster.warmup(ping=True)
+        self.clients['primary'].ping.assert_called_once_with()
+        self.assertFalse(self.clients['primary'].connection_pool.get_connection.called)
+
+    def test_writes_go_to_primary(self):
+        self.cluster.set('foo', 'bar')
+        self.clients['primary'].set.assert_called_once_with('foo', 'bar')
+
+    def test_falls_back_to_primary_on_failure(self):
+        self.conn.replicas[1].down_until = time.time() + 30
+        self.clients.setdefault('replica1', mock.Mock()).get.side_effect = redis_.ConnectionError()
+
+        self.assertEquals(self.cluster.get('foo'), self.clients['primary'].get.return_value)
+        self.assertTrue(self.conn.replicas[0].down_until > time.time())
+        self.assertEquals(self.conn.get_replica(), None)
+
+    def test_skips_lagging_replicas(self):
+        self.conn.max_replica_lag = 5
+        self.clients.setdefault('replica1', mock.Mock()).info.return_value = {
+            'master_link_status': 'up',
+            'master_last_io_seconds_ago': 10,
+        }
+        self.clients.setdefault('replica2', mock.Mock()).info.return_value = {
+            'master_link_status': 'up',
+            'master_last_io_seconds_ago': 1,
+        }
+        self.assertEquals(self.conn.get_replica().host, 'replica2')
+        self.clients['replica2'].info.assert_called_once_with('replication')
+
+        # the lag is only checked every replica_check_interval
+        self.conn.get_replica()
+        self.assertEquals(self.clients['replica2'].info.call_count, 1)
+
+    def test_skips_replicas_without_link_to_primary(self):
+        self.conn.max_replica_lag = 5
+        for host in ('replica1', 'replica2'):
+            self.clients.setdefault(host, mock.Mock()).info.return_value = {'master_link_status': 'down'}
+        self.assertEquals(self.conn.get_replica(), None)
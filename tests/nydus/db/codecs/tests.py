@@ -0,0 +1,164 @@
+from __future__ import absolute_import
+
+import zlib
+
+from nydus.db import create_cluster
+from nydus.db.backends.base import BaseConnection
+from nydus.db.codecs import Codec, JSONSerializer, PickleSerializer, ZlibCompressor, create_codec
+from nydus.testutils import BaseTest, fixture
+
+
+class DictConnection(BaseConnection):
+    """
+    Stores values in memory, the way a key/value server would.
+    """
+    def __init__(self, num, **kwargs):
+        self.data = {}
+        super(DictConnection, self).__init__(num, **kwargs)
+
+    def set(self, key, value):
+        self.data[key] = value
+        return True
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def mget(self, keys):
+        return [self.data.get(k) for k in keys]
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1)
+        return int(self.data[key])
+
+
+class CodecTest(BaseTest):
+    @fixture
+    def codec(self):
+        return Codec(JSONSerializer(), ZlibCompressor(), compress_threshold=10)
+
+    def test_round_trip(self):
+        value = {'foo': [1, 2, 3]}
+        self.assertEquals(self.codec.decode(self.codec.encode(value)), value)
+
+    def test_compresses_above_threshold(self):
+        value = u'a' * 100
+        data = self.codec.encode(value)
+        self.assertEquals(data[0], Codec.COMPRESSED)
+        self.assertEquals(zlib.decompress(data[1:]), '"%s"' % value)
+        self.assertEquals(self.codec.decode(data), value)
+
+    def test_does_not_compress_below_threshold(self):
+        self.assertEquals(self.codec.encode(u'a'), Codec.SERIALIZED + '"a"')
+
+    def test_passes_through_unencoded_values(self):
+        self.assertEquals(self.codec.decode('5'), '5')
+        self.assertEquals(self.codec.decode(None), None)
+        self.assertEquals(self.codec.decode(5), 5)
+
+    def test_stores_integers_and_strings_as_they_are(self):
+        self.assertEquals(self.codec.encode(5), 5)
+        self.assertEquals(self.codec.encode('foo'), 'foo')
+        self.assertEquals(self.codec.encode(True), Codec.SERIALIZED + 'true')
+        self.assertEquals(self.codec.stats['encoded'], 1)
+
+    def test_encodes_strings_starting_with_a_flag(self):
+        value = Codec.SERIALIZED + 'foo'
+        data = self.codec.encode(value)
+        self.assertNotEquals(data, value)
+        self.assertEquals(self.codec.decode(data), value)
+
+    def test_passes_through_values_it_cannot_decode(self):
+        self.assertEquals(self.codec.decode(Codec.SERIALIZED + 'foo'), Codec.SERIALIZED + 'foo')
+        self.assertEquals(self.codec.decode(Codec.COMPRESSED + 'foo'), Codec.COMPRESSED + 'foo')
+
+    def test_stats_report_bytes_saved(self):
+        self.codec.encode(u'a' * 100)
+        self.codec.encode(u'a')
+        stats = self.codec.stats
+        self.assertEquals(stats['encoded'], 2)
+        self.assertEquals(stats['compressed'], 1)
+        self.assertEquals(stats['bytes_serialized'], 105)
+        self.assertEquals(stats['bytes_saved'], stats['bytes_serialized'] - stats['bytes_stored'])
+        self.assertTrue(stats['bytes_saved'] > 0)
+
+    def test_encode_command_encodes_value_argument(self):
+        args, kwargs = self.codec.encode_command('setex', ('foo', 10, [1]), {})
+        self.assertEquals(args, ('foo', 10, Codec.SERIALIZED + '[1]'))
+
+    def test_encode_command_encodes_mappings(self):
+        args, kwargs = self.codec.encode_command('mset', ({'foo': [1]},), {})
+        self.assertEquals(args, ({'foo': Codec.SERIALIZED + '[1]'},))
+
+    def test_encode_command_ignores_other_commands(self):
+        self.assertEquals(self.codec.encode_command('incr', ('foo', 1), {}), (('foo', 1), {}))
+
+    def test_decode_result_shapes(self):
+        one = Codec.SERIALIZED + '1'
+        self.assertEquals(self.codec.decode_result('get', one), 1)
+        self.assertEquals(self.codec.decode_result('mget', [one, None]), [1, None])
+        self.assertEquals(self.codec.decode_result('get_multi', {'foo': one}), {'foo': 1})
+        self.assertEquals(self.codec.decode_result('incr', '1'), '1')
+
+
+class CreateCodecTest(BaseTest):
+    def test_from_names(self):
+        codec = create_codec({'serializer': 'json', 'compressor': 'zlib', 'compress_threshold': 5})
+        self.assertTrue(isinstance(codec.serializer, JSONSerializer))
+        self.assertTrue(isinstance(codec.compressor, ZlibCompressor))
+        self.assertEquals(codec.compress_threshold, 5)
+
+    def test_defaults_to_pickle(self):
+        codec = create_codec({})
+        self.assertTrue(isinstance(codec.serializer, PickleSerializer))
+        self.assertEquals(codec.compressor, None)
+
+    def test_from_paths(self):
+        codec = create_codec({'serializer': 'nydus.db.codecs.JSONSerializer'})
+        self.assertTrue(isinstance(codec.serializer, JSONSerializer))
+
+    def test_passes_codecs_through(self):
+        codec = Codec()
+        self.assertEquals(create_codec(codec), codec)
+
+
+class ClusterCodecTest(BaseTest):
+    @fixture
+    def cluster(self):
+        return create_cluster({
+            'backend': DictConnection,
+            'codec': {'serializer': 'json'},
+            'hosts': {
+                0: {},
+            },
+        })
+
+    def test_encodes_and_decodes_values(self):
+        self.cluster.set('foo', {'bar': 1})
+        self.assertEquals(self.cluster[0].data['foo'], Codec.SERIALIZED + '{"bar":1}')
+        self.assertEquals(self.cluster.get('foo'), {'bar': 1})
+
+    def test_map(self):
+        with self.cluster.map() as conn:
+            conn.set('foo', [1])
+            conn.set('bar', [2])
+            foo = conn.get('foo')
+            both = conn.mget(['foo', 'bar'])
+
+        self.assertEquals(foo, [1])
+        self.assertEquals(both, [[1], [2]])
+
+    def test_integers_can_be_incremented(self):
+        self.cluster.set('foo', 5)
+        self.assertEquals(self.cluster.incr('foo'), 6)
+        self.assertEquals(self.cluster.get('foo'), '6')
+
+    def test_accepts_codec_instances(self):
+        codec = Codec(JSONSerializer())
+        cluster = create_cluster({
+            'backend': DictConnection,
+            'codec': codec,
+            'hosts': {
+                0: {},
+            },
+        })
+        self.assertTrue(cluster.codec is codec)
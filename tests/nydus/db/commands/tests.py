@@ -0,0 +1,207 @@
+from __future__ import absolute_import
+
+from nydus.db.backends.base import BaseConnection
+from nydus.db.backends.redis import REDIS_COMMANDS
+from nydus.db.base import BaseCluster
+from nydus.db.commands import Command, CommandTable, KEYS, KEY_LIST, KEY_MAPPING, SCRIPT
+from nydus.db.routers.keyvalue import PartitionRouter
+from nydus.testutils import BaseTest, fixture
+
+
+class CommandTest(BaseTest):
+    def test_single_key(self):
+        command = Command('get')
+        self.assertEquals(command.get_keys(('foo', 'bar'), {}), ['foo'])
+        self.assertEquals(command.get_keys((), {'key': 'foo'}), ['foo'])
+        self.assertEquals(command.get_key((), {}), None)
+
+    def test_keys(self):
+        command = Command('delete', keys=KEYS)
+        self.assertEquals(command.get_keys(('foo', 'bar'), {}), ['foo', 'bar'])
+        self.assertEquals(command.split(('foo', 'bar'), {}, ['bar']), (('bar',), {}))
+
+    def test_key_list(self):
+        command = Command('mget', keys=KEY_LIST)
+        self.assertEquals(command.get_keys((['foo', 'bar'], 'baz'), {}), ['foo', 'bar', 'baz'])
+        self.assertEquals(command.get_keys(('foo', 'bar'), {}), ['foo', 'bar'])
+        self.assertEquals(command.split((['foo', 'bar'], 'baz'), {}, ['bar', 'baz']), ((['bar', 'baz'],), {}))
+
+    def test_key_mapping(self):
+        command = Command('set_multi', keys=KEY_MAPPING)
+        args = ({'foo': 1, 'bar': 2}, 60)
+        self.assertEquals(sorted(command.get_keys(args, {})), ['bar', 'foo'])
+        self.assertEquals(command.split(args, {'key_prefix': 'a'}, ['foo']), (({'foo': 1}, 60), {'key_prefix': 'a'}))
+
+    def test_script(self):
+        command = Command('evalsha', keys=SCRIPT)
+        self.assertEquals(command.get_keys(('sha', 2, 'foo', 'bar', 'baz'), {}), ['foo', 'bar'])
+        self.assertEquals(command.get_key(('sha', 0, 'foo'), {}), None)
+
+    def test_keyless(self):
+        self.assertEquals(Command('keys', keys=None).get_keys(('*',), {}), [])
+
+    def test_splittable(self):
+        self.assertTrue(Command('mget', keys=KEY_LIST, merge='list').splittable)
+        self.assertFalse(Command('sinter', keys=KEY_LIST).splittable)
+        self.assertFalse(Command('get', merge='list').splittable)
+
+    def test_merges(self):
+        parts = [(['foo', 'baz'], [1, 3]), (['bar'], [2])]
+        keys = ['foo', 'bar', 'baz']
+        self.assertEquals(Command('mget', merge='list').merge(keys, parts), [1, 2, 3])
+        self.assertEquals(Command('delete', merge='sum').merge(keys, [([], 1), ([], 2)]), 3)
+        self.assertEquals(Command('mset', merge='all').merge(keys, [([], True), ([], False)]), False)
+        self.assertEquals(Command('get_multi', merge='dict').merge(keys, [([], {'foo': 1}), ([], {'bar': 2})]),
+                          {'foo': 1, 'bar': 2})
+        self.assertEquals(Command('set_multi', merge='concat').merge(keys, [([], ['foo']), ([], ['bar'])]),
+                          ['foo', 'bar'])
+
+    def test_counter_amount(self):
+        command = Command('decr', counter='incrby', sign=-1)
+        self.assertEquals(command.get_amount(('foo',), {}), -1)
+        self.assertEquals(command.get_amount(('foo', 2), {}), -2)
+        self.assertEquals(command.get_amount(('foo',), {'amount': 3}), -3)
+        self.assertEquals(command.get_amount(('foo', '2'), {}), None)
+        self.assertEquals(command.get_amount(('foo', 2), {'amount': 3}), None)
+        self.assertEquals(Command('incr').get_amount(('foo',), {}), None)
+
+    def test_replaced_key(self):
+        command = Command('set', replaces=True, unless={'nx': 4})
+        self.assertEquals(command.get_replaced_key(('foo', 'bar'), {}), 'foo')
+        self.assertEquals(command.get_replaced_key(('foo', 'bar'), {'nx': True}), None)
+        self.assertEquals(command.get_replaced_key(('foo', 'bar', None, None, True), {}), None)
+        self.assertEquals(Command('delete', keys=KEYS, replaces=(1, 0)).get_replaced_key(('foo', 'bar'), {}), None)
+        self.assertEquals(Command('get').get_replaced_key(('foo',), {}), None)
+
+
+class CommandTableTest(BaseTest):
+    def test_undescribed_commands_take_a_key(self):
+        command = CommandTable()['incr']
+        self.assertEquals(command.name, 'incr')
+        self.assertEquals(command.get_keys(('foo', 1), {}), ['foo'])
+        self.assertFalse(command.read)
+
+    def test_redis_commands(self):
+        self.assertTrue(REDIS_COMMANDS['get'].read)
+        self.assertFalse(REDIS_COMMANDS['set'].read)
+        self.assertEquals(REDIS_COMMANDS['eval'].get_keys(('return 1', 1, 'foo'), {}), ['foo'])
+        self.assertEquals(REDIS_COMMANDS['keys'].get_keys(('*',), {}), [])
+        self.assertTrue(REDIS_COMMANDS['mget'].splittable)
+        self.assertTrue(REDIS_COMMANDS['exists'].splittable)
+        self.assertEquals(REDIS_COMMANDS['exists'].get_keys(('foo', 'bar'), {}), ['foo', 'bar'])
+        self.assertFalse(REDIS_COMMANDS['msetnx'].splittable)
+
+
+class KeyValueConnection(BaseConnection):
+    commands = CommandTable([
+        Command('get', read=True),
+        Command('mget', keys=KEY_LIST, read=True, merge='list'),
+        Command('delete', keys=KEYS, merge='sum'),
+        Command('mset', keys=KEY_MAPPING, merge='all'),
+        REDIS_COMMANDS['exists'],
+    ])
+
+    def __init__(self, num, **kwargs):
+        self.data = {}
+        self.calls = []
+        super(KeyValueConnection, self).__init__(num, **kwargs)
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def mget(self, keys):
+        self.calls.append(('mget', keys))
+        return [self.data.get(k) for k in keys]
+
+    def mset(self, mapping):
+        self.calls.append(('mset', mapping))
+        self.data.update(mapping)
+        return True
+
+    def delete(self, *keys):
+        self.calls.append(('delete', keys))
+        return len([self.data.pop(k) for k in keys if k in self.data])
+
+    def exists(self, *keys):
+        self.calls.append(('exists', keys))
+        return len([k for k in keys if k in self.data])
+
+
+class SplitCommandTest(BaseTest):
+    @fixture
+    def cluster(self):
+        return BaseCluster(
+            backend=KeyValueConnection,
+            router=PartitionRouter,
+            hosts=dict((n, {}) for n in xrange(3)),
+        )
+
+    @fixture
+    def keys(self):
+        return ['key:%d' % n for n in xrange(10)]
+
+    def get_db(self, key):
+        return self.cluster.router.get_dbs(attr='get', args=(key,))[0]
+
+    def test_split_command(self):
+        parts = self.cluster.router.split_command('mget', (self.keys,), {})
+        self.assertTrue(len(parts) > 1)
+        for db_num, args, kwargs, keys in parts:
+            self.assertEquals(args, (keys,))
+            for key in keys:
+                self.assertEquals(self.get_db(key), db_num)
+        self.assertEquals(sorted(k for _, _, _, keys in parts for k in keys), sorted(self.keys))
+
+    def test_single_database_is_not_split(self):
+        self.assertEquals(self.cluster.router.split_command('mget', (['key:1'],), {}), None)
+        self.assertEquals(self.cluster.router.split_command('get', ('key:1',), {}), None)
+
+    def test_map_splits_commands(self):
+        with self.cluster.map() as conn:
+            stored = conn.mset(dict((k, k.upper()) for k in self.keys))
+
+        self.assertEquals(stored, True)
+        for key in self.keys:
+            self.assertEquals(self.cluster[self.get_db(key)].data[key], key.upper())
+
+        with self.cluster.map() as conn:
+            values = conn.mget(self.keys + ['missing'])
+            deleted = conn.delete(*self.keys[:5])
+
+        self.assertEquals(values, [k.upper() for k in self.keys] + [None])
+        self.assertEquals(deleted, 5)
+
+        # each node only saw its own keys
+        for num in self.cluster:
+            for name, keys in self.cluster[num].calls:
+                for key in keys:
+                    self.assertEquals(self.get_db(key), num)
+
+    def test_execute_splits_commands(self):
+        self.assertEquals(self.cluster.mset(dict((k, k.upper()) for k in self.keys)), True)
+        for key in self.keys:
+            self.assertEquals(self.cluster[self.get_db(key)].data[key], key.upper())
+
+        self.assertEquals(self.cluster.mget(self.keys), [k.upper() for k in self.keys])
+        self.assertEquals(self.cluster.exists(*self.keys[3:7]), 4)
+        self.assertEquals(self.cluster.delete(*self.keys[:5]), 5)
+        self.assertEquals(self.cluster.mget(self.keys[4:6]), [None, 'KEY:5'])
+        self.assertEquals(self.cluster.exists(*self.keys[3:7]), 2)
+
+        for num in self.cluster:
+            for name, keys in self.cluster[num].calls:
+                for key in keys:
+                    self.assertEquals(self.get_db(key), num)
+
+    def test_keyless_scripts_run_on_a_single_node(self):
+        self.cluster.commands = REDIS_COMMANDS
+        db_nums = self.cluster.router.get_dbs(attr='evalsha', args=('sha', 0), kwargs={})
+        self.assertEquals(len(db_nums), 1)
+        self.assertEquals(self.cluster.router.get_dbs(attr='evalsha', args=('sha', 0), kwargs={}), db_nums)
+        self.assertEquals(self.cluster.router.get_dbs(attr='info', args=('memory',), kwargs={}), [0, 1, 2])
+
+    def test_execute_raises_errors_of_any_node(self):
+        db_num = self.get_db(self.keys[0])
+        self.cluster[db_num].mget = lambda keys: 1 / 0
+        with self.assertRaises(ZeroDivisionError):
+            self.cluster.mget(self.keys)
@@ -1,16 +1,21 @@
 from __future__ import absolute_import
 
 import mock
+import threading
+import time
 
 from nydus.db import create_cluster
-from nydus.db.backends.base import BaseConnection
-from nydus.db.base import BaseCluster, create_connection
-from nydus.db.exceptions import CommandError
+from nydus.db.backends.base import BaseConnection, BasePipeline
+from nydus.db.base import BaseCluster, LazyConnectionHandler, create_connection
+from nydus.db.codecs import Codec
+from nydus.db.commands import Command, CommandTable, KEYS
+from nydus.db.exceptions import CommandError, WarmupError
 from nydus.db.routers.base import BaseRouter
+from nydus.db.routers.hotkeys import HotKeySampler
 from nydus.db.routers.keyvalue import get_key
 from nydus.db.promise import EventualCommand
 from nydus.testutils import BaseTest, fixture
-from nydus.utils import apply_defaults
+from nydus.utils import ThreadPool, Worker, apply_defaults, iter_parallel
 
 
 class DummyConnection(BaseConnection):
@@ -93,6 +98,12 @@ class CreateConnectionTest(BaseTest):
         create_connection(conn, 0, ['localhost'], {'foo': 'baz'})
         conn.assert_called_once_with(0, 'localhost', foo='baz')
 
+    def test_weight_is_not_passed_to_connection(self):
+        conn = mock.Mock()
+        create_connection(conn, 0, {'resp': 'bar'}, {'weight': 2})
+        conn.assert_called_once_with(0, resp='bar')
+        self.assertEquals(conn.return_value.weight, 2)
+
 
 class CreateClusterTest(BaseTest):
     def test_creates_cluster(self):
@@ -117,6 +128,234 @@ class CreateClusterTest(BaseTest):
         create_connection.assert_called_once_with(DummyConnection, 0, {'resp': 'bar'}, {'foo': 'baz'})
 
 
+class ClosingConnection(DummyConnection):
+    def disconnect(self):
+        self.disconnected = True
+
+
+class LazyConnectionHandlerTest(BaseTest):
+    def setUp(self):
+        self.conf = {
+            'default': {
+                'backend': ClosingConnection,
+                'hosts': {0: {'resp': 'foo'}},
+            },
+            'other': {
+                'backend': ClosingConnection,
+                'hosts': {0: {'resp': 'bar'}},
+            },
+        }
+        self.conf_callback = mock.Mock(side_effect=lambda: self.conf)
+        self.connections = LazyConnectionHandler(self.conf_callback)
+
+    def test_builds_clusters_once(self):
+        self.assertFalse(self.connections.is_ready())
+        cluster = self.connections['default']
+        self.assertEquals(cluster.foo(), 'foo')
+        self.assertTrue(self.connections.is_ready())
+        self.assertTrue(self.connections['default'] is cluster)
+        self.assertEquals(self.connections['other'].foo(), 'bar')
+        self.assertEquals(self.conf_callback.call_count, 1)
+
+    def test_builds_clusters_once_across_threads(self):
+        results = []
+
+        def worker():
+            results.append(self.connections['default'])
+
+        threads = [threading.Thread(target=worker) for _ in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(len(results), 8)
+        self.assertEquals(len(set(map(id, results))), 1)
+        self.assertEquals(self.conf_callback.call_count, 1)
+
+    def test_reload_keeps_unchanged_clusters(self):
+        default = self.connections['default']
+        other = self.connections['other']
+
+        self.conf['other'] = {
+            'backend': ClosingConnection,
+            'hosts': {0: {'resp': 'baz'}},
+        }
+        self.conf['new'] = self.conf.pop('default')
+
+        self.assertEquals(sorted(self.connections.reload()), ['default', 'new', 'other'])
+        self.assertTrue('default' not in self.connections)
+        self.assertTrue(default[0].disconnected)
+        self.assertTrue(other[0].disconnected)
+        self.assertEquals(self.connections['other'].foo(), 'baz')
+        self.assertEquals(self.connections['new'].foo(), 'foo')
+
+        other = self.connections['other']
+        self.assertEquals(self.connections.reload(), [])
+        self.assertTrue(self.connections['other'] is other)
+        self.assertFalse(hasattr(other[0], 'disconnected'))
+
+    def test_reload_ignores_changes_to_applied_settings(self):
+        cluster = self.connections['default']
+        # changing the dictionary in place is only noticed by reload
+        self.conf['default']['hosts'][0]['resp'] = 'baz'
+        self.assertTrue(self.connections['default'] is cluster)
+        self.assertEquals(self.connections.reload(), ['default'])
+        self.assertEquals(self.connections['default'].foo(), 'baz')
+
+    def test_reload_shares_instances(self):
+        codec, sampler = Codec(), HotKeySampler()
+        self.conf['default'].update(codec=codec, hot_keys=sampler)
+        cluster = self.connections['default']
+        self.assertTrue(cluster.codec is codec)
+        self.assertTrue(cluster.hot_keys is sampler)
+
+        self.assertEquals(self.connections.reload(), [])
+        self.assertTrue(self.connections['default'] is cluster)
+
+        self.conf['default']['codec'] = Codec()
+        self.assertEquals(self.connections.reload(), ['default'])
+        self.assertTrue(self.connections['default'].codec is self.conf['default']['codec'])
+
+
+class SocketConnection(DummyConnection):
+    def __init__(self, num, **kwargs):
+        self.disconnects = 0
+        super(SocketConnection, self).__init__(num, **kwargs)
+
+    def connect(self):
+        return mock.Mock()
+
+    def disconnect(self):
+        self.disconnects += 1
+
+
+class ForkTest(BaseTest):
+    def setUp(self):
+        patcher = mock.patch('nydus.db.backends.base.os.getpid', return_value=100)
+        self.getpid = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.cluster = BaseCluster(
+            backend=SocketConnection,
+            hosts={0: {}, 1: {}},
+        )
+
+    def test_reconnects_after_fork(self):
+        conn = self.cluster[0]
+        parent = conn.connection
+        self.assertTrue(conn.connection is parent)
+
+        self.getpid.return_value = 101
+        child = conn.connection
+        self.assertFalse(child is parent)
+        self.assertTrue(conn.connection is child)
+        self.assertEquals(conn.disconnects, 0)
+
+    def test_close_leaves_inherited_connection_open(self):
+        conn = self.cluster[0]
+        conn.connection
+        self.getpid.return_value = 101
+        conn.close()
+        self.assertEquals(conn.disconnects, 0)
+        self.assertEquals(conn._connection, None)
+
+    def test_prefork_closes_open_connections(self):
+        self.cluster[0].connection
+        self.cluster.prefork()
+        self.assertEquals(self.cluster[0].disconnects, 1)
+        self.assertEquals(self.cluster[0]._connection, None)
+        self.assertEquals(self.cluster[1].disconnects, 0)
+
+    def test_postfork_resets_connections(self):
+        parent = self.cluster[0].connection
+        self.cluster.postfork()
+        self.assertEquals(self.cluster[0].disconnects, 0)
+        self.assertFalse(self.cluster[0].connection is parent)
+
+    def test_handler_postfork_warmup(self):
+        connections = LazyConnectionHandler(lambda: {
+            'default': {'backend': SocketConnection, 'hosts': {0: {}}},
+        })
+        parent = connections['default'][0].connection
+        connections.prefork()
+        self.assertEquals(connections['default'][0].disconnects, 1)
+
+        self.getpid.return_value = 101
+        cluster = connections['default']
+        with mock.patch.object(cluster, 'warmup', wraps=cluster.warmup) as warmup:
+            connections.postfork(warmup=True)
+        warmup.assert_called_once_with()
+        child = cluster[0]._connection
+        self.assertFalse(child is None)
+        self.assertFalse(child is parent)
+
+
+class WarmupConnection(SocketConnection):
+    def __init__(self, num, fail=False, block=None, **kwargs):
+        self.fail = fail
+        self.block = block
+        super(WarmupConnection, self).__init__(num, **kwargs)
+
+    def connect(self):
+        if self.block is not None:
+            self.block.wait()
+        if self.fail:
+            raise ValueError('unreachable')
+        return super(WarmupConnection, self).connect()
+
+
+class WarmupTest(BaseTest):
+    def test_connects_every_host(self):
+        cluster = BaseCluster(backend=WarmupConnection, hosts={0: {}, 1: {}})
+        for parallel in (True, False):
+            times = cluster.warmup(parallel=parallel)
+            self.assertEquals(sorted(times), [0, 1])
+            self.assertTrue(cluster[0]._connection is not None)
+            self.assertTrue(cluster[1]._connection is not None)
+
+    def test_fails_on_unreachable_host(self):
+        cluster = BaseCluster(backend=WarmupConnection, hosts={0: {}, 1: {'fail': True}})
+        for parallel in (True, False):
+            try:
+                cluster.warmup(parallel=parallel)
+            except WarmupError as e:
+                self.assertEquals(e.num, 1)
+                self.assertTrue(isinstance(e.error, ValueError))
+            else:
+                self.fail('WarmupError not raised')
+
+    def test_fails_fast(self):
+        block = threading.Event()
+        self.addCleanup(block.set)
+        cluster = BaseCluster(backend=WarmupConnection, hosts={
+            0: {'block': block},
+            1: {'fail': True},
+        })
+        self.assertRaises(WarmupError, cluster.warmup)
+        self.assertFalse(block.is_set())
+
+    def test_times_out(self):
+        block = threading.Event()
+        self.addCleanup(block.set)
+        cluster = BaseCluster(backend=WarmupConnection, hosts={0: {}, 1: {'block': block}})
+        try:
+            cluster.warmup(timeout=0.01)
+        except WarmupError as e:
+            self.assertEquals(e.num, 1)
+        else:
+            self.fail('WarmupError not raised')
+
+    @mock.patch('nydus.db.base.BaseCluster.warmup')
+    def test_create_cluster_setting(self, warmup):
+        create_cluster({
+            'backend': WarmupConnection,
+            'hosts': {0: {}},
+            'warmup': {'ping': True},
+        })
+        warmup.assert_called_once_with(ping=True)
+
+
 class ClusterTest(BaseTest):
     def test_len_returns_num_backends(self):
         p = BaseCluster(
@@ -132,6 +371,31 @@ class ClusterTest(BaseTest):
         )
         self.assertEquals(p.foo(), 'bar')
 
+    def test_add_host(self):
+        p = BaseCluster(
+            backend=DummyConnection,
+            hosts={0: {'resp': 'bar'}},
+            defaults={'resp': 'baz'},
+        )
+        hosts = p.hosts
+        conn = p.add_host(1, {})
+        self.assertTrue(p[1] is conn)
+        self.assertEquals(conn.resp, 'baz')
+        self.assertEquals(len(p), 2)
+        # the previous mapping is left untouched
+        self.assertEquals(hosts.keys(), [0])
+        self.assertRaises(ValueError, p.add_host, 1, {})
+
+    def test_remove_host(self):
+        p = BaseCluster(
+            backend=DummyConnection,
+            hosts={0: {'resp': 'bar'}, 1: {'resp': 'baz'}},
+        )
+        conn = p.remove_host(1)
+        self.assertEquals(conn.resp, 'baz')
+        self.assertEquals(p.hosts.keys(), [0])
+        self.assertEquals(p.foo(), 'bar')
+
     def test_disconnect(self):
         c = mock.Mock()
         p = BaseCluster(
@@ -224,6 +488,422 @@ class MapTest(BaseTest):
         self.assertEquals(bar, ['foo', 'bar'])
 
 
+class EchoConnection(DummyConnection):
+    def echo(self, value):
+        return value
+
+
+class RawTest(BaseTest):
+    @fixture
+    def cluster(self):
+        return BaseCluster(
+            backend=EchoConnection,
+            hosts={0: {}},
+            codec={'serializer': 'json'},
+        )
+
+    def test_returns_memoryviews(self):
+        value = 'a' * 100
+        result = self.cluster.raw.echo(value)
+        self.assertTrue(isinstance(result, memoryview))
+        self.assertEquals(result.tobytes(), value)
+
+    def test_wraps_nested_results(self):
+        result = self.cluster.raw.echo({'foo': ['bar', 1]})
+        self.assertTrue(isinstance(result['foo'][0], memoryview))
+        self.assertEquals(result['foo'][1], 1)
+
+    def test_accepts_buffers(self):
+        value = memoryview('foobar')[3:]
+        self.assertEquals(self.cluster.raw.echo(value).tobytes(), 'bar')
+        self.assertEquals(self.cluster.raw.echo(bytearray('bar')).tobytes(), 'bar')
+
+    def test_bypasses_codec(self):
+        with mock.patch.object(self.cluster.codec, 'encode_command') as encode_command:
+            self.cluster.raw.echo('foo')
+        self.assertFalse(encode_command.called)
+
+
+class ChunkedMapTest(BaseTest):
+    @fixture
+    def cluster(self):
+        return BaseCluster(
+            backend=EchoConnection,
+            hosts={0: {}},
+        )
+
+    def test_flushes_full_chunks(self):
+        with self.cluster.map(chunk_size=2) as conn:
+            first = conn.echo(1)
+            second = conn.echo(2)
+            self.assertEquals(first, None)
+            third = conn.echo(3)
+            self.assertEquals(first, 1)
+            self.assertEquals(second, 2)
+            self.assertEquals(third, None)
+
+        self.assertEquals(third, 3)
+
+    def test_releases_flushed_commands(self):
+        with self.cluster.map(chunk_size=2) as conn:
+            for n in xrange(5):
+                conn.echo(n)
+            self.assertEquals(len(conn._commands), 1)
+
+    def test_collects_errors_across_chunks(self):
+        with self.assertRaises(CommandError):
+            with self.cluster.map(chunk_size=2) as conn:
+                conn.echo(1)
+                conn.echo()
+                third = conn.echo(3)
+                self.assertEquals(third, None)
+        self.assertEquals(third, 3)
+
+    def test_collects_errors_of_a_single_command_chunk(self):
+        with self.cluster.map(chunk_size=2, fail_silently=True) as conn:
+            conn.echo(1)
+            conn.echo(2)
+            conn.echo()
+        errors = conn.get_errors()
+        self.assertEquals(len(errors), 1)
+        self.assertEquals(errors[0][0], 'echo')
+        self.assertTrue(isinstance(errors[0][1], TypeError))
+
+
+class IMapTest(BaseTest):
+    @fixture
+    def cluster(self):
+        return BaseCluster(
+            backend=EchoConnection,
+            router=DummyRouter,
+            hosts={
+                0: {},
+                1: {},
+            },
+        )
+
+    def test_yields_results_in_order(self):
+        commands = (('echo', (n,)) for n in xrange(10))
+        self.assertEquals(list(self.cluster.imap(commands, chunk_size=3)), range(10))
+
+    def test_accepts_kwargs(self):
+        results = self.cluster.imap([('echo', (), {'value': 'foo'})])
+        self.assertEquals(list(results), ['foo'])
+
+    def test_is_lazy(self):
+        def commands():
+            yield ('echo', (1,))
+            raise AssertionError('consumed beyond the first chunk')
+
+        results = self.cluster.imap(commands(), chunk_size=1)
+        self.assertEquals(results.next(), 1)
+
+    def test_propagates_errors(self):
+        with self.assertRaises(CommandError):
+            list(self.cluster.imap([('echo', ()), ('echo', ())]))
+        with self.assertRaises(CommandError):
+            list(self.cluster.imap([('echo', (1,)), ('echo', (2,)), ('echo', ())], chunk_size=2))
+
+
+class RecordingPipeline(BasePipeline):
+    def execute(self):
+        self.connection.executed.append([c.get_args()[0] for c in self.pending])
+        return dict((c, c.get_args()[0]) for c in self.pending)
+
+
+class PipelinedConnection(EchoConnection):
+    supports_pipelines = True
+    supported_pipeline_options = frozenset(['transaction'])
+
+    def __init__(self, num, **kwargs):
+        self.executed = []
+        self.pipeline_options = []
+        super(PipelinedConnection, self).__init__(num, **kwargs)
+
+    def get_pipeline(self, **options):
+        self.pipeline_options.append(options)
+        return RecordingPipeline(self)
+
+
+class BlockingRouter(BaseRouter):
+    """
+    Waits for the first pipeline to be executed before routing the last key.
+    """
+    def __init__(self, *args, **kwargs):
+        self.executed = threading.Event()
+        self.executed_before_routing = False
+        super(BlockingRouter, self).__init__(*args, **kwargs)
+
+    def get_dbs(self, attr, args, kwargs, **fkwargs):
+        if args == ('last',):
+            self.executed_before_routing = self.executed.wait(1)
+        return [0]
+
+
+class PipelinedMapTest(BaseTest):
+    @fixture
+    def cluster(self):
+        return BaseCluster(
+            backend=PipelinedConnection,
+            hosts={0: {}},
+        )
+
+    def test_sends_pipelines_of_pipeline_size_in_order(self):
+        with self.cluster.map(pipeline_size=2) as conn:
+            results = [conn.echo(n) for n in xrange(5)]
+
+        self.assertEquals(results, range(5))
+        self.assertEquals(self.cluster[0].executed, [[0, 1], [2, 3], [4]])
+
+    def test_single_pipeline_without_pipeline_size(self):
+        with self.cluster.map(pipeline_size=None) as conn:
+            [conn.echo(n) for n in xrange(5)]
+
+        self.assertEquals(self.cluster[0].executed, [range(5)])
+
+    def test_pipelines_are_not_transactional_by_default(self):
+        with self.cluster.map() as conn:
+            [conn.echo(n) for n in xrange(2)]
+
+        self.assertEquals(self.cluster[0].pipeline_options, [{}])
+
+    def test_transaction_per_pipeline(self):
+        with self.cluster.map(transaction=True, pipeline_size=2) as conn:
+            [conn.echo(n) for n in xrange(3)]
+
+        self.assertEquals(self.cluster[0].pipeline_options, [{'transaction': True}] * 2)
+        self.assertEquals(self.cluster[0].executed, [[0, 1], [2]])
+
+    def test_atomic_sends_one_transaction_per_node(self):
+        with self.cluster.map(atomic=True, pipeline_size=2) as conn:
+            [conn.echo(n) for n in xrange(3)]
+
+        self.assertEquals(self.cluster[0].pipeline_options, [{'transaction': True}])
+        self.assertEquals(self.cluster[0].executed, [[0, 1, 2]])
+
+    def test_executes_while_routing(self):
+        self.cluster.install_router(BlockingRouter)
+        router = self.cluster.router
+        original_execute = RecordingPipeline.execute
+
+        def execute(pipe):
+            result = original_execute(pipe)
+            router.executed.set()
+            return result
+
+        with mock.patch.object(RecordingPipeline, 'execute', execute):
+            with self.cluster.map(pipeline_size=1) as conn:
+                conn.echo('first')
+                conn.echo('second')
+                last = conn.echo('last')
+
+        self.assertTrue(router.executed_before_routing)
+        self.assertEquals(last, 'last')
+
+    def test_stops_workers_when_routing_fails(self):
+        def add(pipe, command):
+            raise AttributeError(command.get_name())
+
+        with mock.patch.object(RecordingPipeline, 'add', add):
+            with self.assertRaises(AttributeError):
+                with self.cluster.map() as conn:
+                    conn.echo(1)
+                    conn.bogus_command('c')
+
+        self.assertEquals([t for t in threading.enumerate() if isinstance(t, Worker)], [])
+
+    def test_ignores_unsupported_options(self):
+        with self.cluster.map(noreply=True) as conn:
+            [conn.echo(n) for n in xrange(2)]
+
+        self.assertEquals(self.cluster[0].pipeline_options, [{}])
+
+
+class CountingPipeline(BasePipeline):
+    def execute(self):
+        self.connection.executed.append([c.get_command()[:2] for c in self.pending])
+        results = {}
+        for command in self.pending:
+            try:
+                results[command] = command.clone().resolve(self.connection)
+            except Exception as e:
+                results[command] = e
+        return results
+
+
+class CountingConnection(DummyConnection):
+    supports_pipelines = True
+    commands = CommandTable([
+        Command('incr', counter='incrby'),
+        Command('incrby', counter='incrby'),
+        Command('decr', counter='incrby', sign=-1),
+    ])
+
+    def __init__(self, num, **kwargs):
+        self.counters = {}
+        self.executed = []
+        super(CountingConnection, self).__init__(num, **kwargs)
+
+    def incrby(self, key, amount=1):
+        if isinstance(self.counters.get(key, 0), basestring):
+            raise ValueError(key)
+        self.counters[key] = self.counters.get(key, 0) + amount
+        return self.counters[key]
+
+    incr = incrby
+
+    def decr(self, key, amount=1):
+        return self.incrby(key, -amount)
+
+    def get(self, key):
+        return self.counters.get(key)
+
+    def get_pipeline(self, **options):
+        return CountingPipeline(self)
+
+
+class CounterMapTest(BaseTest):
+    @fixture
+    def cluster(self):
+        return BaseCluster(
+            backend=CountingConnection,
+            hosts={0: {}},
+        )
+
+    def test_merges_counters_on_the_same_key(self):
+        with self.cluster.map() as conn:
+            results = [conn.incr('a'), conn.incr('b'), conn.incrby('a', 5), conn.decr('a', amount=2)]
+
+        self.assertEquals(results, [1, 1, 6, 4])
+        self.assertEquals(self.cluster[0].executed, [[('incrby', ('a', 4)), ('incr', ('b',))]])
+
+    def test_does_not_merge_across_other_commands(self):
+        with self.cluster.map() as conn:
+            results = [conn.incr('a'), conn.get('a'), conn.incr('a'), conn.incr('a')]
+
+        self.assertEquals(results, [1, 1, 2, 3])
+        self.assertEquals(self.cluster[0].executed, [[('incr', ('a',)), ('get', ('a',)), ('incrby', ('a', 2))]])
+
+    def test_does_not_merge_other_amounts(self):
+        with self.cluster.map() as conn:
+            conn.incr('a', 1.5)
+            conn.incr('a')
+
+        self.assertEquals(self.cluster[0].executed, [[('incr', ('a', 1.5)), ('incr', ('a',))]])
+
+    def test_errors_resolve_every_merged_command(self):
+        self.cluster[0].counters['a'] = 'foo'
+        with self.cluster.map(fail_silently=True) as conn:
+            first = conn.incr('a')
+            second = conn.incr('a')
+
+        self.assertEquals(len(conn.get_errors()), 2)
+        self.assertTrue(isinstance(first, ValueError))
+        self.assertTrue(isinstance(second, ValueError))
+
+    def test_coalesce_counters_disabled(self):
+        with self.cluster.map(coalesce_counters=False) as conn:
+            results = [conn.incr('a'), conn.incr('a')]
+
+        self.assertEquals(results, [1, 2])
+        self.assertEquals(self.cluster[0].executed, [[('incr', ('a',)), ('incr', ('a',))]])
+
+
+class WritingConnection(DummyConnection):
+    commands = CommandTable([
+        Command('get', read=True),
+        Command('set', replaces=True, unless={'nx': 2}),
+        Command('delete', keys=KEYS, merge='sum', replaces=(1, 0)),
+    ])
+
+    def __init__(self, num, **kwargs):
+        self.data = {}
+        self.executed = []
+        super(WritingConnection, self).__init__(num, **kwargs)
+
+    def get(self, key):
+        self.executed.append(('get', key))
+        return self.data.get(key)
+
+    def set(self, key, value, nx=False):
+        self.executed.append(('set', key, value))
+        if not (nx and key in self.data):
+            self.data[key] = value
+        return True
+
+    def delete(self, *keys):
+        self.executed.append(('delete',) + keys)
+        return len([self.data.pop(key) for key in keys if key in self.data])
+
+
+class PipelinedWritingConnection(WritingConnection):
+    supports_pipelines = True
+
+    def get_pipeline(self, **options):
+        return CountingPipeline(self)
+
+
+class ReplacedWritesMapTest(BaseTest):
+    @fixture
+    def cluster(self):
+        return BaseCluster(
+            backend=WritingConnection,
+            hosts={0: {}},
+        )
+
+    def test_drops_replaced_writes(self):
+        with self.cluster.map(coalesce_writes=True) as conn:
+            results = [conn.set('a', 1), conn.set('b', 1), conn.set('a', 2), conn.delete('a'), conn.set('a', 3)]
+
+        self.assertEquals(results, [True, True, True, 1, True])
+        self.assertEquals(self.cluster[0].executed, [('set', 'b', 1), ('set', 'a', 2), ('set', 'a', 3)])
+        self.assertEquals(self.cluster[0].data, {'a': 3, 'b': 1})
+
+    def test_keeps_writes_followed_by_a_delete(self):
+        with self.cluster.map(coalesce_writes=True) as conn:
+            results = [conn.set('a', 1), conn.delete('a')]
+
+        self.assertEquals(results, [True, 1])
+        self.assertEquals(self.cluster[0].executed, [('set', 'a', 1), ('delete', 'a')])
+        self.assertEquals(self.cluster[0].data, {})
+
+    def test_keeps_writes_read_in_between(self):
+        with self.cluster.map(coalesce_writes=True) as conn:
+            results = [conn.set('a', 1), conn.get('a'), conn.set('a', 2)]
+
+        self.assertEquals(results, [True, 1, True])
+        self.assertEquals(len(self.cluster[0].executed), 3)
+
+    def test_keeps_deletes_of_unknown_keys(self):
+        with self.cluster.map(coalesce_writes=True) as conn:
+            results = [conn.delete('a'), conn.set('a', 1)]
+
+        self.assertEquals(results, [0, True])
+        self.assertEquals(self.cluster[0].executed, [('delete', 'a'), ('set', 'a', 1)])
+
+    def test_keeps_conditional_writes(self):
+        with self.cluster.map(coalesce_writes=True) as conn:
+            conn.set('a', 1, nx=True)
+            conn.set('a', 2)
+
+        self.assertEquals(self.cluster[0].executed, [('set', 'a', 1), ('set', 'a', 2)])
+
+    def test_disabled_by_default(self):
+        with self.cluster.map() as conn:
+            conn.set('a', 1)
+            conn.set('a', 2)
+
+        self.assertEquals(self.cluster[0].executed, [('set', 'a', 1), ('set', 'a', 2)])
+
+    def test_pipelines(self):
+        cluster = BaseCluster(backend=PipelinedWritingConnection, hosts={0: {}})
+        with cluster.map(coalesce_writes=True) as conn:
+            results = [conn.set('a', 1), conn.set('a', 2), conn.delete('b'), conn.get('a')]
+
+        self.assertEquals(results, [True, True, 0, 2])
+        self.assertEquals(cluster[0].executed[-3:], [('set', 'a', 2), ('delete', 'b'), ('get', 'a')])
+
+
 class MapWithFailuresTest(BaseTest):
     @fixture
     def cluster(self):
@@ -386,3 +1066,54 @@ class ApplyDefaultsTest(BaseTest):
         self.assertEquals(results, {
             'port': 6379,
         })
+
+
+class ThreadPoolTest(BaseTest):
+    def test_join_runs_tasks(self):
+        pool = ThreadPool(2)
+        pool.add('a', lambda: 1)
+        pool.add('b', lambda: 2)
+        self.assertEquals(pool.join(), {'a': [1], 'b': [2]})
+
+    def test_start_runs_tasks_before_join(self):
+        done = threading.Event()
+        pool = ThreadPool(1)
+        pool.start()
+        pool.add('a', done.set)
+        self.assertTrue(done.wait(5))
+        self.assertEquals(pool.join(), {'a': [None]})
+
+    def test_collects_errors(self):
+        pool = ThreadPool(1)
+        pool.add('a', int, ('a',))
+        result = pool.join()['a'][0]
+        self.assertTrue(isinstance(result, ValueError))
+
+
+class IterParallelTest(BaseTest):
+    def test_yields_every_item(self):
+        results = iter_parallel([xrange(3), xrange(3, 5), []])
+        self.assertEquals(sorted(results), range(5))
+
+    def test_bounds_buffered_items(self):
+        produced = []
+
+        def produce():
+            for n in xrange(100):
+                produced.append(n)
+                yield n
+
+        results = iter_parallel([produce()], buffer_size=1)
+        self.assertEquals(results.next(), 0)
+        time.sleep(0.05)
+        # one item consumed, one buffered and one waiting to be buffered
+        self.assertTrue(len(produced) <= 3, produced)
+        results.close()
+
+    def test_propagates_errors(self):
+        def produce():
+            yield 1
+            raise ValueError()
+
+        with self.assertRaises(ValueError):
+            list(iter_parallel([produce()]))
@@ -0,0 +1,346 @@
+from __future__ import absolute_import
+
+import mock
+import threading
+
+from nydus.db.backends.base import BaseConnection
+from nydus.db.base import BaseCluster
+from nydus.db.commands import Command, CommandTable, KEY_LIST
+from nydus.db.exceptions import CommandError
+from nydus.db.migrate import DualReadCluster, Migration, ShadowCluster
+from nydus.db.routers.keyvalue import PartitionRouter
+from nydus.testutils import BaseTest, fixture
+
+
+class MemoryPipeline(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.pending = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.pending.append((name, args, kwargs))
+        return queue
+
+    def execute(self, raise_on_error=True):
+        results = []
+        for name, args, kwargs in self.pending:
+            try:
+                results.append(getattr(self.connection, name)(*args, **kwargs))
+            except Exception as e:
+                if raise_on_error:
+                    raise
+                results.append(e)
+        return results
+
+
+class MemoryConnection(BaseConnection):
+    """
+    Stores ``key: (value, ttl)`` in memory, and speaks just enough Redis to
+    be migrated.
+    """
+    commands = CommandTable([
+        Command('get', read=True),
+        Command('mget', keys=KEY_LIST, read=True, merge='list'),
+        Command('get_multi', keys=KEY_LIST, read=True, merge='dict'),
+    ])
+
+    def __init__(self, num, host='localhost', **options):
+        self.host = host
+        self.data = {}
+        super(MemoryConnection, self).__init__(num, **options)
+
+    @property
+    def identifier(self):
+        return '%s/%s' % (self.host, self.num)
+
+    def scan(self, cursor, match=None, count=None):
+        keys = sorted(self.data)
+        cursor = int(cursor)
+        page = keys[cursor:cursor + count]
+        if cursor + count >= len(keys):
+            return 0, page
+        return cursor + count, page
+
+    def pipeline(self, transaction=True):
+        return MemoryPipeline(self)
+
+    def dump(self, key):
+        if key not in self.data:
+            return None
+        return 'dump:%s' % (self.data[key][0],)
+
+    def pttl(self, key):
+        if key not in self.data:
+            return -2
+        return self.data[key][1]
+
+    def restore(self, key, ttl, data, replace=False):
+        if data == 'dump:error':
+            raise ValueError(data)
+        self.data[key] = (data[len('dump:'):], ttl or -1)
+        return True
+
+    def get(self, key):
+        return self.data.get(key, (None,))[0]
+
+    def mget(self, keys):
+        return [self.get(k) for k in keys]
+
+    def get_multi(self, keys):
+        return dict((k, self.data[k][0]) for k in keys if k in self.data)
+
+    def set(self, key, value):
+        self.data[key] = (value, -1)
+
+    def delete(self, key):
+        return int(self.data.pop(key, None) is not None)
+
+
+def create_memory_cluster(num_hosts):
+    return BaseCluster(
+        backend=MemoryConnection,
+        router=PartitionRouter,
+        hosts=dict((n, {'host': 'host%d' % n}) for n in xrange(num_hosts)),
+    )
+
+
+class MigrationTest(BaseTest):
+    @fixture
+    def source(self):
+        cluster = create_memory_cluster(2)
+        for n in xrange(50):
+            cluster.set('key:%d' % n, 'value:%d' % n)
+        cluster.get_conn('key:7').data['key:7'] = ('value:7', 5000)
+        return cluster
+
+    @fixture
+    def target(self):
+        return create_memory_cluster(3)
+
+    @fixture
+    def migration(self):
+        return Migration(self.source, self.target, batch_size=7, workers=2)
+
+    def test_copies_keys_to_new_layout(self):
+        stats = self.migration.run()
+
+        for n in xrange(50):
+            key = 'key:%d' % n
+            if self.source.get_conn(key).identifier != self.target.get_conn(key).identifier:
+                self.assertEquals(self.target.get(key), 'value:%d' % n)
+        self.assertEquals(self.target.get_conn('key:7').data['key:7'], ('value:7', 5000))
+
+        self.assertEquals(stats['scanned'], 50)
+        self.assertEquals(stats['copied'] + stats['skipped'], 50)
+        self.assertEquals(stats['errors'], 0)
+        self.assertTrue(stats['elapsed'] > 0)
+
+    def test_skips_keys_which_stay_on_the_same_server(self):
+        stats = self.migration.run()
+
+        skipped = [k for conn in self.source.hosts.itervalues() for k in conn.data
+                   if self.target.get_conn(k).identifier == conn.identifier]
+        self.assertTrue(skipped)
+        self.assertEquals(stats['skipped'], len(skipped))
+        for key in skipped:
+            # skipped keys are not written, as they are already in place
+            self.assertFalse(key in self.target.get_conn(key).data)
+
+    def test_counts_missing_keys_and_errors(self):
+        conn = self.source.get_conn('key:1')
+        with mock.patch.object(conn, 'dump', side_effect=lambda key: None if key == 'key:1' else 'dump:error'):
+            stats = self.migration.run()
+
+        self.assertEquals(stats['missing'], 1)
+        self.assertTrue(stats['errors'] > 0)
+
+    def test_reports_progress(self):
+        progress = mock.Mock()
+        self.migration.run(progress=progress)
+        self.assertTrue(progress.call_count >= 50 / 7)
+        self.assertTrue('keys_per_second' in progress.call_args[0][0])
+
+
+class DualReadClusterTest(BaseTest):
+    @fixture
+    def previous(self):
+        cluster = create_memory_cluster(2)
+        cluster.set('old', 'old value')
+        cluster.set('both', 'stale value')
+        return cluster
+
+    @fixture
+    def cluster(self):
+        cluster = create_memory_cluster(3)
+        cluster.set('both', 'new value')
+        cluster.set('new', 'new value')
+        return DualReadCluster(cluster, self.previous)
+
+    def test_reads_fall_back_to_previous_layout(self):
+        self.assertEquals(self.cluster.get('new'), 'new value')
+        self.assertEquals(self.cluster.get('both'), 'new value')
+        self.assertEquals(self.cluster.get('old'), 'old value')
+        self.assertEquals(self.cluster.get('missing'), None)
+
+    def test_empty_values_do_not_fall_back(self):
+        self.cluster.cluster.set('old', '')
+        self.assertEquals(self.cluster.get('old'), '')
+
+    def test_multi_key_reads_only_fetch_missing_keys(self):
+        with mock.patch.object(self.previous, 'execute', wraps=self.previous.execute) as execute:
+            values = self.cluster.mget(['new', 'old', 'both', 'missing'])
+        self.assertEquals(values, ['new value', 'old value', 'new value', None])
+        execute.assert_called_once_with('mget', (['old', 'missing'],), {}, False)
+
+    def test_mapping_reads_only_fetch_missing_keys(self):
+        with mock.patch.object(self.previous, 'execute', wraps=self.previous.execute) as execute:
+            values = self.cluster.get_multi(['new', 'old', 'both', 'missing'])
+        self.assertEquals(values, {'new': 'new value', 'old': 'old value', 'both': 'new value'})
+        execute.assert_called_once_with('get_multi', (['old', 'missing'],), {}, False)
+
+    def test_writes_go_to_new_layout(self):
+        self.cluster.set('old', 'value')
+        self.assertEquals(self.cluster.cluster.get('old'), 'value')
+        self.assertEquals(self.previous.get('old'), 'old value')
+
+    def test_deletes_go_to_both_layouts(self):
+        self.cluster.delete('old')
+        self.assertEquals(self.cluster.get('old'), None)
+
+    def test_proxies_cluster_attributes(self):
+        self.assertEquals(self.cluster.hosts, self.cluster.cluster.hosts)
+        self.assertEquals(self.cluster.router, self.cluster.cluster.router)
+        self.assertEquals(self.cluster.get_conn('new').get('new'), 'new value')
+        self.assertEquals(self.cluster.raw.get('old'), 'old value')
+
+
+class ShadowClusterTest(BaseTest):
+    @fixture
+    def primary(self):
+        return create_memory_cluster(2)
+
+    @fixture
+    def shadow(self):
+        return create_memory_cluster(3)
+
+    def test_mirrors_writes(self):
+        cluster = ShadowCluster(self.primary, self.shadow)
+        cluster.set('foo', 'bar')
+        self.assertEquals(cluster.get('foo'), 'bar')
+        cluster.join()
+
+        self.assertEquals(self.shadow.get('foo'), 'bar')
+        stats = cluster.get_stats()
+        self.assertEquals(stats['queued'], 1)
+        self.assertEquals(stats['executed'], 1)
+        self.assertEquals(stats['pending'], 0)
+        self.assertTrue(stats['max_lag'] >= stats['lag'] >= 0)
+        cluster.close()
+
+    def test_mirrors_writes_within_map(self):
+        cluster = ShadowCluster(self.primary, self.shadow, read_sample_rate=1)
+        with cluster.map() as conn:
+            conn.set('foo', 'bar')
+            result = conn.get('foo')
+        self.assertEquals(result, 'bar')
+        cluster.join()
+
+        self.assertEquals(self.shadow.get('foo'), 'bar')
+        self.assertEquals(cluster.get_stats()['queued'], 1)
+        cluster.close()
+
+    def test_mirrors_successful_writes_when_others_fail(self):
+        cluster = ShadowCluster(self.primary, self.shadow)
+        with self.assertRaises(CommandError):
+            with cluster.map() as conn:
+                conn.set('foo', 'bar')
+                conn.restore('baz', 0, 'dump:error')
+        cluster.join()
+
+        self.assertEquals(self.shadow.get('foo'), 'bar')
+        self.assertEquals(cluster.get_stats()['queued'], 1)
+        cluster.close()
+
+    def test_can_be_wrapped(self):
+        previous = create_memory_cluster(2)
+        previous.set('old', 'old value')
+        shadowed = ShadowCluster(self.primary, self.shadow)
+        cluster = DualReadCluster(shadowed, previous)
+        self.assertEquals(cluster.hosts, self.primary.hosts)
+        self.assertEquals(cluster.get('old'), 'old value')
+
+        cluster.set('foo', 'bar')
+        shadowed.join()
+        self.assertEquals(self.shadow.get('foo'), 'bar')
+        shadowed.close()
+
+    def test_samples_reads_and_compares_results(self):
+        on_mismatch = mock.Mock()
+        cluster = ShadowCluster(self.primary, self.shadow, read_sample_rate=1, on_mismatch=on_mismatch)
+        self.primary.set('foo', 'bar')
+        self.shadow.set('baz', 'qux')
+        cluster.get('foo')
+        cluster.get('baz')
+        cluster.join()
+
+        stats = cluster.get_stats()
+        self.assertEquals(stats['executed'], 2)
+        self.assertEquals(stats['mismatches'], 2)
+        on_mismatch.assert_any_call('get', ('foo',), {}, 'bar', None)
+        cluster.close()
+
+    def test_reads_are_not_mirrored_by_default(self):
+        cluster = ShadowCluster(self.primary, self.shadow)
+        cluster.get('foo')
+        cluster.join()
+        self.assertEquals(cluster.get_stats()['queued'], 0)
+        cluster.close()
+
+    def test_counts_errors(self):
+        cluster = ShadowCluster(self.primary, self.shadow)
+        with mock.patch.object(self.shadow, 'execute', side_effect=ValueError()):
+            cluster.set('foo', 'bar')
+            cluster.join()
+        self.assertEquals(cluster.get_stats()['errors'], 1)
+        cluster.close()
+
+    def blocked_cluster(self, **kwargs):
+        # the worker blocks on the first command, so the queue fills up
+        started, release = threading.Event(), threading.Event()
+        execute = self.shadow.execute
+
+        def blocking_execute(*args, **kwargs):
+            started.set()
+            release.wait()
+            return execute(*args, **kwargs)
+
+        self.shadow.execute = blocking_execute
+        cluster = ShadowCluster(self.primary, self.shadow, queue_size=2, **kwargs)
+        cluster.set('first', 1)
+        started.wait()
+        return cluster, release
+
+    def test_drops_newest_commands_when_full(self):
+        cluster, release = self.blocked_cluster(drop_policy='newest')
+        for n in xrange(4):
+            cluster.set('key:%d' % n, n)
+        release.set()
+        cluster.join()
+
+        self.assertEquals(cluster.get_stats()['dropped'], 2)
+        self.assertEquals(self.shadow.get('key:1'), 1)
+        self.assertEquals(self.shadow.get('key:3'), None)
+        cluster.close()
+
+    def test_drops_oldest_commands_when_full(self):
+        cluster, release = self.blocked_cluster(drop_policy='oldest')
+        for n in xrange(4):
+            cluster.set('key:%d' % n, n)
+        release.set()
+        cluster.join()
+
+        self.assertEquals(cluster.get_stats()['dropped'], 2)
+        self.assertEquals(self.shadow.get('key:1'), None)
+        self.assertEquals(self.shadow.get('key:3'), 3)
+        cluster.close()
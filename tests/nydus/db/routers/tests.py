@@ -1,15 +1,23 @@
 from __future__ import absolute_import
 
 import mock
+import random
+import threading
 import time
 
 from collections import Iterable
 from inspect import getargspec
 
+from nydus.db import create_cluster
 from nydus.db.base import BaseCluster
+from nydus.db.commands import Command, CommandTable, KEYS
 from nydus.db.backends import BaseConnection
+from nydus.db.backends.memcache import Memcache
+from nydus.db.backends.redis import REDIS_COMMANDS
+from nydus.contrib.ketama import Ketama, LibmemcachedKetama
 from nydus.db.routers import BaseRouter, RoundRobinRouter
-from nydus.db.routers.keyvalue import ConsistentHashingRouter
+from nydus.db.routers.hotkeys import HotKeySampler
+from nydus.db.routers.keyvalue import ConsistentHashingRouter, get_key
 from nydus.testutils import BaseTest
 
 
@@ -228,6 +236,20 @@ class RoundRobinRouterTest(BaseRoundRobinRouterTest):
         with self.assertRaises(RoundRobinRouter.HostListExhausted):
             self.router._route(attr='test', args=('foo',))
 
+    def test_add_host_joins_cycle(self):
+        self.router.setup_router()
+        self.cluster.add_host(5, {})
+        results = [self.router._route(attr='test', args=('foo',))[0] for _ in xrange(6)]
+        self.assertEqual(sorted(results), range(6))
+
+    def test_remove_host_leaves_cycle(self):
+        self.router.setup_router()
+        self.router.mark_connection_down(4)
+        self.cluster.remove_host(4)
+        self.assertEquals(self.router._down_connections, {})
+        results = [self.router._route(attr='test', args=('foo',))[0] for _ in xrange(8)]
+        self.assertEqual(results, range(4) * 2)
+
 
 class ConsistentHashingRouterTest(BaseRoundRobinRouterTest):
     Router = ConsistentHashingRouter
@@ -254,3 +276,339 @@ class ConsistentHashingRouterTest(BaseRoundRobinRouterTest):
         self.assertRaises(
             ConsistentHashingRouter.HostListExhausted,
             self.get_dbs, **dict(args=('foo',), retry_for=4))
+
+    def test_replicated_key_writes_go_to_all_replicas(self):
+        self.router.replicate_key('foo', 3)
+        db_nums = self.router.get_dbs(attr='set', args=('foo', 'bar'))
+        self.assertEquals(len(db_nums), 3)
+        self.assertTrue(2 in db_nums)
+        # other keys are unaffected
+        self.assertEquals(self.router.get_dbs(attr='set', args=('bar', 'bar')), self.get_dbs(args=('bar',)))
+
+    def test_replicated_key_reads_go_to_one_replica(self):
+        self.cluster.commands = CommandTable([Command('get', read=True)])
+        self.router.replicate_key('foo', 3)
+        replicas = self.router.get_dbs(attr='set', args=('foo', 'bar'))
+        seen = set()
+        for n in xrange(50):
+            db_nums = self.router.get_dbs(attr='get', args=('foo',))
+            self.assertEquals(len(db_nums), 1)
+            seen.update(db_nums)
+        self.assertEquals(seen, set(replicas))
+
+    def test_replicated_keys_are_counted_once(self):
+        self.cluster.commands = CommandTable([Command('delete', keys=KEYS, merge='sum')])
+        self.router.replicate_key('foo', 3)
+        for keys in (('foo',), ('foo', 'bar', 'baz')):
+            part_keys = [part[3] for part in self.router.split_command('delete', keys, {})]
+            # the key is deleted from each of its nodes
+            self.assertEquals(sum(map(len, part_keys)), len(keys) + 2)
+            merged = self.cluster.commands['delete'].merge(keys, [(k, len(k)) for k in part_keys])
+            self.assertEquals(merged, len(keys))
+
+    def test_keyless_scripts_run_on_a_single_node(self):
+        self.cluster.commands = REDIS_COMMANDS
+        self.assertEquals(len(self.router.get_dbs(attr='evalsha', args=('sha', 0))), 1)
+        self.assertEquals(len(self.router.get_dbs(attr='info', args=('memory',))), len(self.cluster))
+
+    def test_unreplicate_key(self):
+        self.router.replicate_key('foo', 3)
+        self.router.unreplicate_key('foo')
+        self.assertEquals(self.router.get_dbs(attr='set', args=('foo', 'bar')), [2])
+        self.assertEquals(self.router.get_replicated_keys(), {})
+
+    def test_replicated_keys_option(self):
+        cluster = BaseCluster(router=self.Router, hosts=self.hosts, backend=DummyConnection,
+                              router_options={'replicated_keys': {'foo': 2}})
+        self.assertEquals(cluster.router.get_replicated_keys(), {'foo': 2})
+        self.assertEquals(len(cluster.router.get_dbs(attr='set', args=('foo', 'bar'))), 2)
+
+    def test_replicate_hot_keys(self):
+        cluster = BaseCluster(router=self.Router, hosts=self.hosts, backend=DummyConnection,
+                              hot_keys=True)
+        router = cluster.router
+        with mock.patch.object(cluster.hot_keys, 'get_last_hot_keys', return_value=[('foo', 2, 10), ('bar', 1, 1)]):
+            self.assertEquals(router.replicate_hot_keys(limit=2, replicas=2, min_count=5), ['foo'])
+        self.assertEquals(router.get_replicated_keys(), {'foo': 2})
+
+        with mock.patch.object(cluster.hot_keys, 'get_last_hot_keys', return_value=[('bar', 1, 10)]):
+            router.replicate_hot_keys(replicas=2)
+        self.assertEquals(router.get_replicated_keys(), {'bar': 2})
+
+    def test_add_host_only_moves_keys_to_new_host(self):
+        keys = ['key%d' % i for i in xrange(200)]
+        before = dict((k, self.get_dbs(args=(k,))) for k in keys)
+        self.cluster.add_host(5, {})
+        after = dict((k, self.get_dbs(args=(k,))) for k in keys)
+
+        moved = [k for k in keys if after[k] != before[k]]
+        self.assertTrue(moved)
+        for k in moved:
+            self.assertEquals(after[k], [5])
+
+    def test_remove_host_only_moves_its_keys(self):
+        keys = ['key%d' % i for i in xrange(200)]
+        before = dict((k, self.get_dbs(args=(k,))) for k in keys)
+        self.cluster.remove_host(2)
+        after = dict((k, self.get_dbs(args=(k,))) for k in keys)
+
+        for k in keys:
+            if before[k] == [2]:
+                self.assertNotEquals(after[k], [2])
+            else:
+                self.assertEquals(after[k], before[k])
+
+    def test_retry_for_removed_host(self):
+        self.assertEquals([2], self.get_dbs(args=('foo',)))
+        self.cluster.remove_host(2)
+        self.assertEquals([4], self.get_dbs(args=('foo',), retry_for=2))
+        self.assertEquals(self.router._down_connections, {})
+
+    def test_weighted_hosts(self):
+        cluster = BaseCluster(router=self.Router, backend=DummyConnection, hosts={
+            0: {},
+            1: {'weight': 3},
+        })
+        self.assertEquals(cluster[1].weight, 3)
+        counts = [0, 0]
+        for i in xrange(2000):
+            counts[cluster.router.get_dbs(attr='test', args=('key%d' % i,))[0]] += 1
+        self.assertTrue(2 < counts[1] / float(counts[0]) < 4.5, counts)
+
+    def test_weight_survives_down_and_up(self):
+        cluster = BaseCluster(router=self.Router, backend=DummyConnection, hosts={
+            0: {},
+            1: {'weight': 3},
+        })
+        router = cluster.router
+        router.setup_router()
+        sorted_keys = router._hash._sorted_keys
+        router.mark_connection_down(1)
+        router.mark_connection_up(1)
+        self.assertEquals(router._hash._sorted_keys, sorted_keys)
+
+        cluster.add_host(2, {'weight': 2})
+        self.assertEquals(len(router._hash._points['dummyhost:2']), 320)
+
+
+class KetamaTest(BaseTest):
+    def test_get_nodes(self):
+        ketama = Ketama(['a', 'b', 'c', 'd'])
+        nodes = ketama.get_nodes('foo', 3)
+        self.assertEquals(len(set(nodes)), 3)
+        self.assertEquals(nodes[0], ketama.get_node('foo'))
+
+    def test_get_nodes_is_bounded_by_number_of_nodes(self):
+        ketama = Ketama(['a', 'b'])
+        self.assertEquals(sorted(ketama.get_nodes('foo', 3)), ['a', 'b'])
+        self.assertEquals(Ketama().get_nodes('foo', 3), [])
+
+    def test_add_and_remove_node(self):
+        ketama = Ketama(['a', 'b'])
+        ketama.add_node('c')
+        expected = Ketama(['a', 'b', 'c'])
+        self.assertEquals(ketama._sorted_keys, expected._sorted_keys)
+        self.assertEquals(ketama._hashring, expected._hashring)
+
+        ketama.remove_node('c')
+        expected = Ketama(['a', 'b'])
+        self.assertEquals(ketama._sorted_keys, expected._sorted_keys)
+        self.assertEquals(ketama._hashring, expected._hashring)
+
+
+class LibmemcachedKetamaTest(BaseTest):
+    # placements reported by libmemcached 1.0.18 with ketama_weighted
+    keys = ['foo', 'bar', 'baz', 'user:1', 'user:2', 'user:3', 'session:abc', 'session:def', 'page:home', 'page:about']
+
+    def test_placements(self):
+        ketama = LibmemcachedKetama(['10.0.1.1:11211', '10.0.1.2:11211', '10.0.1.3:11212'])
+        self.assertEquals(dict((k, ketama.get_node(k)) for k in self.keys), {
+            'foo': '10.0.1.1:11211',
+            'bar': '10.0.1.3:11212',
+            'baz': '10.0.1.3:11212',
+            'user:1': '10.0.1.3:11212',
+            'user:2': '10.0.1.2:11211',
+            'user:3': '10.0.1.2:11211',
+            'session:abc': '10.0.1.2:11211',
+            'session:def': '10.0.1.1:11211',
+            'page:home': '10.0.1.3:11212',
+            'page:about': '10.0.1.1:11211',
+        })
+        self.assertEquals(len(ketama._sorted_keys), 480)
+
+    def test_weighted_placements(self):
+        ketama = LibmemcachedKetama(['cache1:11211', 'cache2:11211', 'cache3:11213'], weights={
+            'cache1:11211': 1,
+            'cache2:11211': 4,
+            'cache3:11213': 2,
+        })
+        self.assertEquals(dict((k, ketama.get_node(k)) for k in self.keys), {
+            'foo': 'cache2:11211',
+            'bar': 'cache2:11211',
+            'baz': 'cache2:11211',
+            'user:1': 'cache3:11213',
+            'user:2': 'cache3:11213',
+            'user:3': 'cache3:11213',
+            'session:abc': 'cache3:11213',
+            'session:def': 'cache2:11211',
+            'page:home': 'cache1:11211',
+            'page:about': 'cache2:11211',
+        })
+
+    def test_point_keys(self):
+        ketama = LibmemcachedKetama()
+        self.assertEquals(ketama._get_point_key('cache1:11211', 3), 'cache1-3')
+        self.assertEquals(ketama._get_point_key('cache1:11213', 3), 'cache1:11213-3')
+
+    def test_add_and_remove_node(self):
+        ketama = LibmemcachedKetama(['cache1:11211', 'cache2:11211'], weights={'cache2:11211': 2})
+        ketama.add_node('cache3:11211', 3)
+        expected = LibmemcachedKetama(['cache1:11211', 'cache2:11211', 'cache3:11211'],
+                                      weights={'cache2:11211': 2, 'cache3:11211': 3})
+        self.assertEquals(ketama._sorted_keys, expected._sorted_keys)
+
+        ketama.remove_node('cache3:11211')
+        expected = LibmemcachedKetama(['cache1:11211', 'cache2:11211'], weights={'cache2:11211': 2})
+        self.assertEquals(ketama._sorted_keys, expected._sorted_keys)
+
+    def test_router_option(self):
+        cluster = BaseCluster(
+            backend=Memcache,
+            router=ConsistentHashingRouter,
+            router_options={'libmemcached_compat': True},
+            hosts={
+                0: {'host': '10.0.1.1'},
+                1: {'host': '10.0.1.2'},
+                2: {'host': '10.0.1.3', 'port': 11212},
+            },
+        )
+        self.assertEquals(cluster.router.get_dbs(attr='get', args=('foo',)), [0])
+        self.assertEquals(cluster.router.get_dbs(attr='get', args=('user:2',)), [1])
+        self.assertEquals(cluster.router.get_dbs(attr='get', args=('bar',)), [2])
+        self.assertTrue(isinstance(cluster.router._hash, LibmemcachedKetama))
+
+    def test_lookups_during_rebuilds(self):
+        ketama = LibmemcachedKetama(['10.0.1.1:11211', '10.0.1.2:11211'])
+        errors = []
+        done = threading.Event()
+
+        def lookup():
+            while not done.is_set():
+                try:
+                    for key in self.keys:
+                        ketama.get_node(key)
+                except Exception as e:
+                    errors.append(e)
+                    return
+
+        thread = threading.Thread(target=lookup)
+        thread.start()
+        try:
+            for i in xrange(200):
+                ketama.add_node('10.0.1.3:11212')
+                ketama.remove_node('10.0.1.3:11212')
+        finally:
+            done.set()
+            thread.join()
+        self.assertEquals(errors, [])
+
+
+class GetKeyTest(BaseTest):
+    def test_first_argument(self):
+        self.assertEquals(get_key(('foo', 'bar'), {}), 'foo')
+
+    def test_key_keyword_argument(self):
+        self.assertEquals(get_key((), {'key': 'foo'}), 'foo')
+
+
+class HotKeySamplerTest(BaseTest):
+    def test_counts_keys(self):
+        sampler = HotKeySampler(sample_rate=1)
+        for key in ('foo', 'bar', 'foo', 'baz', 'foo', 'bar'):
+            sampler.record(key, [1])
+        self.assertEquals(sampler.get_hot_keys(), [('foo', 1, 3), ('bar', 1, 2), ('baz', 1, 1)])
+        self.assertEquals(sampler.get_hot_keys(limit=1), [('foo', 1, 3)])
+
+    def test_replaces_least_frequent_key_when_full(self):
+        sampler = HotKeySampler(capacity=2, sample_rate=1)
+        for key in ('foo', 'foo', 'foo', 'bar', 'baz'):
+            sampler.record(key, [0])
+        # baz inherits the count of bar, which it replaced
+        self.assertEquals(sampler.get_hot_keys(), [('foo', 0, 3), ('baz', 0, 2)])
+
+    def test_never_underestimates_counts(self):
+        sampler = HotKeySampler(capacity=5, sample_rate=1)
+        rand = random.Random(0)
+        keys = ['key:%d' % min(int(rand.expovariate(0.3)), 20) for n in xrange(1000)]
+        for key in keys:
+            sampler.record(key, [0])
+
+        hot_keys = sampler.get_hot_keys()
+        self.assertEquals(len(hot_keys), 5)
+        # every call is counted once, by whichever key holds it
+        self.assertEquals(sum(count for key, db_num, count in hot_keys), len(keys))
+        for key, db_num, count in hot_keys:
+            self.assertTrue(count >= keys.count(key))
+        self.assertEquals(hot_keys[0][0], 'key:0')
+
+    def test_logs_keys_reaching_threshold(self):
+        sampler = HotKeySampler(sample_rate=1, log_threshold=3)
+        with mock.patch.object(sampler.logger, 'info') as info:
+            for key in ('foo', 'bar', 'foo', 'foo', 'foo'):
+                sampler.record(key, [0])
+        self.assertEquals(info.call_count, 1)
+        self.assertEquals(info.call_args[0][1:4], ('foo', 0, 3))
+
+    def test_scales_sampled_counts(self):
+        sampler = HotKeySampler(sample_rate=0.5)
+        with mock.patch('random.random', return_value=0.1):
+            sampler.record('foo', [0])
+        with mock.patch('random.random', return_value=0.9):
+            sampler.record('foo', [0])
+        self.assertEquals(sampler.get_hot_keys(), [('foo', 0, 2)])
+
+    def test_rotates_windows(self):
+        sampler = HotKeySampler(window=60, sample_rate=1)
+        sampler.window_start = 0
+        with mock.patch('time.time', return_value=30):
+            sampler.record('foo', [0])
+        with mock.patch('time.time', return_value=61):
+            with mock.patch.object(sampler.logger, 'info') as info:
+                sampler.record('bar', [1])
+        self.assertEquals(sampler.get_last_hot_keys(), [('foo', 0, 1)])
+        self.assertEquals(sampler.get_hot_keys(), [('bar', 1, 1)])
+        self.assertEquals(sampler.window_start, 61)
+        self.assertTrue(info.called)
+
+    def test_ignores_unhashable_keys(self):
+        sampler = HotKeySampler(sample_rate=1)
+        sampler.record(['foo'], [0])
+        self.assertEquals(sampler.get_hot_keys(), [])
+
+
+class HotKeyRoutingTest(BaseTest):
+    def test_records_routed_keys(self):
+        cluster = BaseCluster(router=ConsistentHashingRouter, hosts=dict((i, {}) for i in xrange(5)),
+                              backend=DummyConnection, hot_keys={'capacity': 10, 'sample_rate': 1})
+        db_num = cluster.router.get_dbs(attr='get', args=('foo',))[0]
+        cluster.router.get_dbs(attr='get', args=('foo',))
+        cluster.router.get_dbs(attr='keys', args=())
+        self.assertEquals(cluster.hot_keys.get_hot_keys(), [('foo', db_num, 2)])
+
+    def test_disabled_by_default(self):
+        cluster = BaseCluster(router=ConsistentHashingRouter, hosts={0: {}}, backend=DummyConnection)
+        self.assertEquals(cluster.hot_keys, None)
+        self.assertEquals(cluster.router.sampler, None)
+
+    def test_samples_few_calls_by_default(self):
+        self.assertEquals(HotKeySampler().sample_rate, 0.01)
+
+    def test_accepts_sampler_instances(self):
+        sampler = HotKeySampler()
+        cluster = create_cluster({
+            'backend': DummyConnection,
+            'router': ConsistentHashingRouter,
+            'hosts': {0: {}},
+            'hot_keys': sampler,
+        })
+        self.assertTrue(cluster.hot_keys is sampler)